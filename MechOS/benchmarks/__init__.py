@@ -0,0 +1 @@
+"MechOS benchmarks"
@@ -0,0 +1,91 @@
+'''
+Description: Micro-benchmark of packing and unpacking the simple_messages types.
+             It compares the current codecs against packing with the module-level
+             struct functions and a format string rebuilt one character at a time,
+             which is how the array messages used to work. The array messages are
+             packed both from a list and from an array.array.
+
+             Run with: python -m MechOS.benchmarks.message_codecs
+'''
+import struct
+import array
+import timeit
+import argparse
+from MechOS.simple_messages.float_array import Float_Array
+from MechOS.simple_messages.int_array import Int_Array
+from MechOS.simple_messages.int import Int
+
+class Legacy_Array:
+    '''
+    The array message codec as it was before the precompiled structs, kept
+    here as the reference to compare against.
+    '''
+    def __init__(self, number_of_elements, element_format):
+        self.message_constructor = ''
+        for i in range(number_of_elements):
+            self.message_constructor += element_format
+        self.size = 4 * number_of_elements
+
+    def _pack(self, message):
+        return(struct.pack(self.message_constructor, *message))
+
+    def _unpack(self, encoded_message):
+        return(struct.unpack(self.message_constructor, encoded_message))
+
+def time_codec(message_format, message, repeat):
+    '''
+    Time packing and unpacking a message with a message format.
+
+    Parameters:
+        message_format: The message format object to time.
+        message: The message to pack.
+        repeat: The number of times to pack and unpack the message.
+    Returns:
+        pack_time: The average time in microseconds to pack the message.
+        unpack_time: The average time in microseconds to unpack the message.
+    '''
+    encoded_message = message_format._pack(message)
+    pack_time = min(timeit.repeat(lambda: message_format._pack(message), number=repeat, repeat=3))
+    unpack_time = min(timeit.repeat(lambda: message_format._unpack(encoded_message), number=repeat, repeat=3))
+    return(1e6*pack_time/repeat, 1e6*unpack_time/repeat)
+
+def run(sizes):
+    '''
+    Run the benchmark for each array size and print a table of the results.
+
+    Parameters:
+        sizes: A list of the number of elements of the array messages to time.
+    Returns:
+        results: A list of dictionaries with the timings of each case.
+    '''
+    results = []
+    print("%-12s %8s %12s %12s %12s %14s %14s" % ("message", "elements", "old pack us",
+                        "new pack us", "array pack us", "old unpack us", "new unpack us"))
+    for size in sizes:
+        for name, message_class, element_format, element in (("Float_Array", Float_Array, 'f', 1.5),
+                                                            ("Int_Array", Int_Array, 'i', 7)):
+            message = [element]*size
+            repeat = max(10, 200000 // size)
+
+            old_pack, old_unpack = time_codec(Legacy_Array(size, element_format), message, repeat)
+            new_pack, new_unpack = time_codec(message_class(size), message, repeat)
+            array_pack, _ = time_codec(message_class(size), array.array(element_format, message), repeat)
+
+            print("%-12s %8d %12.2f %12.2f %12.2f %14.2f %14.2f" % (name, size, old_pack, new_pack,
+                                                                array_pack, old_unpack, new_unpack))
+            results.append({"message": name, "elements": size,
+                            "old_pack_us": old_pack, "new_pack_us": new_pack, "array_pack_us": array_pack,
+                            "old_unpack_us": old_unpack, "new_unpack_us": new_unpack})
+
+    int_pack, int_unpack = time_codec(Int(), 7, 200000)
+    print("%-12s %8d %12s %12.2f %12s %14s %14.2f" % ("Int", 1, "-", int_pack, "-", "-", int_unpack))
+    return(results)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,10,100,1000,10000,100000",
+            help='''Comma separated numbers of elements of the array messages to time.''', type=str)
+    args = parser.parse_args()
+
+    run([int(size) for size in args.sizes.split(',')])
@@ -0,0 +1,381 @@
+'''
+Description: Measures the throughput, latency and fan-out of publishers and
+             subscribers. A local mechoscore is started and every run of the sweep
+             spawns one publisher process and the subscriber processes, so the
+             messages go through the real sockets or shared memory. Each message
+             carries its sequence number and the time it was published, which is
+             compared against the time it is received since the monotonic clock
+             is shared by the processes of a host.
+
+             The sweep covers every combination of protocol, message format,
+             publish rate and number of subscribers, and the results are written
+             as JSON: msgs/s and MB/s received, p50/p99/max latency and the
+             fraction of messages dropped.
+
+             Run with: python -m MechOS.benchmarks.pubsub --protocols tcp,udp
+                        --messages "Bool,Float_Array(1000),Float_Array(100000)"
+                        --rates 0,1000 --subscribers 1,4 --output results.json
+'''
+import re
+import sys
+import json
+import time
+import array
+import socket
+import struct
+import argparse
+import platform
+import itertools
+import subprocess
+import multiprocessing
+from MechOS import mechos
+from MechOS.simple_messages.bool import Bool
+from MechOS.simple_messages.int import Int
+from MechOS.simple_messages.float_array import Float_Array
+
+#Header of every benchmark message: the sequence number of the message and the
+#time.perf_counter() at which it was published.
+STAMP_HEADER = struct.Struct('<Id')
+
+#Seconds subscribers keep receiving after the publisher is done, for the
+#messages still on their way.
+DRAIN_TIME = 1.0
+
+#Seconds to wait for the processes of a run to start and connect.
+CONNECT_TIMEOUT = 30.0
+
+class Stamped_Message:
+    '''
+    Message format wrapping another message format with a sequence number and a
+    publish time. Messages are (sequence, stamp, payload) tuples.
+    '''
+    def __init__(self, message_format):
+        '''
+        Parameters:
+            message_format: The message format of the payload.
+        '''
+        self.message_format = message_format
+        self.size = STAMP_HEADER.size + message_format.size
+
+    def __reduce__(self):
+        return(Stamped_Message, (self.message_format,))
+
+    def _pack(self, message):
+        sequence, stamp, payload = message
+        return(b''.join((STAMP_HEADER.pack(sequence, stamp), self.message_format._pack(payload))))
+
+    def _unpack(self, encoded_message):
+        sequence, stamp = STAMP_HEADER.unpack_from(encoded_message, 0)
+        payload = self.message_format._unpack(memoryview(encoded_message)[STAMP_HEADER.size:])
+        return((sequence, stamp, payload))
+
+def message_format(message):
+    '''
+    Get the message format and a message to publish from the name of a message
+    format, e.g. "Bool", "Int" or "Float_Array(1000)".
+
+    Parameters:
+        message: The name of the message format.
+    Returns:
+        message_format: The message format object.
+        payload: A message of the format.
+    '''
+    if(message == "Bool"):
+        return(Bool(), True)
+    if(message == "Int"):
+        return(Int(), 1)
+
+    match = re.fullmatch(r"Float_Array\((\d+)\)", message)
+    if(match is not None):
+        length = int(match.group(1))
+        return(Float_Array(length), array.array('f', [0.5])*length)
+    raise ValueError("Unknown message format %s" % message)
+
+def get_free_port():
+    '''
+    Get a free port on the local host.
+    '''
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return(s.getsockname()[1])
+
+def start_mechoscore():
+    '''
+    Start mechoscore in its own process and wait for it to accept nodes.
+
+    Parameters:
+        N/A
+    Returns:
+        process: The subprocess.Popen of mechoscore.
+        port: The port of the mechoscore xmlrpc server.
+    '''
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, "-m", "MechOS.mechoscore", "--core_port", str(port),
+                                "--param_server_port", str(get_free_port())],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while(1):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return(process, port)
+        except OSError:
+            if(process.poll() is not None or time.monotonic() > deadline):
+                process.kill()
+                raise RuntimeError("mechoscore did not start")
+            time.sleep(0.05)
+
+def _connected_subscribers(publisher):
+    '''
+    Get the number of subscribers connected to a publisher.
+    '''
+    return(len(publisher.send_queues) + len(publisher.subscriber_udp_connections) + \
+            len(publisher.subscriber_shm_connections) + len(publisher.subscriber_multicast_connections) + \
+            len(publisher.local_subscribers))
+
+def _subscriber_process(run, index, mechoscore_port, ready, done, results):
+    '''
+    SUBSCRIBER PROCESS
+
+    Receive the messages of a run and report the latency of each of them.
+
+    Parameters:
+        run: The dictionary of the configuration of the run.
+        index: The index of the subscriber in the run.
+        mechoscore_port: The port of mechoscore.
+        ready: Semaphore released once the subscriber is registered.
+        done: Event set once the publisher is done publishing.
+        results: Queue to put the results of the subscriber in.
+    '''
+    #Only the JSON report goes to stdout.
+    sys.stdout = sys.stderr
+
+    node = mechos.Node("benchmark_%d_sub_%d" % (run["run"], index), mechoscore_port=mechoscore_port)
+    latencies = array.array('d')
+    receive_times = []
+
+    def callback(message):
+        now = time.perf_counter()
+        latencies.append(now - message[1])
+        if(not receive_times):
+            receive_times.append(now)
+
+    node.create_subscriber(run["topic"], Stamped_Message(message_format(run["message"])[0]), callback,
+                            queue_size=run["queue_size"], protocol=run["protocol"])
+    ready.release()
+
+    drain_deadline = None
+    while(len(latencies) < run["count"]):
+        node.spin_once(0.05)
+        if(done.is_set()):
+            if(drain_deadline is None):
+                drain_deadline = time.perf_counter() + DRAIN_TIME
+            elif(time.perf_counter() > drain_deadline):
+                break
+
+    last_receive = time.perf_counter() if(drain_deadline is None) else None
+    results.put(("subscriber", index, latencies.tobytes(), receive_times[0] if(receive_times) else None,
+                    last_receive))
+
+def _publisher_process(run, mechoscore_port, done, finished, results):
+    '''
+    PUBLISHER PROCESS
+
+    Publish the messages of a run at the rate of the run once every subscriber
+    is connected.
+
+    Parameters:
+        run: The dictionary of the configuration of the run.
+        mechoscore_port: The port of mechoscore.
+        done: Event to set once every message is published.
+        finished: Event set once the subscribers reported, the publisher exits then.
+        results: Queue to put the results of the publisher in.
+    '''
+    sys.stdout = sys.stderr
+
+    node = mechos.Node("benchmark_%d_pub" % run["run"], mechoscore_port=mechoscore_port)
+    message_format_object, payload = message_format(run["message"])
+    publisher = node.create_publisher(run["topic"], Stamped_Message(message_format_object),
+                                    queue_size=run["queue_size"], protocol=run["protocol"])
+
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while(_connected_subscribers(publisher) < run["subscribers"] and time.monotonic() < deadline):
+        time.sleep(0.01)
+
+    #Let the subscribers finish watching their new sockets.
+    time.sleep(0.2)
+
+    interval = 1.0/run["rate"] if(run["rate"]) else 0.0
+    start = time.perf_counter()
+    for sequence in range(run["count"]):
+        if(interval):
+            delay = start + sequence*interval - time.perf_counter()
+            if(delay > 0):
+                time.sleep(delay)
+        publisher.publish((sequence, time.perf_counter(), payload))
+    end = time.perf_counter()
+
+    #Wait for the writer thread to hand the tcp messages to the sockets.
+    while(any(send_queue.pending() for send_queue in list(publisher.send_queues.values())) and \
+            time.perf_counter() < end + CONNECT_TIMEOUT):
+        time.sleep(0.01)
+
+    results.put(("publisher", run["count"], start, end))
+    done.set()
+    finished.wait(CONNECT_TIMEOUT)
+
+def _percentile(values, fraction):
+    '''
+    Get a percentile of a sorted list, None if it is empty.
+    '''
+    if(not values):
+        return None
+    return(values[min(len(values) - 1, int(round(fraction*(len(values) - 1))))])
+
+def run_once(run, mechoscore_port, context):
+    '''
+    Run one configuration of the sweep.
+
+    Parameters:
+        run: The dictionary of the configuration of the run.
+        mechoscore_port: The port of mechoscore.
+        context: The multiprocessing context to spawn the processes with.
+    Returns:
+        result: The dictionary of the measurements of the run.
+    '''
+    ready = context.Semaphore(0)
+    done = context.Event()
+    finished = context.Event()
+    results = context.Queue()
+
+    subscribers = [context.Process(target=_subscriber_process,
+                                    args=(run, index, mechoscore_port, ready, done, results))
+                    for index in range(run["subscribers"])]
+    for process in subscribers:
+        process.start()
+    for process in subscribers:
+        if(not ready.acquire(timeout=CONNECT_TIMEOUT)):
+            raise RuntimeError("A subscriber did not start")
+
+    publisher = context.Process(target=_publisher_process, args=(run, mechoscore_port, done, finished, results))
+    publisher.start()
+
+    latencies = array.array('d')
+    first_receive = None
+    last_receive = None
+    sent, start, end = 0, None, None
+    for _ in range(run["subscribers"] + 1):
+        report = results.get(timeout=CONNECT_TIMEOUT + run["count"]*max(1.0/run["rate"] if(run["rate"]) else 0, 0.01))
+        if(report[0] == "publisher"):
+            _, sent, start, end = report
+            continue
+
+        _, _, subscriber_latencies, subscriber_first, subscriber_last = report
+        latencies.frombytes(subscriber_latencies)
+        if(subscriber_first is not None):
+            first_receive = subscriber_first if(first_receive is None) else min(first_receive, subscriber_first)
+        if(subscriber_last is not None):
+            last_receive = subscriber_last if(last_receive is None) else max(last_receive, subscriber_last)
+
+    finished.set()
+    for process in subscribers + [publisher]:
+        process.join(CONNECT_TIMEOUT)
+
+    #Subscribers that had to wait for dropped messages stopped receiving when the
+    #publisher was done, otherwise when they had every message.
+    if(end is not None and (last_receive is None or len(latencies) < sent*run["subscribers"])):
+        last_receive = max(last_receive or end, end)
+
+    received = len(latencies)
+    duration = (last_receive - start) if(start is not None and last_receive is not None) else None
+    message_size = STAMP_HEADER.size + message_format(run["message"])[0].size
+    msgs_per_s = received/duration if(duration) else 0.0
+    sorted_latencies = sorted(latencies)
+
+    return({"protocol": run["protocol"],
+            "message": run["message"],
+            "message_size": message_size,
+            "rate": run["rate"],
+            "subscribers": run["subscribers"],
+            "sent": sent,
+            "received": received,
+            "publish_msgs_per_s": sent/(end - start) if(end is not None and end > start) else 0.0,
+            "msgs_per_s": msgs_per_s,
+            "mb_per_s": msgs_per_s*message_size/1e6,
+            "latency_us": {"p50": _percentile(sorted_latencies, 0.5) and 1e6*_percentile(sorted_latencies, 0.5),
+                           "p99": _percentile(sorted_latencies, 0.99) and 1e6*_percentile(sorted_latencies, 0.99),
+                           "max": sorted_latencies[-1]*1e6 if(sorted_latencies) else None},
+            "drop_rate": 1.0 - received/(sent*run["subscribers"]) if(sent) else 1.0})
+
+def run_sweep(protocols, messages, rates, subscriber_counts, count, queue_size=1000):
+    '''
+    Run every combination of protocol, message format, rate and number of
+    subscribers against a local mechoscore.
+
+    Parameters:
+        protocols: The list of protocols, e.g. ["tcp", "udp"].
+        messages: The list of message format names, e.g. ["Bool", "Float_Array(1000)"].
+        rates: The list of publish rates in messages per second, 0 publishes as
+                fast as possible.
+        subscriber_counts: The list of numbers of subscribers.
+        count: The number of messages published in each run.
+        queue_size: Default 1000. The queue size of the publishers and subscribers.
+    Returns:
+        report: The dictionary of the environment and the results of every run.
+    '''
+    context = multiprocessing.get_context("spawn")
+    mechoscore, mechoscore_port = start_mechoscore()
+    results = []
+    try:
+        for run_index, (protocol, message, rate, subscribers) in \
+                enumerate(itertools.product(protocols, messages, rates, subscriber_counts)):
+            run = {"run": run_index, "topic": "benchmark_%d" % run_index, "protocol": protocol,
+                   "message": message, "rate": rate, "subscribers": subscribers, "count": count,
+                   "queue_size": queue_size}
+            result = run_once(run, mechoscore_port, context)
+            results.append(result)
+            print("%-14s %-20s %8s %4d subs %10.0f msgs/s %9.2f MB/s  p50 %8s us  drop %.3f" % \
+                    (protocol, message, rate or "max", subscribers, result["msgs_per_s"], result["mb_per_s"],
+                    "%.0f" % result["latency_us"]["p50"] if(result["latency_us"]["p50"] is not None) else "-",
+                    result["drop_rate"]), file=sys.stderr)
+    finally:
+        mechoscore.terminate()
+        mechoscore.wait()
+
+    return({"environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpu_count": multiprocessing.cpu_count()},
+            "count": count,
+            "results": results})
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--protocols", default="tcp,udp",
+            help='''Comma separated protocols to run.''', type=str)
+    parser.add_argument("--messages", default="Bool,Float_Array(1000),Float_Array(100000)",
+            help='''Comma separated message formats: Bool, Int or Float_Array(N).''', type=str)
+    parser.add_argument("--rates", default="0",
+            help='''Comma separated publish rates in messages per second, 0 for as fast as possible.''', type=str)
+    parser.add_argument("--subscribers", default="1,4",
+            help='''Comma separated numbers of subscribers.''', type=str)
+    parser.add_argument("--count", default=1000,
+            help='''The number of messages published in each run.''', type=int)
+    parser.add_argument("--queue_size", default=1000,
+            help='''The queue size of the publishers and subscribers.''', type=int)
+    parser.add_argument("--output", default=None,
+            help='''The file to write the JSON report to. Default is stdout.''', type=str)
+    args = parser.parse_args()
+
+    #Commas inside the parentheses of a message format don't split it.
+    messages = re.findall(r"[^,()]+(?:\([^)]*\))?", args.messages)
+
+    report = run_sweep(args.protocols.split(','), [message.strip() for message in messages],
+                        [float(rate) for rate in args.rates.split(',')],
+                        [int(subscribers) for subscribers in args.subscribers.split(',')],
+                        args.count, args.queue_size)
+
+    if(args.output is None):
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
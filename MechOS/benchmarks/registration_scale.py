@@ -0,0 +1,91 @@
+'''
+Description: Measures how long mechoscore takes to register publishers and
+             subscribers as the node graph grows. The nodes are simulated inside
+             this process so only the cost of mechoscore matching endpoints is
+             measured, not the network. With the topic index the time per
+             registration should stay flat as the graph grows.
+
+             Run with: python -m MechOS.benchmarks.registration_scale
+'''
+import io
+import sys
+import time
+import argparse
+import contextlib
+import socket
+from MechOS.mechoscore import Mechoscore
+
+class Simulated_Node_Client:
+    '''
+    Stands in for the xmlrpc client to a node and answers every call from
+    mechoscore right away.
+    '''
+    def __getattr__(self, name):
+        return lambda *args: True
+
+def get_free_port():
+    '''
+    Get a free port on the local host.
+    '''
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return(s.getsockname()[1])
+
+def run(num_nodes, step, topics_per_node):
+    '''
+    Register num_nodes simulated nodes, each with topics_per_node publishers on
+    topics of its own and one subscriber to the topic of the previous node.
+
+    Parameters:
+        num_nodes: The number of nodes to register.
+        step: The number of nodes between each timing report.
+        topics_per_node: The number of publishers each node registers.
+    Returns:
+        results: A list of (number of endpoints, microseconds per registration).
+    '''
+    mechoscore = Mechoscore(ip="127.0.0.1", core_port=get_free_port(), param_server_port=get_free_port())
+    results = []
+
+    print("%10s %12s %22s" % ("nodes", "endpoints", "us per registration"))
+    #Mechoscore prints every registration, only the report is shown.
+    report = sys.stdout
+    start = time.perf_counter()
+    registrations = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for node_index in range(num_nodes):
+            name = "node_%d" % node_index
+            mechoscore.register_node(name, 0, "127.0.0.1", 0)
+            mechoscore.xmlrpc_clients_to_nodes[name] = Simulated_Node_Client()
+
+            for topic_index in range(topics_per_node):
+                mechoscore.register_publisher(name, "%s_pub_%d" % (name, topic_index),
+                                    "topic_%d_%d" % (node_index, topic_index), "127.0.0.1", 0, "tcp")
+            mechoscore.register_subscriber(name, "%s_sub" % name,
+                                    "topic_%d_0" % max(node_index - 1, 0), "127.0.0.1", 0, "tcp")
+            registrations += topics_per_node + 2
+
+            if((node_index + 1) % step == 0):
+                elapsed = time.perf_counter() - start
+                endpoints = (node_index + 1)*(topics_per_node + 1)
+                results.append((endpoints, 1e6*elapsed/registrations))
+                print("%10d %12d %22.1f" % (node_index + 1, endpoints, 1e6*elapsed/registrations),
+                        file=report)
+                start = time.perf_counter()
+                registrations = 0
+
+    #The simulated nodes don't need to be unregistered at exit.
+    mechoscore.node_information.clear()
+    mechoscore.xmlrpc_server.server_close()
+    mechoscore.param_server.server.server_close()
+    return(results)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", default=2000, help='''The number of nodes to register.''', type=int)
+    parser.add_argument("--step", default=250, help='''Report the timing every step nodes.''', type=int)
+    parser.add_argument("--topics_per_node", default=4,
+            help='''The number of publishers each node registers.''', type=int)
+    args = parser.parse_args()
+
+    run(args.nodes, args.step, args.topics_per_node)
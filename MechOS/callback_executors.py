@@ -0,0 +1,283 @@
+'''
+Description: callback_executors contains the executors that run the callbacks of
+             the subscribers of a node.
+
+             Single_Threaded_Executor calls each callback in the thread spinning the
+             node, one message at a time. Thread_Pool_Executor runs the callbacks in
+             a pool of threads so a slow callback does not hold up the other
+             subscribers. Process_Pool_Executor runs them in a pool of processes for
+             CPU-bound callbacks, handing over the packed message so it is only
+             unpacked once, in the process running the callback.
+
+             Which callbacks may run at the same time is controlled by callback
+             groups. The callbacks of a mutually exclusive group run one at a time
+             in the order the messages arrived, which is the default for each
+             subscriber. The callbacks of a reentrant group may run at the same time.
+
+             Example:
+                node = mechos.Node("vision", executor=Thread_Pool_Executor(4))
+                cameras = Callback_Group()
+                node.create_subscriber("left_image", Image, process_image, callback_group=cameras)
+                node.create_subscriber("right_image", Image, process_image, callback_group=cameras)
+'''
+import time
+import threading
+import functools
+import collections
+import concurrent.futures
+
+#Number of messages of a mutually exclusive group a worker runs before letting
+#the other groups have the worker.
+DRAIN_LIMIT = 64
+
+class Callback_Group:
+    '''
+    A Callback_Group holds the messages waiting for the callbacks of one or more
+    subscribers. The callbacks of a mutually exclusive group run one at a time,
+    in order. The callbacks of a reentrant group may run at the same time.
+    '''
+    def __init__(self, reentrant=False, queue_size=1000):
+        '''
+        Parameters:
+            reentrant: Default False. If True, the callbacks of the group may run at
+                        the same time and in any order.
+            queue_size: Default 1000. The number of messages of a mutually exclusive
+                        group that may wait for a worker. The oldest waiting message
+                        is dropped once there are more, and counted in the drops
+                        of its subscriber.
+        '''
+        self.reentrant = reentrant
+        self.lock = threading.Lock()
+
+        #The (function, args, stats) of each message waiting, stats being the
+        #Topic_Stats of its subscriber. A group may be shared by subscribers.
+        self.pending = collections.deque(maxlen=queue_size)
+
+        #True while a worker is running the callbacks of the group.
+        self.running = False
+
+def _call_encoded(callback, message_format, message_encoded):
+    '''
+    PROCESS POOL
+
+    Unpack a message and pass it to a callback.
+
+    Parameters:
+        callback: The callback of the subscriber.
+        message_format: The message format of the subscriber.
+        message_encoded: The bytes of the packed message.
+    Returns:
+        N/A
+    '''
+    callback(message_format._unpack(message_encoded))
+
+def _timed(function, stats):
+    '''
+    Wrap a callback so the number of times it runs and the time it takes are
+    added to the counters of its subscriber.
+
+    Parameters:
+        function: The callback to wrap.
+        stats: The Topic_Stats of the subscriber, or None to leave it unwrapped.
+    Returns:
+        function: The wrapped callback.
+    '''
+    if(stats is None):
+        return function
+
+    @functools.wraps(function)
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            stats.callbacks += 1
+            stats.callback_time += time.perf_counter() - start
+    return timed
+
+class Single_Threaded_Executor:
+    '''
+    Calls each callback in the thread spinning the node as soon as its message
+    is received. This is the default executor of a node.
+    '''
+    def dispatcher(self, callback, callback_group, stats=None):
+        '''
+        Get the function a subscriber passes its unpacked messages to.
+
+        Parameters:
+            callback: The callback of the subscriber.
+            callback_group: The Callback_Group of the subscriber.
+            stats: Default None. The Topic_Stats of the subscriber the time spent
+                    in the callback is added to.
+        Returns:
+            dispatch: A function of one message that runs the callback with it.
+        '''
+        return _timed(callback, stats)
+
+    def encoded_dispatcher(self, callback, callback_group, message_format, stats=None):
+        '''
+        Get the function a subscriber passes its packed messages to, if the
+        executor takes packed messages.
+
+        Parameters:
+            callback: The callback of the subscriber.
+            callback_group: The Callback_Group of the subscriber.
+            message_format: The message format of the subscriber.
+            stats: Default None. The Topic_Stats of the subscriber the time spent
+                    in the callback is added to.
+        Returns:
+            dispatch: A function of one packed message, or None if the subscriber
+                    should unpack its messages itself.
+        '''
+        return None
+
+    def shutdown(self, wait=True):
+        '''
+        Release the workers of the executor.
+
+        Parameters:
+            wait: Default True. Wait for the callbacks running to finish.
+        Returns:
+            N/A
+        '''
+        pass
+
+class Thread_Pool_Executor(Single_Threaded_Executor):
+    '''
+    Runs the callbacks in a pool of threads. The callbacks of each mutually
+    exclusive group run one at a time and in order, so the messages of a
+    subscriber are never handled out of order unless its group is reentrant.
+    '''
+    def __init__(self, workers=4):
+        '''
+        Parameters:
+            workers: Default 4. The number of threads running callbacks.
+        '''
+        self.workers = workers
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def dispatcher(self, callback, callback_group, stats=None):
+        callback = _timed(callback, stats)
+        return(lambda message: self.submit(callback_group, callback, message, stats=stats))
+
+    def submit(self, callback_group, function, *args, stats=None):
+        '''
+        Run a function in the pool under a callback group.
+
+        Parameters:
+            callback_group: The Callback_Group to run the function under.
+            function: The function to run.
+            args: The arguments of the function.
+            stats: Default None. The Topic_Stats of the subscriber the function
+                    is run for, counting a drop if the message is dropped from
+                    the group.
+        Returns:
+            N/A
+        '''
+        if(callback_group.reentrant):
+            self.pool.submit(self._run, function, args)
+            return
+
+        with callback_group.lock:
+            pending = callback_group.pending
+            if(len(pending) == pending.maxlen):
+                dropped_stats = pending[0][2]
+                if(dropped_stats is not None):
+                    dropped_stats.drops += 1
+            pending.append((function, args, stats))
+            if(callback_group.running):
+                return
+            callback_group.running = True
+        self.pool.submit(self._drain, callback_group)
+
+    def _drain(self, callback_group):
+        '''
+        WORKER THREAD
+
+        Run the functions waiting in a mutually exclusive group one at a time.
+
+        Parameters:
+            callback_group: The Callback_Group to run the functions of.
+        Returns:
+            N/A
+        '''
+        for _ in range(DRAIN_LIMIT):
+            with callback_group.lock:
+                if(not callback_group.pending):
+                    callback_group.running = False
+                    return
+                function, args, stats = callback_group.pending.popleft()
+            self._run(function, args)
+
+        #Give the worker to the other groups and continue later.
+        self.pool.submit(self._drain, callback_group)
+
+    def _run(self, function, args):
+        '''
+        WORKER THREAD
+
+        Run a function, reporting the exceptions it raises.
+
+        Parameters:
+            function: The function to run.
+            args: The arguments of the function.
+        Returns:
+            N/A
+        '''
+        try:
+            function(*args)
+        except Exception as e:
+            print("[ERROR]: Callback %s raised %s: %s" % (getattr(function, "__name__", function),
+                                                        type(e).__name__, e))
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+class Process_Pool_Executor(Thread_Pool_Executor):
+    '''
+    Runs the callbacks in a pool of processes, for callbacks that are CPU-bound.
+    The packed message is sent to the process running the callback and unpacked
+    there, so a message is never unpacked and then pickled again. The callbacks
+    must be picklable, i.e. functions defined at the top level of a module, and
+    only their side effects outside the node are kept. Callback groups are
+    applied the same way as for a Thread_Pool_Executor.
+    '''
+    def __init__(self, workers=4):
+        '''
+        Parameters:
+            workers: Default 4. The number of processes running callbacks.
+        '''
+        Thread_Pool_Executor.__init__(self, workers)
+        self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def dispatcher(self, callback, callback_group, stats=None):
+        #Messages delivered by publishers of the same node are already unpacked.
+        #The callback time counted includes handing the message to the process.
+        call_process = _timed(self._call_process, stats)
+        return(lambda message: self.submit(callback_group, call_process, callback, message, stats=stats))
+
+    def encoded_dispatcher(self, callback, callback_group, message_format, stats=None):
+        #The packed message may be a view of a receive buffer that is reused.
+        call_process = _timed(self._call_process, stats)
+        return(lambda message_encoded: self.submit(callback_group, call_process, _call_encoded,
+                                                callback, message_format, bytes(message_encoded),
+                                                stats=stats))
+
+    def _call_process(self, function, *args):
+        '''
+        WORKER THREAD
+
+        Run a function in the process pool and wait for it to finish, so the
+        callback groups hold for the processes as well.
+
+        Parameters:
+            function: The picklable function to run.
+            args: The picklable arguments of the function.
+        Returns:
+            N/A
+        '''
+        self.process_pool.submit(function, *args).result()
+
+    def shutdown(self, wait=True):
+        Thread_Pool_Executor.shutdown(self, wait)
+        self.process_pool.shutdown(wait=wait)
@@ -0,0 +1,377 @@
+'''
+Description: control_plane contains the servers and clients that mechoscore, nodes
+             and the parameter server use to make calls to each other.
+'''
+import queue
+import socket
+import socketserver
+import struct
+import json
+import threading
+import time
+import concurrent.futures
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer
+
+#Header of a control message: number of bytes of the json payload and the id of
+#the request, which the response carries back so requests can be pipelined.
+CONTROL_HEADER = struct.Struct('!II')
+
+#Largest control message payload accepted, in bytes.
+MAX_CONTROL_MESSAGE_SIZE = 16777216
+
+class Threaded_XMLRPC_Server(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    '''
+    An xmlrpc server that handles each request in its own thread, so one slow
+    request does not hold up the others.
+    '''
+    daemon_threads = True
+
+    #Nodes starting at the same time all register at once, which overflows the
+    #default listen backlog of 5 and resets their connections.
+    request_queue_size = 128
+
+class Timeout_Transport(xmlrpc.client.Transport):
+    '''
+    An xmlrpc transport whose connections give up after a timeout instead of
+    waiting forever on a server that stopped answering.
+    '''
+    def __init__(self, timeout):
+        '''
+        Parameters:
+            timeout: The number of seconds to wait on a connection before giving up.
+        '''
+        xmlrpc.client.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpc.client.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+class Pooled_XMLRPC_Client:
+    '''
+    A thread-safe xmlrpc client. An xmlrpc.client.ServerProxy can only be used by
+    one thread at a time, so each call takes a proxy from a pool (creating one if
+    none are free) and puts it back afterwards. Calls are made the same way as
+    with a ServerProxy, e.g. client.register_node(...).
+    '''
+    def __init__(self, url, timeout=None):
+        '''
+        Parameters:
+            url: The url of the xmlrpc server, e.g. "http://127.0.0.1:5959".
+            timeout: Default None. The number of seconds a call may take before
+                    it fails with socket.timeout. None waits forever.
+        '''
+        self.url = url
+        self.timeout = timeout
+        self.proxies = queue.LifoQueue()
+
+    def _call(self, name, *args):
+        '''
+        Call a function registered with the xmlrpc server.
+
+        Parameters:
+            name: The name of the function.
+            args: The arguments of the function.
+        Returns:
+            result: The value returned by the function.
+        '''
+        try:
+            proxy = self.proxies.get_nowait()
+        except queue.Empty:
+            if(self.timeout is None):
+                proxy = xmlrpc.client.ServerProxy(self.url)
+            else:
+                proxy = xmlrpc.client.ServerProxy(self.url, transport=Timeout_Transport(self.timeout))
+
+        try:
+            result = getattr(proxy, name)(*args)
+        except Exception:
+            #The connection of a failed proxy may be in a bad state.
+            proxy("close")()
+            raise
+        self.proxies.put(proxy)
+        return result
+
+    def __getattr__(self, name):
+        if(name.startswith("__")):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, *args)
+
+def _encode_control_message(request_id, value):
+    '''
+    Frame a control message.
+
+    Parameters:
+        request_id: The id of the request.
+        value: The json serializable request or response.
+    Returns:
+        frame: The bytes of the header followed by the payload.
+    '''
+    payload = json.dumps(value, separators=(',', ':')).encode()
+    return(CONTROL_HEADER.pack(len(payload), request_id) + payload)
+
+def _receive_control_message(sock):
+    '''
+    Read one control message from a blocking socket.
+
+    Parameters:
+        sock: The connected socket.
+    Returns:
+        request_id: The id of the request.
+        value: The decoded request or response.
+    '''
+    length, request_id = CONTROL_HEADER.unpack(_receive_exactly(sock, CONTROL_HEADER.size))
+    if(length > MAX_CONTROL_MESSAGE_SIZE):
+        raise ValueError("Control message of %d bytes is too large" % length)
+    return(request_id, json.loads(_receive_exactly(sock, length)))
+
+def _receive_exactly(sock, size):
+    '''
+    Read exactly size bytes from a blocking socket. Timeouts of the socket are
+    waited through, since giving up in the middle of a message would lose the
+    start of the next one.
+
+    Parameters:
+        sock: The connected socket.
+        size: The number of bytes to read.
+    Returns:
+        data: The bytes read.
+    '''
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while(received < size):
+        try:
+            num_bytes = sock.recv_into(view[received:])
+        except socket.timeout:
+            continue
+        if(num_bytes == 0):
+            raise ConnectionError("Control connection closed")
+        received += num_bytes
+    return(data)
+
+class Control_Request_Handler(socketserver.BaseRequestHandler):
+    '''
+    Handles the requests of one persistent control connection in order until the
+    client disconnects.
+    '''
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while(1):
+            try:
+                request_id, (name, args) = _receive_control_message(self.request)
+            except (OSError, ValueError, TypeError):
+                return
+            response = self.server._dispatch(name, args)
+            try:
+                self.request.sendall(_encode_control_message(request_id, response))
+            except OSError:
+                return
+
+class Control_Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    A server for the same functions as an xmlrpc server, reached over persistent
+    tcp connections carrying length-prefixed json messages instead of a new http
+    request with xml for every call. Each connection is handled in its own thread.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        '''
+        Parameters:
+            address: The (ip, port) to host the server on. Port 0 picks a free port.
+        '''
+        socketserver.TCPServer.__init__(self, address, Control_Request_Handler)
+        self.functions = {}
+
+    def register_function(self, function, name=None):
+        '''
+        Allow clients to call a function, the same as SimpleXMLRPCServer.register_function.
+
+        Parameters:
+            function: The function to call.
+            name: Default None. The name clients call it by, the function name if None.
+        Returns:
+            function: The function registered.
+        '''
+        self.functions[function.__name__ if name is None else name] = function
+        return function
+
+    def _dispatch(self, name, args):
+        '''
+        Call a registered function.
+
+        Parameters:
+            name: The name of the function.
+            args: The list of arguments of the function.
+        Returns:
+            response: [True, result] or [False, error message].
+        '''
+        if(name not in self.functions):
+            return([False, 'method "%s" is not supported' % name])
+        try:
+            return([True, self.functions[name](*args)])
+        except Exception as error:
+            return([False, "%s: %s" % (type(error).__name__, error)])
+
+class Control_Client:
+    '''
+    A thread-safe client of a Control_Server. Every call goes over one persistent
+    connection, and calls from several threads are pipelined on it: a call is sent
+    without waiting for the responses of earlier calls. Calls are made the same way
+    as with an xmlrpc.client.ServerProxy, e.g. client.register_node(...), and errors
+    raised by the function on the server are raised as xmlrpc.client.Fault.
+    '''
+    def __init__(self, address, timeout=None):
+        '''
+        Parameters:
+            address: The (ip, port) of the control server.
+            timeout: Default None. The number of seconds a call may take before
+                    it fails with socket.timeout, which is also how long sending
+                    a call may block before the connection is closed. None waits
+                    forever.
+        '''
+        self.address = tuple(address)
+        self.timeout = timeout
+
+        #Guards the connection, the request ids and the calls waiting on a response.
+        self.lock = threading.RLock()
+        self.sock = None
+        self.request_id = 0
+        self.pending = {}
+
+    def _connect(self):
+        '''
+        Open the connection to the server and start the thread reading responses.
+        Called with the lock held.
+        '''
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        #A send blocked for longer than the timeout closes the connection. The
+        #response thread waits through the timeouts of its reads.
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        threading.Thread(target=self._receive_responses, args=[sock], daemon=True).start()
+
+    def _disconnect(self, sock, error):
+        '''
+        Close a connection and fail every call still waiting on it.
+
+        Parameters:
+            sock: The connection to close.
+            error: The reason the connection is closed.
+        '''
+        with self.lock:
+            pending = {}
+            if(self.sock is sock):
+                self.sock = None
+                pending, self.pending = self.pending, {}
+        sock.close()
+        for future in pending.values():
+            future.set_exception(ConnectionError("Control connection to %s:%d lost: %s" % \
+                                            (self.address[0], self.address[1], error)))
+
+    def _receive_responses(self, sock):
+        '''
+        Thread reading the responses from a connection and handing them to the
+        calls waiting on them.
+
+        Parameters:
+            sock: The connection to read from.
+        '''
+        try:
+            while(1):
+                request_id, (success, result) = _receive_control_message(sock)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+
+                #The call may already have timed out.
+                if(future is None):
+                    continue
+                if(success):
+                    future.set_result(result)
+                else:
+                    future.set_exception(xmlrpc.client.Fault(1, result))
+        except (OSError, ValueError, TypeError) as error:
+            self._disconnect(sock, error)
+
+    def call_async(self, name, *args):
+        '''
+        Send a call without waiting for its response.
+
+        Parameters:
+            name: The name of the function.
+            args: The arguments of the function.
+        Returns:
+            future: A concurrent.futures.Future of the value returned by the function.
+        '''
+        future = concurrent.futures.Future()
+        with self.lock:
+            if(self.sock is None):
+                self._connect()
+            sock = self.sock
+            self.request_id = (self.request_id + 1) & 0xffffffff
+            request_id = self.request_id
+            future.send_time = time.monotonic()
+            self.pending[request_id] = future
+            try:
+                sock.sendall(_encode_control_message(request_id, [name, args]))
+            except OSError as error:
+                self._disconnect(sock, error)
+                raise
+        future.request_id = request_id
+        return future
+
+    def _call(self, name, *args):
+        '''
+        Call a function registered with the control server.
+
+        Parameters:
+            name: The name of the function.
+            args: The arguments of the function.
+        Returns:
+            result: The value returned by the function.
+        '''
+        future = self.call_async(name, *args)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                self.pending.pop(future.request_id, None)
+            raise socket.timeout("Control call %s timed out" % name)
+
+    def expire_calls(self, timeout):
+        '''
+        Fail the calls that have waited on a response for longer than timeout, so
+        a server that stopped answering does not keep their futures forever.
+
+        Parameters:
+            timeout: The number of seconds a call may wait on its response.
+        Returns:
+            N/A
+        '''
+        now = time.monotonic()
+        with self.lock:
+            expired = [request_id for request_id, future in self.pending.items() \
+                            if now - future.send_time > timeout]
+            futures = [self.pending.pop(request_id) for request_id in expired]
+        for future in futures:
+            future.set_exception(socket.timeout("Control call to %s:%d timed out" % self.address))
+
+    def close(self):
+        '''
+        Close the connection to the server. The next call reconnects.
+        '''
+        with self.lock:
+            sock = self.sock
+        if(sock is not None):
+            self._disconnect(sock, "closed by client")
+
+    def __getattr__(self, name):
+        if(name.startswith("__")):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, *args)
@@ -26,7 +26,8 @@ def talker():
     #template.
 
     #The protocol is the socket protocol to send messages over. This can either
-    #be tcp or udp.
+    #be tcp or udp. Nodes running on the same computer can also use shm, which
+    #passes messages through shared memory instead of sockets.
     pub = talker_node.create_publisher("chatter", Float_Array(4), protocol="tcp")
 
     #Some random message to send (4 floats)
@@ -35,9 +35,9 @@ def listener():
     while(1):
 
         #Spin once will check ALL the subscriber registered to this node
-        #to see if they have messages.
-        listener_node.spin_once()
-        time.sleep(0.01)
+        #to see if they have messages. It waits up to the timeout and
+        #returns as soon as a message arrives.
+        listener_node.spin_once(timeout=0.01)
 
 
 if __name__ == "__main__":
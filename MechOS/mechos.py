@@ -5,9 +5,11 @@ Description: mechos contains all the primary code for making nodes,
              publisher, and subcribers to make a mechos node network.
 '''
 import socket
+import selectors
 import threading
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
+from MechOS.control_plane import Threaded_XMLRPC_Server, Control_Server, Control_Client
 import xmlrpc.client
 import uuid
 import os
@@ -17,7 +19,472 @@ import signal
 import io
 import math
 import sys
+import struct
+import copy
+import collections
+import asyncio
+import concurrent.futures
+import functools
+from MechOS.shared_memory_ring import Shared_Memory_Ring, ring_name
+from MechOS.parameter_store import normalize_parameter
+from MechOS.callback_executors import Single_Threaded_Executor, Callback_Group
+from MechOS.topic_stats import Topic_Stats
+
+#Every tcp and udp message is sent as a frame made of this header followed by
+#the packed message. The header holds the length of the packed message in bytes
+#and the sequence number of the message from its publisher. A udp datagram holds
+#one or more frames.
+FRAME_HEADER = struct.Struct('!II')
+
+#Largest number of bytes of a udp datagram, so a datagram fits in one ethernet
+#frame. Several small messages are packed into one datagram up to this size and
+#larger messages are split into fragments of this size.
+UDP_BATCH_SIZE = 1472
+
+#Set in the length of a frame header when the frame holds a fragment of a message.
+#The frame header is then followed by the fragment header, which holds the length
+#of the whole message and the offset of the fragment in it. The fragments of a
+#message have the sequence number of the message.
+FRAGMENT_FLAG = 0x80000000
+FRAGMENT_HEADER = struct.Struct('!II')
+
+#Number of bytes of a message in each fragment.
+UDP_FRAGMENT_SIZE = UDP_BATCH_SIZE - FRAME_HEADER.size - FRAGMENT_HEADER.size
+
+#Number of messages a udp subscriber reassembles at once, and the seconds it
+#waits for the missing fragments of a message before dropping it.
+MAX_PARTIAL_MESSAGES = 8
+FRAGMENT_TIMEOUT = 1.0
+
+#Largest number of buffers handed to one sendmsg call.
+MAX_SEND_BUFFERS = 512
+
+#sendmsg sends several buffers in one call without joining them first. It is
+#missing on some platforms, e.g. Windows.
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+#Largest receive buffer preallocated for a tcp connection. Frames larger than
+#this still get received since the buffer grows to fit them.
+MAX_FRAME_BUFFER_SIZE = 1048576
+
+#The first bytes a tcp subscriber sends after connecting: its unique id.
+TCP_HANDSHAKE = struct.Struct('!16s')
+
+#Seconds a tcp publisher waits for a subscriber to send its id.
+TCP_HANDSHAKE_TIMEOUT = 5.0
+
+#Largest number of bytes of shared memory the ring buffer of a shm publisher
+#takes. Publishers of large messages keep fewer than queue_size of them.
+SHM_MAX_RING_SIZE = 67108864
+
+class Frame_Receiver:
+    '''
+    A Frame_Receiver reassembles the frames sent over one tcp connection. Data is
+    read with recv_into into a preallocated buffer and every complete frame in it
+    is handed back in one pass, so a backlog of messages is cleared in a single
+    spin and a short read never desynchronizes the stream.
+    '''
+    def __init__(self, buffer_size):
+        '''
+        Initialize the reusable receive buffer.
+
+        Parameters:
+            buffer_size: The starting number of bytes of the receive buffer. The
+                        buffer grows if a single frame does not fit.
+        Returns:
+            N/A
+        '''
+        self.buffer = bytearray(max(buffer_size, FRAME_HEADER.size))
+        self.view = memoryview(self.buffer)
+
+        #Number of valid bytes at the start of the buffer.
+        self.length = 0
+
+        #Sequence number of the last frame received.
+        self.last_sequence = None
+
+    def free_space(self):
+        '''
+        Get the number of bytes that can be received before the buffer is full.
+
+        Parameters:
+            N/A
+        Returns:
+            free_space: The number of free bytes at the end of the buffer.
+        '''
+        return(len(self.buffer) - self.length)
+
+    def receive(self, sub_socket):
+        '''
+        Read the bytes waiting on the socket into the free space of the buffer.
+
+        Parameters:
+            sub_socket: The non-blocking tcp socket to read from.
+        Returns:
+            num_bytes: The number of bytes read, 0 if the other end closed the
+                        connection or None if nothing was waiting.
+        '''
+        #A full buffer would make recv_into look like a closed connection.
+        if(self.length == len(self.buffer)):
+            self._grow(2*len(self.buffer))
+
+        try:
+            num_bytes = sub_socket.recv_into(self.view[self.length:])
+        except (BlockingIOError, InterruptedError):
+            return None
+        except socket.error as e:
+            return 0
+
+        self.length += num_bytes
+        return num_bytes
+
+    def frames(self):
+        '''
+        Iterate over every complete frame that is in the buffer. Incomplete data
+        stays in the buffer until the rest of it is received.
+
+        Parameters:
+            N/A
+        Returns:
+            frames: A generator of memoryviews of the payload of each complete
+                    frame. Each memoryview is only valid until the next one is
+                    requested.
+        '''
+        position = 0
+        frame_size = 0
+        try:
+            while(self.length - position >= FRAME_HEADER.size):
+                payload_length, sequence = FRAME_HEADER.unpack_from(self.buffer, position)
+                frame_size = FRAME_HEADER.size + payload_length
+
+                if(position + frame_size > self.length):
+                    break
+
+                self.last_sequence = sequence
+                payload = self.view[position + FRAME_HEADER.size:position + frame_size]
+                position += frame_size
+                yield payload
+        finally:
+            self._consume(position)
+
+            #Make sure the rest of a frame larger than the buffer fits.
+            if(frame_size > len(self.buffer)):
+                self._grow(frame_size)
+
+    def latest_frame(self):
+        '''
+        Skip every complete frame in the buffer but the last one. Incomplete data
+        stays in the buffer until the rest of it is received.
+
+        Parameters:
+            N/A
+        Returns:
+            payload: The bytes of the payload of the last complete frame, or None
+                    if there is no complete frame.
+        '''
+        position = 0
+        frame_size = 0
+        latest = None
+        while(self.length - position >= FRAME_HEADER.size):
+            payload_length, sequence = FRAME_HEADER.unpack_from(self.buffer, position)
+            frame_size = FRAME_HEADER.size + payload_length
+
+            if(position + frame_size > self.length):
+                break
+
+            self.last_sequence = sequence
+            latest = (position + FRAME_HEADER.size, position + frame_size)
+            position += frame_size
+
+        if(latest is not None):
+            latest = bytes(self.view[latest[0]:latest[1]])
+        self._consume(position)
+
+        #Make sure the rest of a frame larger than the buffer fits.
+        if(frame_size > len(self.buffer)):
+            self._grow(frame_size)
+        return latest
+
+    def _consume(self, num_bytes):
+        '''
+        Move the bytes of any incomplete frame to the start of the buffer.
+
+        Parameters:
+            num_bytes: The number of bytes at the start of the buffer that have
+                        been parsed.
+        Returns:
+            N/A
+        '''
+        if(num_bytes == 0):
+            return
+        remaining = self.length - num_bytes
+        if(remaining):
+            self.view[:remaining] = self.view[num_bytes:self.length]
+        self.length = remaining
+
+    def _grow(self, buffer_size):
+        '''
+        Enlarge the receive buffer keeping the bytes already received.
+
+        Parameters:
+            buffer_size: The new size of the buffer in bytes.
+        Returns:
+            N/A
+        '''
+        buffer = bytearray(buffer_size)
+        buffer[:self.length] = self.view[:self.length]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(self.buffer)
+
+class Fragment_Buffer:
+    '''
+    A Fragment_Buffer reassembles the messages that udp publishers split into
+    fragments. Only a bounded number of messages are reassembled at once, the
+    oldest being dropped to make room, and a message whose fragments stop
+    arriving is dropped after a timeout, so lost datagrams can't use up memory.
+    Every fragment but the last of a message holds fragment_size bytes, so a
+    fragment at any other offset or of any other length is ignored.
+    '''
+    def __init__(self, max_message_size, max_messages=MAX_PARTIAL_MESSAGES, timeout=FRAGMENT_TIMEOUT,
+                    fragment_size=UDP_FRAGMENT_SIZE):
+        '''
+        Parameters:
+            max_message_size: The number of bytes of the largest message accepted.
+            max_messages: Default MAX_PARTIAL_MESSAGES. The number of messages
+                        reassembled at once.
+            timeout: Default FRAGMENT_TIMEOUT. The seconds to wait for the rest of
+                        the fragments of a message.
+            fragment_size: Default UDP_FRAGMENT_SIZE. The number of bytes of a
+                        message in each fragment.
+        Returns:
+            N/A
+        '''
+        self.max_message_size = max_message_size
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.fragment_size = fragment_size
+
+        #The messages being reassembled, oldest first, keyed by the address of
+        #the publisher and the sequence number of the message. Each value is the
+        #time the first fragment arrived, the message buffer, the set of offsets
+        #of the fragments received and the number of bytes received.
+        self.messages = collections.OrderedDict()
+
+        #Number of messages dropped before all their fragments arrived.
+        self.dropped = 0
+
+    def add(self, address, sequence, message_length, offset, fragment):
+        '''
+        Add a fragment to the message it belongs to.
+
+        Parameters:
+            address: The address of the publisher that sent the fragment.
+            sequence: The sequence number of the message.
+            message_length: The number of bytes of the whole message.
+            offset: The offset of the fragment in the message.
+            fragment: The bytes-like data of the fragment.
+        Returns:
+            message_encoded: The bytearray of the message if this fragment
+                            completed it, otherwise None.
+        '''
+        if(message_length > self.max_message_size or offset % self.fragment_size != 0 or \
+                offset >= message_length or len(fragment) != min(self.fragment_size, message_length - offset)):
+            return None
+
+        now = time.monotonic()
+        while(self.messages):
+            key, (first_time, _, _, _) = next(iter(self.messages.items()))
+            if(now - first_time < self.timeout):
+                break
+            del self.messages[key]
+            self.dropped += 1
+
+        key = (address, sequence)
+        entry = self.messages.get(key)
+
+        #A fragment of another length replaces the message, so drop the old one
+        #first instead of making room by dropping the message of another publisher.
+        if(entry is not None and len(entry[1]) != message_length):
+            del self.messages[key]
+            self.dropped += 1
+            entry = None
+
+        if(entry is None):
+            if(len(self.messages) >= self.max_messages):
+                self.messages.popitem(last=False)
+                self.dropped += 1
+            entry = [now, bytearray(message_length), set(), 0]
+            self.messages[key] = entry
+
+        _, message_encoded, offsets, received = entry
+        if(offset in offsets):
+            return None
+        message_encoded[offset:offset + len(fragment)] = fragment
+        offsets.add(offset)
+        received += len(fragment)
+
+        if(received < message_length):
+            entry[3] = received
+            return None
+        del self.messages[key]
+        return message_encoded
+
+
+class Send_Queue:
+    '''
+    A Send_Queue holds the frames waiting to be sent to one tcp subscriber. The
+    publisher only appends frames to the queue and its writer thread sends them,
+    keeping track of how much of a frame went out so a partial write never
+    corrupts the stream.
+    '''
+    def __init__(self, sub_socket, queue_size, overflow, stats=None):
+        '''
+        Initialize an empty send queue for a subscriber connection.
+
+        Parameters:
+            sub_socket: The non-blocking socket connected to the subscriber.
+            queue_size: The maximum number of frames waiting to be sent.
+            overflow: What to do with a new frame when the queue is full. Either
+                    "drop_oldest", "drop_newest" or "block".
+            stats: Default None. The Topic_Stats of the publisher that dropped
+                    frames, failed sends and partial writes are counted in.
+        Returns:
+            N/A
+        '''
+        self.socket = sub_socket
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.stats = Topic_Stats() if(stats is None) else stats
+
+        #Frames waiting for the writer thread. Together with the frames in
+        #sending they are never more than queue_size.
+        self.frames = collections.deque()
+
+        #Frames taken off the queue by the writer thread that are still to be
+        #sent. Only the first one may have been partly sent.
+        self.sending = collections.deque()
+
+        #Set once sending fails so the connection is no longer written to.
+        self.broken = False
+
+    def full(self):
+        '''
+        Check if the queue holds queue_size frames, counting the frames taken by
+        the writer thread that are still to be sent.
+
+        Parameters:
+            N/A
+        Returns:
+            full: True if the queue is full.
+        '''
+        return(self.free_space() <= 0)
+
+    def free_space(self):
+        '''
+        Get the number of frames that can be put in the queue before it is full.
+
+        Parameters:
+            N/A
+        Returns:
+            free_space: The number of frames.
+        '''
+        return(self.queue_size - len(self.frames) - len(self.sending))
+
+    def pending(self):
+        '''
+        Check if there is anything left to send.
+
+        Parameters:
+            N/A
+        Returns:
+            pending: True if a frame or part of one is waiting to be sent.
+        '''
+        return(not self.broken and (len(self.sending) > 0 or len(self.frames) > 0))
+
+    def put(self, message_frame):
+        '''
+        Add a frame to the queue applying the overflow policy when it is full.
+        The "block" policy is handled by the publisher before calling put. The
+        frames taken by the writer thread are never dropped, so "drop_oldest"
+        drops the new frame if every frame in the queue was already taken.
+
+        Parameters:
+            message_frame: The framed message.
+        Returns:
+            queued: False if the frame was dropped.
+        '''
+        if(self.broken):
+            self.stats.drops += 1
+            return False
+        if(self.full()):
+            self.stats.drops += 1
+            if(self.overflow == "drop_newest"):
+                return False
+            try:
+                self.frames.popleft()
+            except IndexError:
+                return False
+        self.frames.append(message_frame)
+        return True
+
+    def flush(self):
+        '''
+        WRITER THREAD ONLY
+
+        Send as many waiting frames as the socket accepts without blocking. The
+        waiting frames are written together with sendmsg where it is available,
+        so a backlog of small messages takes one system call instead of one each.
 
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        while(not self.broken):
+
+            #Frames are taken off the queue before they are sent, so a frame the
+            #publisher drops from the full queue is never one that is half sent.
+            while(len(self.sending) < MAX_SEND_BUFFERS):
+                try:
+                    self.sending.append(memoryview(self.frames.popleft()))
+                except IndexError:
+                    break
+                if(not HAS_SENDMSG):
+                    break
+            if(not self.sending):
+                return
+
+            try:
+                if(HAS_SENDMSG):
+                    num_bytes = self.socket.sendmsg(self.sending)
+                else:
+                    num_bytes = self.socket.send(self.sending[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                print("[ERROR]: A socket has appeared to disconnect")
+                self.stats.send_errors += 1
+                self.stats.drops += len(self.frames) + len(self.sending)
+                self.broken = True
+                self.frames.clear()
+                self.sending.clear()
+                return
+
+            #Drop the frames that were sent completely and keep the rest of a
+            #frame that was sent in part.
+            while(num_bytes > 0):
+                message_frame = self.sending[0]
+                if(num_bytes < len(message_frame)):
+                    self.sending[0] = message_frame[num_bytes:]
+                    break
+                num_bytes -= len(message_frame)
+                self.sending.popleft()
+
+            #The socket did not take everything, wait for it to accept more.
+            if(self.sending):
+                self.stats.partial_writes += 1
+                return
 
 class Node:
     '''
@@ -26,7 +493,8 @@ class Node:
     register themselves (and their publishers and subscribers) with mechsocore. The node
     communicates with the master (mechoscore) via xmlrpc servers.
     '''
-    def __init__(self, name, node_ip='127.0.0.1', mechoscore_ip='127.0.0.1', mechoscore_port=5959):
+    def __init__(self, name, node_ip='127.0.0.1', mechoscore_ip='127.0.0.1', mechoscore_port=5959,
+                    mechoscore_control_port=None, executor=None):
         '''
         Initialize a node by connecting it to the mechos network.
 
@@ -35,6 +503,12 @@ class Node:
             node_ip: Default '127.0.0.1': The ip of the node (and the xmlrpc server running on the node)
             mechoscore_ip: Default '127.0.0.1'. The ip of mechsocore server.
             mechoscore_port: Default 5959: The port of the mechoscore server.
+            mechoscore_control_port: Default None. If given, the node talks to mechoscore
+                        over persistent control connections to this port instead of
+                        xmlrpc, and mechoscore calls back the node the same way.
+            executor: Default None. The executor running the callbacks of the subscribers,
+                        see callback_executors. None calls each callback in the thread
+                        spinning the node.
         '''
         self.name = name
         self.pid = os.getpid()
@@ -45,6 +519,11 @@ class Node:
 
         self.mechoscore_xmlrpc_server_ip = mechoscore_ip
         self.mechoscore_xmlrpc_server_port = mechoscore_port
+        self.mechoscore_control_port = mechoscore_control_port
+
+        if(executor is None):
+            executor = Single_Threaded_Executor()
+        self.executor = executor
 
         #Create an xml rpc server of the node so the master can make requests
         #to the node
@@ -62,12 +541,49 @@ class Node:
         #Dictionary that holds subscribers created through this node
         self.node_subscribers = {}
 
+        #Mechoscore may update several publishers and subscribers of the node at
+        #once. Guards the shm ring cursors.
+        self.connection_lock = threading.Lock()
+
+        #The (publisher id, subscriber id) pairs mechoscore connected the
+        #publishers and the subscribers of this node to, so a pair is only
+        #connected once even if mechoscore asks twice.
+        self.publisher_pairs = set()
+        self.subscriber_pairs = set()
+
+        #Selector that watches every subscriber socket of this node so spin_once
+        #only touches the sockets that actually have data waiting.
+        self.selector = selectors.DefaultSelector()
+
+        #Socket pair used to wake up spin_once when a publisher of this node
+        #delivers a message straight to a subscriber of this node.
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, None)
+
         #Register the node with mechoscore
-        allowable = self.xmlrpc_client.register_node(self.name, self.pid,
+        self._register_node()
+
+    def _register_node(self):
+        '''
+        Register the node with mechoscore.
+
+        Parameters:
+            N/A
+        Returns:
+            allowable: False if a node with the same name already exists.
+        '''
+        if(self.control_server is not None):
+            allowable = self.xmlrpc_client.register_node(self.name, self.pid,
+                                    self.xmlrpc_server_ip, self.xmlrpc_server_port, self.control_server_port)
+        else:
+            allowable = self.xmlrpc_client.register_node(self.name, self.pid,
                                     self.xmlrpc_server_ip, self.xmlrpc_server_port)
         if(not allowable):
             print("[ERROR]:Node %s already exists, killing program" % self.name)
             self.xmlrpc_client.unregister_node(self.name)
+        return allowable
 
     def get_free_port(self, ip):
         '''
@@ -94,8 +610,10 @@ class Node:
         Returns:
             N/A
         '''
-        #Create a simple xmlrpc server
-        self.xmlrpc_server = SimpleXMLRPCServer((self.xmlrpc_server_ip, self.xmlrpc_server_port), logRequests=False)
+        #Create an xmlrpc server. Mechoscore may call the node from several threads
+        #at once, so each request is handled in its own thread.
+        self.xmlrpc_server = Threaded_XMLRPC_Server((self.xmlrpc_server_ip, self.xmlrpc_server_port), logRequests=False)
+
 
         #Register functions with server so that mechoscore can call actions on a node.
         #Update a publisher on a subscriber trying to connect. Allow it to make a
@@ -113,10 +631,26 @@ class Node:
         self.xmlrpc_server.register_function(self._kill_subscriber_connection)
         self.xmlrpc_server.register_function(self._kill_publisher_connection)
 
+        #Allow mechoscore to collect the counters of the publishers and subscribers.
+        self.xmlrpc_server.register_function(self._get_topic_stats)
+
         #Run the nodes xmlrpc server as a thread.
         self.xmlrpc_server_thread = threading.Thread(target=self.xmlrpc_server.serve_forever, daemon=True)
         self.xmlrpc_server_thread.start()
 
+        #When mechoscore is reached over persistent control connections, it calls
+        #back the node the same way, on a free port.
+        self.control_server = None
+        self.control_server_port = None
+        if(self.mechoscore_control_port is not None):
+            self.control_server = Control_Server((self.xmlrpc_server_ip, 0))
+            self.control_server_port = self.control_server.server_address[1]
+            for name, function in self.xmlrpc_server.funcs.items():
+                self.control_server.register_function(function, name)
+
+            self.control_server_thread = threading.Thread(target=self.control_server.serve_forever, daemon=True)
+            self.control_server_thread.start()
+
     def _create_xmlrpc_client(self):
         '''
         Create an xmlrpc server client to establish communication from this node
@@ -127,9 +661,12 @@ class Node:
         Returns:
             N/A
         '''
-        self.xmlrpc_client = xmlrpc.client.ServerProxy("http://" + \
-                    self.mechoscore_xmlrpc_server_ip + ":" + \
-                    str(self.mechoscore_xmlrpc_server_port))
+        if(self.mechoscore_control_port is not None):
+            self.xmlrpc_client = Control_Client((self.mechoscore_xmlrpc_server_ip, self.mechoscore_control_port))
+        else:
+            self.xmlrpc_client = xmlrpc.client.ServerProxy("http://" + \
+                        self.mechoscore_xmlrpc_server_ip + ":" + \
+                        str(self.mechoscore_xmlrpc_server_port))
 
     def _kill_node(self):
         '''
@@ -160,8 +697,16 @@ class Node:
                         publisher id.
         '''
         publisher = self.node_publishers[publisher_id]
+        if(not self._claim_pair(self.publisher_pairs, publisher_id, subscriber_id)):
+            return True
 
-        if(publisher.protocol == "tcp"):
+        #Subscribers of this node get the messages handed to them directly
+        #without any serialization or sockets. Multicast subscribers of this node
+        #get the datagram sent to the group like every other subscriber.
+        if(subscriber_id in self.node_subscribers and publisher.protocol != "udp_multicast"):
+            publisher.local_subscribers[subscriber_id] = self.node_subscribers[subscriber_id]
+
+        elif(publisher.protocol == "tcp"):
 
             publisher_accept_thread = threading.Thread(target=self._publisher_accept_connection, args=[publisher_id, subscriber_id], daemon=True)
             publisher_accept_thread.start()
@@ -173,6 +718,23 @@ class Node:
 
             #Note that update subscribers was called first
             publisher.subscriber_udp_connections[subscriber_id] = [subscriber_ip, subscriber_port]
+
+        #Multicast publishers send to their group, only the subscribers are counted
+        #so nothing is sent when there are none.
+        elif(publisher.protocol == "udp_multicast"):
+            publisher.subscriber_multicast_connections[subscriber_id] = [subscriber_ip, subscriber_port]
+
+        #Shm publishers give the subscriber a read cursor in the ring buffer and
+        #wake it up through its ip and port.
+        elif(publisher.protocol == "shm"):
+
+            with self.connection_lock:
+                cursor_index = publisher.ring.add_cursor(subscriber_id)
+            if(cursor_index is None):
+                print("[ERROR]: Shm publisher on topic %s has no free subscriber cursors" % publisher.topic)
+                self._forget_pairs(self.publisher_pairs, 0, publisher_id, subscriber_id)
+                return False
+            publisher.subscriber_shm_connections[subscriber_id] = [subscriber_ip, subscriber_port, cursor_index]
         return True
 
     def _publisher_accept_connection(self, publisher_id, subscriber_id):
@@ -190,13 +752,30 @@ class Node:
         publisher = self.node_publishers[publisher_id]
 
         conn, addr = publisher.server_socket.accept()
+
+        #Mechoscore may connect several subscribers to the publisher at once, so the
+        #connection accepted is not necessarily the one of subscriber_id. The
+        #subscriber sends its id first thing after connecting.
+        conn.settimeout(TCP_HANDSHAKE_TIMEOUT)
+        try:
+            handshake = b''
+            while(len(handshake) < TCP_HANDSHAKE.size):
+                data = conn.recv(TCP_HANDSHAKE.size - len(handshake))
+                if(not data):
+                    raise ConnectionError("connection closed")
+                handshake += data
+        except OSError as error:
+            print("[ERROR]: Tcp subscriber on topic %s failed to connect: %s" % (publisher.topic, error))
+            conn.close()
+            return
+        subscriber_id = TCP_HANDSHAKE.unpack(handshake)[0].hex()
         conn.setblocking(False)
 
         #Maximum send buffer.
         conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, publisher.queue_size*publisher.message_format.size)
         conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        publisher.subscriber_tcp_connections[subscriber_id] = [conn, addr]
+        publisher._add_tcp_subscriber(subscriber_id, conn, addr)
 
 
     def _update_subscriber(self, subscriber_id, publisher_id, publisher_ip, publisher_port):
@@ -216,15 +795,126 @@ class Node:
         '''
 
         subscriber = self.node_subscribers[subscriber_id]
+        if(not self._claim_pair(self.subscriber_pairs, publisher_id, subscriber_id)):
+            return True
+
+        #Publishers of this node deliver to the subscriber directly.
+        if(publisher_id in self.node_publishers and subscriber.protocol != "udp_multicast"):
+            return True
 
         if(subscriber.protocol == "tcp"):
             subscriber._connect_to_tcp_publisher(publisher_id, publisher_ip, publisher_port)
+            sub_socket = subscriber.publisher_tcp_connections[publisher_id]
 
         elif(subscriber.protocol == "udp"):
             subscriber._connect_to_udp_publisher(publisher_id, publisher_ip, publisher_port)
+            sub_socket = subscriber.publisher_udp_connections[publisher_id][0]
+
+        #The doorbell socket of a shm subscriber is watched from its creation.
+        elif(subscriber.protocol == "shm"):
+            subscriber._connect_to_shm_publisher(publisher_id, publisher_ip, publisher_port)
+            return True
+
+        elif(subscriber.protocol == "udp_multicast"):
+            with self.connection_lock:
+                first_connection = subscriber.multicast_socket is None
+                subscriber._connect_to_multicast_publisher(publisher_id, publisher_ip, publisher_port)
+
+            #All the publishers of the topic send to the same group.
+            if(not first_connection):
+                return True
+            sub_socket = subscriber.multicast_socket
+            publisher_id = None
+
+        #Threaded subscribers watch their sockets in their own thread.
+        if(subscriber.threaded):
+            subscriber._watch_socket(sub_socket, publisher_id)
+        else:
+            self._watch_subscriber_socket(sub_socket, subscriber, publisher_id)
 
         return True
 
+    def _claim_pair(self, pairs, publisher_id, subscriber_id):
+        '''
+        Record that a publisher and a subscriber are being connected.
+
+        Parameters:
+            pairs: Either publisher_pairs or subscriber_pairs.
+            publisher_id: The unique id of the publisher.
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            claimed: False if the pair was already connected.
+        '''
+        with self.connection_lock:
+            if((publisher_id, subscriber_id) in pairs):
+                return False
+            pairs.add((publisher_id, subscriber_id))
+            return True
+
+    def _forget_pairs(self, pairs, index, id, other_id=None):
+        '''
+        Forget the connected pairs of a publisher or subscriber that was disconnected.
+
+        Parameters:
+            pairs: Either publisher_pairs or subscriber_pairs.
+            index: 0 if id is a publisher id, 1 if it is a subscriber id.
+            id: The unique id of the publisher or subscriber.
+            other_id: Default None. Only forget the pair with this id on the other
+                    side, instead of every pair of id.
+        Returns:
+            N/A
+        '''
+        with self.connection_lock:
+            pairs.difference_update([pair for pair in pairs if pair[index] == id and \
+                                        (other_id is None or pair[1 - index] == other_id)])
+
+    def _watch_subscriber_socket(self, sub_socket, subscriber, publisher_id):
+        '''
+        Register a subscriber socket with the node selector so that spin_once
+        is woken up as soon as data from the publisher arrives.
+
+        Parameters:
+            sub_socket: The socket of the subscriber connected to the publisher.
+            subscriber: The subscriber object that owns the socket.
+            publisher_id: The unique id of the publisher the socket receives from.
+        Returns:
+            N/A
+        '''
+        self.selector.register(sub_socket, selectors.EVENT_READ, (subscriber, publisher_id))
+
+    def _unwatch_subscriber_socket(self, sub_socket):
+        '''
+        Remove a subscriber socket from the node selector. This must be done
+        before the socket is closed.
+
+        Parameters:
+            sub_socket: The socket of the subscriber to stop watching.
+        Returns:
+            N/A
+        '''
+        if(self._unwatch_threaded_socket(sub_socket)):
+            return
+
+        try:
+            self.selector.unregister(sub_socket)
+        except (KeyError, ValueError):
+            pass
+
+    def _unwatch_threaded_socket(self, sub_socket):
+        '''
+        Remove a subscriber socket from the selector of the threaded subscriber
+        watching it, if any.
+
+        Parameters:
+            sub_socket: The socket of the subscriber to stop watching.
+        Returns:
+            unwatched: True if a threaded subscriber was watching the socket.
+        '''
+        for subscriber in list(self.node_subscribers.values()):
+            if(subscriber.threaded and subscriber._unwatch_socket(sub_socket)):
+                return True
+        return False
+
     def _kill_publisher(self, id):
         '''
         XMLRPC CALL FROM MECHOSCORE
@@ -238,17 +928,26 @@ class Node:
         '''
         publisher = self.node_publishers[id]
 
+        #Send what a coalescing publisher held back before its sockets close.
+        if(publisher.coalesce_delay is not None):
+            try:
+                publisher._stop_coalescer()
+            except (OSError, ValueError) as e:
+                pass
+
         subscriber_ids = list(publisher.subscriber_tcp_connections.keys()).copy()
 
         if(publisher.protocol == "tcp"):
             #Close all the connection to the subscribers.
             for subscriber_id in subscriber_ids:
 
-                #close the connection socket to the subscriber on the publishers end.
-                (publisher.subscriber_tcp_connections[subscriber_id])[0].close()
+                #close the connection socket to the subscriber on the publishers end
+                #and remove it along with its send queue.
+                publisher._remove_tcp_subscriber(subscriber_id)
 
-                #Remove the socket connecting to the subscriber
-                (publisher.subscriber_tcp_connections.pop(subscriber_id))
+            #Stop the writer thread and the tcp server.
+            publisher._stop_writer()
+            publisher.server_socket.close()
 
         #close the udp server socket.
         elif(publisher.protocol == "udp"):
@@ -261,9 +960,22 @@ class Node:
 
             publisher.server_socket.close()
 
+        elif(publisher.protocol == "udp_multicast"):
+            publisher.subscriber_multicast_connections.clear()
+            publisher.server_socket.close()
+
+        #Remove the ring buffer from the system.
+        elif(publisher.protocol == "shm"):
+            publisher.subscriber_shm_connections.clear()
+            publisher.ring.close()
+            publisher.server_socket.close()
+
+        publisher.local_subscribers.clear()
+
 
         #Remove the publisher from the nodes publisher dictionary
         self.node_publishers.pop(id)
+        self._forget_pairs(self.publisher_pairs, 0, id)
         del publisher
 
         return True
@@ -281,20 +993,45 @@ class Node:
         '''
         subscriber = self.node_subscribers[id]
 
+        #Stop the receive thread before its sockets are closed.
+        if(subscriber.threaded):
+            subscriber._stop_receiving()
+
         #Close all the connections to publishers.
-        for publisher_id in self.node_publishers.keys():
-            publisher = self.node_publishers[publisher_id]
+        for publisher_id in list(subscriber.publisher_tcp_connections.keys()):
+
+            #close the subscriber client connection
+            sub_socket = subscriber.publisher_tcp_connections.pop(publisher_id)
+            subscriber.frame_receivers.pop(publisher_id, None)
+            self._unwatch_subscriber_socket(sub_socket)
+            sub_socket.close()
+
+        for publisher_id in list(subscriber.publisher_udp_connections.keys()):
+
+            sub_socket = subscriber.publisher_udp_connections.pop(publisher_id)[0]
+            self._unwatch_subscriber_socket(sub_socket)
+            sub_socket.close()
+
+        for publisher_id in list(subscriber.publisher_shm_connections.keys()):
+
+            subscriber.publisher_shm_connections.pop(publisher_id)[0].close()
+
+        if(subscriber.doorbell_socket is not None):
+            self._unwatch_subscriber_socket(subscriber.doorbell_socket)
+            subscriber.doorbell_socket.close()
 
-            if(publisher.protocol == "tcp"):
-                #close the subscriber client connection
-                (subscriber.publisher_tcp_connections[publisher_id]).close()
-                subscriber.publisher_tcp_connections.pop(publisher_id)
+        subscriber.publisher_multicast_connections.clear()
+        if(subscriber.multicast_socket is not None):
+            self._unwatch_subscriber_socket(subscriber.multicast_socket)
+            subscriber.multicast_socket.close()
 
-            elif(publisher.protocol == "udp"):
-                (subscriber.publisher_udp_connections[publisher_id])[0].close()
-                subscriber.publisher_udp_connections.pop(publisher_id)
+        #Stop publishers of this node from delivering to the subscriber.
+        for publisher in self.node_publishers.values():
+            publisher.local_subscribers.pop(id, None)
+        subscriber.local_inbox.clear()
 
         self.node_subscribers.pop(id)
+        self._forget_pairs(self.subscriber_pairs, 1, id)
         del subscriber
 
         return(True)
@@ -318,15 +1055,29 @@ class Node:
 
             #if subscriber is tcp
             if(publisher_id in subscriber.publisher_tcp_connections.keys()):
-                (subscriber.publisher_tcp_connections[publisher_id]).close()
-                subscriber.publisher_tcp_connections.pop(publisher_id)
+                sub_socket = subscriber.publisher_tcp_connections.pop(publisher_id)
+                subscriber.frame_receivers.pop(publisher_id, None)
+                self._unwatch_subscriber_socket(sub_socket)
+                sub_socket.close()
 
             #if subscriber is udp
             elif(publisher_id in subscriber.publisher_udp_connections.keys()):
-                (subscriber.publisher_udp_connections[publisher_id])[0].close()
-                subscriber.publisher_udp_connections.pop(publisher_id)
-
-
+                [sub_socket, publisher_ip, publisher_port] = subscriber.publisher_udp_connections.pop(publisher_id)
+                subscriber.udp_sequences.pop((publisher_ip, publisher_port), None)
+                self._unwatch_subscriber_socket(sub_socket)
+                sub_socket.close()
+
+            #if subscriber is shm, detach from the ring buffer before the
+            #publisher removes it.
+            elif(publisher_id in subscriber.publisher_shm_connections.keys()):
+                subscriber.publisher_shm_connections.pop(publisher_id)[0].close()
+
+            #if subscriber is multicast, the group socket stays open for the other
+            #publishers of the topic.
+            elif(publisher_id in subscriber.publisher_multicast_connections.keys()):
+                subscriber.publisher_multicast_connections.pop(publisher_id)
+
+        self._forget_pairs(self.subscriber_pairs, 0, publisher_id)
         return True
 
     def _kill_publisher_connection(self, subscriber_id):
@@ -347,12 +1098,44 @@ class Node:
             #if publisher is tcp
             if(subscriber_id in publisher.subscriber_tcp_connections.keys()):
 
-                publisher.subscriber_tcp_connections[subscriber_id][0].close()
-                publisher.subscriber_tcp_connections.pop(subscriber_id)
+                publisher._remove_tcp_subscriber(subscriber_id)
+
+            #if publisher is shm, free the read cursor of the subscriber.
+            elif(subscriber_id in publisher.subscriber_shm_connections.keys()):
+                publisher.subscriber_shm_connections.pop(subscriber_id)
+                publisher.ring.remove_cursor(subscriber_id)
+
+            elif(subscriber_id in publisher.subscriber_multicast_connections.keys()):
+                publisher.subscriber_multicast_connections.pop(subscriber_id)
 
+            #if the subscriber is on this node
+            publisher.local_subscribers.pop(subscriber_id, None)
+
+        self._forget_pairs(self.publisher_pairs, 1, subscriber_id)
         return True
 
-    def create_publisher(self, topic, message_format, queue_size=1000, ip=None, protocol="tcp"):
+    def _get_topic_stats(self):
+        '''
+        XMLRPC CALL FROM MECHOSCORE
+
+        Get the counters of every publisher and subscriber of the node.
+
+        Parameters:
+            N/A
+        Returns:
+            node_stats: A dictionary with a list of "publishers" and of "subscribers",
+                    each a dictionary of their topic, protocol, id and the
+                    dictionary of their counters (see topic_stats).
+        '''
+        return({"publishers": [{"topic": publisher.topic, "protocol": publisher.protocol, "id": publisher.id,
+                                "stats": publisher.stats.snapshot()}
+                                for publisher in list(self.node_publishers.values())],
+                "subscribers": [{"topic": subscriber.topic, "protocol": subscriber.protocol, "id": subscriber.id,
+                                "stats": subscriber.stats.snapshot()}
+                                for subscriber in list(self.node_subscribers.values())]})
+
+    def create_publisher(self, topic, message_format, queue_size=1000, ip=None, protocol="tcp", local_copy=True,
+                            overflow="drop_oldest", coalesce_delay=None, coalesce_size=UDP_BATCH_SIZE):
         '''
         Create either a tcp or udp publisher server.
 
@@ -363,18 +1146,47 @@ class Node:
                             method for packing and unpacking bytes. It also must have the
                             byte size of the message.
             queue_size: The maximum number of messages that the socket publisher should stack
-                        up for sending.
+                        up for sending. The ring buffer of a shm publisher holds at most
+                        SHM_MAX_RING_SIZE bytes of messages, so fewer messages of a large
+                        message format.
             ip: The ip address that you want to connect publishers server to be created on.
             port: The port address that you want to connect the publishers server to.
-            protocol: Either tcp or udp protocol. Note only one topic can have one protocol.
+            protocol: Either tcp, udp, udp_multicast or shm protocol. Note only one topic can have
+                    one protocol. udp_multicast sends each message once to a multicast
+                    group that mechoscore assigns to the topic, however many subscribers
+                    there are. shm moves messages through a shared memory ring buffer and only
+                    connects to subscribers running on the same host.
+            local_copy: Default True. Subscribers of this same node are handed the
+                    published message object directly. If True, they get a deep
+                    copy of it so the publisher may keep modifying the message. Set
+                    to False to skip the copy when published messages are never
+                    modified afterwards.
+            overflow: Default "drop_oldest". What a tcp publisher does with a new
+                    message when queue_size messages are already waiting to be sent
+                    to a subscriber. "drop_oldest" drops the oldest waiting message,
+                    "drop_newest" drops the new message and "block" makes publish
+                    wait until there is room.
+            coalesce_delay: Default None. If given, published messages are held back
+                    for up to this many seconds and sent to the subscribers on other
+                    nodes together, in as few datagrams or writes as possible. None
+                    sends every message as soon as it is published.
+            coalesce_size: Default UDP_BATCH_SIZE. The number of bytes of held back
+                    messages that makes the publisher send them without waiting
+                    for coalesce_delay to pass.
         '''
         if ip == None:
 
             ip=self.ip
 
-        port = self.get_free_port(ip)
+        #A multicast publisher sends from the node to the group of the topic.
+        if(protocol == "udp_multicast"):
+            interface_ip = ip
+            ip, port = self.xmlrpc_client.get_multicast_group(topic)
+        else:
+            port = self.get_free_port(ip)
         #port = 8787
-        publisher = Node.Publisher(topic, message_format, queue_size, ip, port, protocol)
+        publisher = self.Publisher(topic, message_format, queue_size, ip, port, protocol, local_copy, overflow,
+                                    coalesce_delay, coalesce_size)
 
         #Add the publisher object to the node dictionary of publishers.
         self.node_publishers[publisher.id] = publisher
@@ -383,6 +1195,10 @@ class Node:
             publisher._create_tcp_server()
         elif(protocol == "udp"):
             publisher._create_udp_server()
+        elif(protocol == "udp_multicast"):
+            publisher._create_multicast_server(interface_ip)
+        elif(protocol == "shm"):
+            publisher._create_shm_server()
 
         #Register the publisher with mechoscore under the node created under.
         allowable = self.xmlrpc_client.register_publisher(self.name, publisher.id, publisher.topic,
@@ -392,7 +1208,8 @@ class Node:
 
         return publisher
 
-    def create_subscriber(self, topic, message_format, callback, queue_size=1000, ip=None, protocol="tcp"):
+    def create_subscriber(self, topic, message_format, callback, queue_size=1000, ip=None, protocol="tcp",
+                            conflate=False, threaded=False, overflow="drop_oldest", callback_group=None):
         '''
         Create either a tcp or udp subscriber that will connect to publishers
         when instructed to by mechoscore.
@@ -405,14 +1222,55 @@ class Node:
             callback: A function with one parameter in which the subscriber will pass the
                         data it receives to.
             queue_size: The maximum amount of messages the receive socket buffer should queue up
-            protocol: Either tcp or udp protocol
+            protocol: Either tcp, udp, udp_multicast or shm protocol
+            conflate: Default False. If True, only the newest message of each publisher
+                    is passed to the callback. Everything waiting when the subscriber
+                    is spun is received, but only the last message is unpacked, so a
+                    callback that falls behind skips stale messages instead of
+                    working through them.
+            threaded: Default False. If True, the subscriber receives its messages in
+                    its own thread as soon as they arrive, whether or not the node is
+                    being spun, and puts them in an inbox of up to queue_size messages.
+                    The callback is still called from spin_once (or the event loop of
+                    an AsyncNode) with the messages in the inbox.
+            overflow: Default "drop_oldest". What a threaded subscriber does with a new
+                    message when its inbox is full. "drop_oldest" drops the oldest
+                    waiting message, "drop_newest" drops the new message and "block"
+                    stops receiving until the node is spun, leaving the messages in
+                    the socket buffers.
+            callback_group: Default None. The Callback_Group the callback runs under with
+                    the executor of the node. Callbacks of a mutually exclusive group
+                    never run at the same time, callbacks of a reentrant group may.
+                    None gives the subscriber a mutually exclusive group of its own,
+                    so its messages are always handled in order.
         '''
         if ip == None:
 
             ip=self.ip
 
-        port = self.get_free_port(ip)
-        subscriber = Node.Subscriber(topic, message_format, callback, queue_size, ip, port, protocol)
+        #A multicast subscriber joins the group of the topic on the interface of ip.
+        if(protocol == "udp_multicast"):
+            port = self.xmlrpc_client.get_multicast_group(topic)[1]
+
+        #The doorbell socket of a shm subscriber is bound to a port the os picks.
+        elif(protocol == "shm"):
+            port = 0
+        else:
+            port = self.get_free_port(ip)
+        subscriber = self.Subscriber(topic, message_format, callback, queue_size, ip, port, protocol, conflate,
+                                    threaded, overflow, self.executor, callback_group)
+        subscriber.wakeup_socket = self.wakeup_sender
+
+        #Every shm publisher rings the same doorbell socket, so it is watched
+        #from the start.
+        if(protocol == "shm"):
+            subscriber._create_doorbell()
+            if(threaded):
+                subscriber._watch_socket(subscriber.doorbell_socket, None)
+            else:
+                self._watch_subscriber_socket(subscriber.doorbell_socket, subscriber, None)
+        if(threaded):
+            subscriber.start()
 
         #Add the subscriber to the node subscriber list.
         self.node_subscribers[subscriber.id] = subscriber
@@ -423,24 +1281,95 @@ class Node:
 
         return(subscriber)
 
-    def spin_once(self):
+    def spin_once(self, timeout=0.0):
         '''
         Check for messages for each subscriber of the node.
         This is the function that should be called to get messages
-        sent from publishers to subscribers. Usually this is put in a
-        thread in your program to continually receive messages.
+        sent from publishers to subscribers. Only the subscriber sockets
+        that are readable are touched, so the cost of a spin does not grow
+        with the number of idle topics.
 
         Parameters:
-            N/A
+            timeout: Default 0.0. The maximum time in seconds to wait for
+                    any subscriber socket to become readable. 0.0 only checks
+                    for messages already waiting and None waits until a message
+                    arrives.
         Returns:
             N/A
         '''
+        #The selector refuses to wait when nothing is registered, so wait here
+        #until a socket is watched instead of returning straight away.
+        while(not self.selector.get_map()):
+            if(timeout is not None):
+                if(timeout):
+                    time.sleep(timeout)
+                return
+            time.sleep(0.1)
 
-        for subscriber_id in self.node_subscribers.keys():
+        events = self.selector.select(timeout)
+
+        for key, mask in events:
+
+            #Messages delivered by publishers of this node.
+            if(key.data is None):
+                self._receive_local()
+                continue
 
             #Receive message
-            subscriber = self.node_subscribers[subscriber_id]
-            message = subscriber._receive()
+            subscriber, publisher_id = key.data
+            connected = subscriber._receive(publisher_id, key.fileobj)
+
+            #A closed tcp connection stays readable forever, so stop watching it.
+            if(not connected):
+                self._unwatch_subscriber_socket(key.fileobj)
+
+    def _receive_local(self):
+        '''
+        Pass the messages that publishers of this node delivered directly to
+        subscribers of this node, and the messages threaded subscribers received,
+        to their callbacks.
+
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        while(1):
+            try:
+                self.wakeup_receiver.recv(4096)
+            except socket.error as e:
+                break
+
+        for subscriber in list(self.node_subscribers.values()):
+            while(1):
+                with subscriber.local_inbox_lock:
+                    if(not subscriber.local_inbox):
+                        break
+                    if(subscriber.conflate):
+                        _, message = subscriber.local_inbox.popitem(last=False)
+                    else:
+                        message = subscriber.local_inbox.popleft()
+                subscriber.dispatch_callback(message)
+
+            #Messages received by threaded subscribers.
+            if(subscriber.threaded):
+                subscriber._dispatch_inbox()
+
+    def spin(self):
+        '''
+        Continually receive messages for each subscriber of the node, waking
+        up as soon as data arrives. This call never returns, so it is usually
+        put in a thread in your program.
+
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        while(1):
+            #Wake up periodically so sockets of newly connected publishers are
+            #picked up on platforms where the selector can't be updated mid-wait.
+            self.spin_once(timeout=0.1)
 
     class Publisher:
         '''
@@ -449,7 +1378,8 @@ class Node:
         mechoscore through the mechoscore XMLRPC server and will be connected to subscriber
         throught the Node XMLRPC server.
         '''
-        def __init__(self, topic, message_format, queue_size, ip, port, protocol):
+        def __init__(self, topic, message_format, queue_size, ip, port, protocol, local_copy=True,
+                        overflow="drop_oldest", coalesce_delay=None, coalesce_size=UDP_BATCH_SIZE):
             '''
             Create either a tcp or udp publisher server.
 
@@ -464,6 +1394,15 @@ class Node:
                 ip: The ip address that you want to connect publishers server to be created on.
                 port: The port address that you want to connect the publishers server to.
                 protocol: Either tcp or udp protocol. Note only one topic can have one protocol.
+                local_copy: Default True. If True, subscribers on the same node get a
+                            deep copy of the published message instead of the object itself.
+                overflow: Default "drop_oldest". The policy of the tcp send queues when
+                            they are full. Either "drop_oldest", "drop_newest" or "block".
+                coalesce_delay: Default None. The most seconds a published message is
+                            held back to be sent together with the next ones. None
+                            sends every message as soon as it is published.
+                coalesce_size: Default UDP_BATCH_SIZE. The number of bytes of held back
+                            messages that are sent without waiting for coalesce_delay.
             '''
             self.topic = topic
             self.queue_size = queue_size
@@ -476,12 +1415,60 @@ class Node:
             #generate a unique id
             self.id = str(uuid.uuid4().hex)
 
+            #Sequence number put in the frame header of each tcp and udp message.
+            self.sequence = 0
+
+            #Counters of the messages published, see topic_stats.
+            self.stats = Topic_Stats()
+
             #The socket connections of subscribers when the accpet() function is called.
             self.subscriber_tcp_connections = {}
 
             #Hold the ip and port of the subscribers to send to over udp
             self.subscriber_udp_connections = {}
 
+            #Hold the ip and port of the subscribers that joined the multicast group.
+            self.subscriber_multicast_connections = {}
+
+            #Hold the ip, port and ring buffer cursor index of the subscribers
+            #reading from the shared memory ring buffer.
+            self.subscriber_shm_connections = {}
+
+            #Subscribers on the same node that get messages handed to them directly.
+            self.local_copy = local_copy
+            self.local_subscribers = {}
+
+            #A Send_Queue for each tcp subscriber drained by the writer thread. The
+            #condition guards the queues and wakes up publishers waiting for room.
+            if(overflow not in ("drop_oldest", "drop_newest", "block")):
+                raise ValueError("Unknown overflow policy %s" % overflow)
+            self.overflow = overflow
+            self.send_queues = {}
+            self.send_condition = threading.Condition()
+            self.run_writer = True
+            self.writer_thread = None
+
+            #The writer thread waits on a selector for the sockets of subscribers
+            #that fell behind to accept more data, or for a byte on the wakeup
+            #socket telling it new frames were queued. writer_woken is set while a
+            #wakeup byte is waiting so only one is sent however many frames are.
+            self.writer_selector = None
+            self.writer_wakeup_receiver = None
+            self.writer_wakeup_sender = None
+            self.writer_woken = False
+
+            #Packed messages held back to be sent together, and the thread sending
+            #them once the oldest one has waited coalesce_delay seconds.
+            self.coalesce_delay = coalesce_delay
+            self.coalesce_size = coalesce_size
+            self.batch = []
+            self.batch_size = 0
+            self.batch_deadline = None
+            self.batch_condition = threading.Condition()
+            self.run_coalescer = coalesce_delay is not None
+            if(self.run_coalescer):
+                threading.Thread(target=self._coalesce_loop, daemon=True).start()
+
         def _create_tcp_server(self):
             '''
             If the publisher is has a tcp protocol, then create a tcp socket server.
@@ -499,71 +1486,583 @@ class Node:
             self.server_socket.bind((self.ip, self.port))
             self.server_socket.listen()
 
-        def _create_udp_server(self):
+            self.writer_selector = selectors.DefaultSelector()
+            self.writer_wakeup_receiver, self.writer_wakeup_sender = socket.socketpair()
+            self.writer_wakeup_receiver.setblocking(False)
+            self.writer_wakeup_sender.setblocking(False)
+            self.writer_selector.register(self.writer_wakeup_receiver, selectors.EVENT_READ)
+
+            self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self.writer_thread.start()
+
+        def _add_tcp_subscriber(self, subscriber_id, conn, addr):
             '''
-            If the publisher is has a udp protocol, then create a udp socket server.
+            Keep track of the connection to a tcp subscriber and give it a send queue.
 
             Parameters:
-                N/A
+                subscriber_id: The unique id of the subscriber.
+                conn: The non-blocking socket connected to the subscriber.
+                addr: The address of the subscriber.
             Returns:
                 N/A
             '''
+            with self.send_condition:
+                self.subscriber_tcp_connections[subscriber_id] = [conn, addr]
+                self.send_queues[subscriber_id] = Send_Queue(conn, self.queue_size, self.overflow, self.stats)
 
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.queue_size*self.message_format.size)
-
-
-        def publish(self, message):
+        def _remove_tcp_subscriber(self, subscriber_id):
             '''
-            Publish a message to the topic of the subscriber. The message must
-            be of the type that the message_format object will pack and unpack.
-            For example, if the message_format is type simple_messages.bool.Bool(),
-            then a boolean value must be passed.
+            Close the connection to a tcp subscriber and drop its send queue.
 
             Parameters:
-                message: A message that matches the type described in the message format
-                         object passed to the publisher.
-
-            Returns
+                subscriber_id: The unique id of the subscriber.
+            Returns:
                 N/A
             '''
+            with self.send_condition:
+                self.send_queues.pop(subscriber_id, None)
+                connection = self.subscriber_tcp_connections.pop(subscriber_id, None)
+                if(connection is not None):
+                    connection[0].close()
 
-            #Pack the message as bytes using the message format packer.
-            message_encoded = self.message_format._pack(message)
-            if(self.protocol == 'tcp'):
+                #Publishers blocked on the removed queue need to move on.
+                self._room_freed()
 
-                subscriber_connections = list(self.subscriber_tcp_connections.keys()).copy()
-                for subscriber_id in subscriber_connections:
-                    try:
-                        sub_socket = (self.subscriber_tcp_connections[subscriber_id])[0]
-                        sub_socket.send(message_encoded)
-                    except socket.error as e:
-                        print("[ERROR]: A socket has appeared to disconnect")
-                        continue
-                    except:
-                        continue
-            elif(self.protocol == 'udp'):
+        def _stop_writer(self):
+            '''
+            Stop the writer thread of a tcp publisher.
 
-                subscriber_connections = list(self.subscriber_udp_connections.keys()).copy()
-                for subscriber_id in subscriber_connections:
-                    try:
-                        [subscriber_ip, subscriber_port] = self.subscriber_udp_connections[subscriber_id]
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            with self.send_condition:
+                self.run_writer = False
+                self._room_freed()
+                self._wake_writer()
 
-                        self.server_socket.sendto(message_encoded, (subscriber_ip, subscriber_port))
+        def _room_freed(self):
+            '''
+            Let publishers blocked on a full send queue check for room again.
+            Called with send_condition held.
 
-                    except socket.error as e:
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            self.send_condition.notify_all()
+
+        def _wake_writer(self):
+            '''
+            Wake up the writer thread to send newly queued frames. Called with
+            send_condition held.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            if(self.writer_woken or self.writer_wakeup_sender is None):
+                return
+            self.writer_woken = True
+            try:
+                self.writer_wakeup_sender.send(b'\x00')
+            except socket.error as e:
+                pass
+
+        def _writer_loop(self):
+            '''
+            WRITER THREAD
+
+            Send the frames in the send queues of every tcp subscriber. A subscriber
+            that can't keep up only fills its own queue, the others are still sent
+            to as soon as their frames are queued.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            #The sockets registered for EVENT_WRITE, those with frames left over.
+            blocked_sockets = set()
+            while(1):
+                with self.send_condition:
+                    if(not self.run_writer):
+                        self.writer_selector.close()
+                        self.writer_wakeup_receiver.close()
+                        self.writer_wakeup_sender.close()
+                        return
+
+                    #Clear the wakeup before looking at the queues, so frames queued
+                    #from now on send a new wakeup byte.
+                    while(1):
+                        try:
+                            self.writer_wakeup_receiver.recv(4096)
+                        except socket.error as e:
+                            break
+                    self.writer_woken = False
+                    send_queues = list(self.send_queues.items())
+
+                for subscriber_id, send_queue in send_queues:
+                    send_queue.flush()
+
+                #Let publishers blocked on a full queue check for room.
+                if(self.overflow == "block"):
+                    with self.send_condition:
+                        self._room_freed()
+
+                #Only watch the sockets of subscribers that fell behind, until
+                #they accept more data.
+                pending_sockets = set(send_queue.socket for subscriber_id, send_queue in send_queues \
+                                        if send_queue.pending())
+                for sub_socket in blocked_sockets - pending_sockets:
+                    try:
+                        self.writer_selector.unregister(sub_socket)
+                    except (KeyError, ValueError):
+                        pass
+                for sub_socket in pending_sockets - blocked_sockets:
+
+                    #The socket may have been closed since the queues were copied.
+                    try:
+                        self.writer_selector.register(sub_socket, selectors.EVENT_WRITE)
+                    except (KeyError, ValueError, OSError):
+                        pending_sockets.discard(sub_socket)
+                blocked_sockets = pending_sockets
+
+                #Subscribers whose connection failed are not sent to again.
+                for subscriber_id, send_queue in send_queues:
+                    if(send_queue.broken and self.send_queues.get(subscriber_id) is send_queue):
+                        self._remove_tcp_subscriber(subscriber_id)
+
+                self.writer_selector.select()
+
+        def _create_udp_server(self):
+            '''
+            If the publisher is has a udp protocol, then create a udp socket server.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.queue_size*self.message_format.size)
+
+
+        def _create_multicast_server(self, interface_ip):
+            '''
+            If the publisher has a udp_multicast protocol, then create a udp socket
+            sending to the multicast group of the topic (the ip and port of the publisher).
+
+            Parameters:
+                interface_ip: The ip address of the interface to send from.
+            Returns:
+                N/A
+            '''
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.queue_size*self.message_format.size)
+            self.server_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+
+            #Subscribers on the same host receive the messages as well.
+            self.server_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        def _create_shm_server(self):
+            '''
+            If the publisher has a shm protocol, then create the shared memory ring
+            buffer holding the last queue_size messages and a udp socket to wake up
+            subscribers waiting for new messages. The ring is limited to
+            SHM_MAX_RING_SIZE bytes, but always holds at least two messages.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            slot_size = max(self.message_format.size, 1)
+            slot_count = max(2, min(self.queue_size, SHM_MAX_RING_SIZE // slot_size))
+            self.ring = Shared_Memory_Ring(ring_name(self.id), slot_count=slot_count, slot_size=slot_size)
+
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.setblocking(False)
+
+        def publish(self, message):
+            '''
+            Publish a message to the topic of the subscriber. The message must
+            be of the type that the message_format object will pack and unpack.
+            For example, if the message_format is type simple_messages.bool.Bool(),
+            then a boolean value must be passed.
+
+            Parameters:
+                message: A message that matches the type described in the message format
+                         object passed to the publisher.
+
+            Returns
+                N/A
+            '''
+
+            self.stats.messages += 1
+
+            #Hand the message to subscribers of the same node.
+            if(not self._publish_local(message)):
+                return
+
+            #Pack the message as bytes using the message format packer.
+            message_encoded = self.message_format._pack(message)
+            self.stats.bytes += len(message_encoded)
+            if(self.coalesce_delay is not None):
+                self._coalesce([message_encoded])
+            else:
+                self._send([message_encoded])
+
+        def publish_many(self, messages):
+            '''
+            Publish several messages to the topic at once. The messages are sent
+            to the subscribers of other nodes in as few datagrams or socket writes
+            as possible instead of one for each message.
+
+            Parameters:
+                messages: A list of messages that match the type described in the
+                        message format object passed to the publisher.
+            Returns:
+                N/A
+            '''
+            messages_encoded = [self.message_format._pack(message) for message in messages \
+                                    if self._publish_local(message)]
+            self.stats.messages += len(messages)
+            if(not messages_encoded):
+                return
+            self.stats.bytes += sum(len(message_encoded) for message_encoded in messages_encoded)
+
+            if(self.coalesce_delay is not None):
+                self._coalesce(messages_encoded)
+            else:
+                self._send(messages_encoded)
+
+        def flush(self):
+            '''
+            Send the messages held back by a coalescing publisher right away.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            with self.batch_condition:
+                if(self.batch):
+                    self._send(self._take_batch())
+
+        def _send(self, messages_encoded):
+            '''
+            Send packed messages to the subscribers on other nodes.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                N/A
+            '''
+            if(self.protocol == 'tcp'):
+                self._send_tcp([self._frame(message_encoded) for message_encoded in messages_encoded])
+
+            elif(self.protocol == 'udp'):
+                self._send_udp(messages_encoded)
+
+            elif(self.protocol == 'udp_multicast'):
+                self._send_multicast(messages_encoded)
+
+            elif(self.protocol == 'shm'):
+                self._send_shm(messages_encoded)
+
+        def _coalesce(self, messages_encoded):
+            '''
+            Hold back packed messages to be sent together with the next ones. The
+            messages held back are sent once they reach coalesce_size bytes, or by
+            the coalescing thread once the oldest has waited coalesce_delay seconds.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                N/A
+            '''
+            with self.batch_condition:
+                if(not self.batch):
+                    self.batch_deadline = time.monotonic() + self.coalesce_delay
+                    self.batch_condition.notify()
+                self.batch.extend(messages_encoded)
+                self.batch_size += sum(FRAME_HEADER.size + len(message_encoded) \
+                                        for message_encoded in messages_encoded)
+
+                #Sending with the lock held keeps the batches in order.
+                if(self.batch_size >= self.coalesce_size):
+                    self._send(self._take_batch())
+
+        def _take_batch(self):
+            '''
+            Empty the messages held back. Called with the batch condition held.
+
+            Parameters:
+                N/A
+            Returns:
+                messages_encoded: The list of packed messages that were held back.
+            '''
+            messages_encoded = self.batch
+            self.batch = []
+            self.batch_size = 0
+            return messages_encoded
+
+        def _coalesce_loop(self):
+            '''
+            COALESCING THREAD
+
+            Send the messages held back once the oldest of them has waited
+            coalesce_delay seconds.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            with self.batch_condition:
+                while(self.run_coalescer):
+                    if(not self.batch):
+                        self.batch_condition.wait()
                         continue
-                    except:
+
+                    remaining = self.batch_deadline - time.monotonic()
+                    if(remaining > 0):
+                        self.batch_condition.wait(remaining)
                         continue
 
+                    try:
+                        self._send(self._take_batch())
+                    except (OSError, ValueError) as e:
+                        print("[ERROR]: Could not send the coalesced messages of %s: %s" % (self.topic, e))
+
+        def _stop_coalescer(self):
+            '''
+            Send the messages held back and stop the coalescing thread.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            with self.batch_condition:
+                if(self.batch):
+                    self._send(self._take_batch())
+                self.run_coalescer = False
+                self.batch_condition.notify_all()
+
+        def _publish_local(self, message):
+            '''
+            Hand a message to the subscribers on the same node as the publisher.
+
+            Parameters:
+                message: The message being published.
+            Returns:
+                remote: True if there are subscribers on other nodes that the message
+                        still needs to be packed and sent to.
+            '''
+            if(self.local_subscribers):
+                for subscriber in list(self.local_subscribers.values()):
+                    if(self.local_copy):
+                        subscriber._deliver_local(copy.deepcopy(message), self.id)
+                    else:
+                        subscriber._deliver_local(message, self.id)
+
+                #Skip packing when there are no subscribers on other nodes.
+                if(not (self.subscriber_tcp_connections or self.subscriber_udp_connections or \
+                        self.subscriber_shm_connections or self.subscriber_multicast_connections)):
+                    return False
+            return True
+
+        def _frame(self, message_encoded):
+            '''
+            Frame a packed message so a tcp subscriber can find where it ends.
+
+            Parameters:
+                message_encoded: The packed message.
+            Returns:
+                message_frame: The frame header followed by the packed message.
+            '''
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            return FRAME_HEADER.pack(len(message_encoded), self.sequence) + message_encoded
+
+        def _send_tcp(self, message_frames):
+            '''
+            Put framed messages in the send queue of every tcp subscriber. The
+            writer thread does the actual sending.
+
+            Parameters:
+                message_frames: A list of framed messages.
+            Returns:
+                N/A
+            '''
+            with self.send_condition:
+                for send_queue in list(self.send_queues.values()):
+                    for message_frame in message_frames:
+
+                        if(self.overflow == "block"):
+                            while(send_queue.full() and not send_queue.broken and self.run_writer and \
+                                    send_queue in self.send_queues.values()):
+
+                                #The writer thread may be waiting for the frames
+                                #already queued by this call.
+                                self._wake_writer()
+                                self.send_condition.wait()
+
+                        send_queue.put(message_frame)
+
+                self._wake_writer()
+
+        def _datagrams(self, messages_encoded):
+            '''
+            Frame packed messages and pack the frames into as few datagrams as
+            possible, each at most UDP_BATCH_SIZE bytes. A message that does not
+            fit in a datagram is split into fragments of UDP_FRAGMENT_SIZE bytes,
+            one datagram each.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                datagrams: A list of datagrams, each a list of the buffers to send
+                            as one datagram.
+            '''
+            datagrams = []
+            buffers = []
+            datagram_size = 0
+            for message_encoded in messages_encoded:
+                frame_size = FRAME_HEADER.size + len(message_encoded)
+                if(buffers and (datagram_size + frame_size > UDP_BATCH_SIZE or \
+                                len(buffers) + 2 > MAX_SEND_BUFFERS)):
+                    datagrams.append(buffers)
+                    buffers = []
+                    datagram_size = 0
+
+                self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+                if(frame_size > UDP_BATCH_SIZE):
+                    message_view = memoryview(message_encoded).cast('B')
+                    for offset in range(0, len(message_view), UDP_FRAGMENT_SIZE):
+                        fragment = message_view[offset:offset + UDP_FRAGMENT_SIZE]
+                        datagrams.append([FRAME_HEADER.pack(FRAGMENT_FLAG | len(fragment), self.sequence),
+                                          FRAGMENT_HEADER.pack(len(message_view), offset), fragment])
+                    continue
+
+                buffers.append(FRAME_HEADER.pack(len(message_encoded), self.sequence))
+                buffers.append(message_encoded)
+                datagram_size += frame_size
+
+            if(buffers):
+                datagrams.append(buffers)
+            return datagrams
+
+        def _send_datagram(self, buffers, address):
+            '''
+            Send buffers as one datagram, gathered by sendmsg where it is available.
+
+            Parameters:
+                buffers: The list of buffers of the datagram.
+                address: The (ip, port) to send the datagram to.
+            Returns:
+                N/A
+            '''
+            if(HAS_SENDMSG):
+                self.server_socket.sendmsg(buffers, (), 0, address)
+            else:
+                self.server_socket.sendto(b''.join(buffers), address)
+
+        def _send_udp(self, messages_encoded):
+            '''
+            Send packed messages to every udp subscriber.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                N/A
+            '''
+            datagrams = self._datagrams(messages_encoded)
+
+            subscriber_connections = list(self.subscriber_udp_connections.keys()).copy()
+            for subscriber_id in subscriber_connections:
+                try:
+                    [subscriber_ip, subscriber_port] = self.subscriber_udp_connections[subscriber_id]
+
+                    for buffers in datagrams:
+                        self._send_datagram(buffers, (subscriber_ip, subscriber_port))
+
+                #The subscriber was removed while sending.
+                except KeyError:
+                    continue
+
+                #Udp delivery is best effort, a subscriber that can't be reached
+                #must not stop the others from being sent to.
+                except socket.error as e:
+                    self.stats.send_errors += 1
+                    continue
+
+        def _send_multicast(self, messages_encoded):
+            '''
+            Send packed messages once to the multicast group of the topic.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                N/A
+            '''
+            if(not self.subscriber_multicast_connections):
+                return
+            try:
+                for buffers in self._datagrams(messages_encoded):
+                    self._send_datagram(buffers, (self.ip, self.port))
+            except socket.error as e:
+                self.stats.send_errors += 1
+
+        def _send_shm(self, messages_encoded):
+            '''
+            Write packed messages to the ring buffer and wake up the shm subscribers
+            waiting for them.
+
+            Parameters:
+                messages_encoded: A list of packed messages.
+            Returns:
+                N/A
+            '''
+            #The ring was closed when the publisher was killed.
+            if(self.ring.buffer is None):
+                return
+
+            for message_encoded in messages_encoded:
+                last_sequence = self.ring.write(message_encoded)
+            sequence = last_sequence - len(messages_encoded) + 1
+
+            subscriber_connections = list(self.subscriber_shm_connections.keys()).copy()
+            for subscriber_id in subscriber_connections:
+                try:
+                    [subscriber_ip, subscriber_port, cursor_index] = self.subscriber_shm_connections[subscriber_id]
+
+                    #Only wake up subscribers that have read everything before this
+                    #message. The others are still reading and will find it.
+                    if(self.ring.cursor_sequence(cursor_index) >= sequence - 1):
+                        self.server_socket.sendto(b'\x00', (subscriber_ip, subscriber_port))
+
+                #The subscriber was removed while sending.
+                except KeyError:
+                    continue
+                except socket.error as e:
+                    self.stats.send_errors += 1
+                    continue
+
     class Subscriber(threading.Thread):
         '''
         Subscriber is a tcp/udp data receiver that receives data from publishers based on a
         a topic name. The subscriber will be registered with mechoscore through the mechoscore XMLRPC server and will be connected to subscriber
         throught the Node XMLRPC server.
         '''
-        def __init__(self, topic, message_format, callback, queue_size, ip, port, protocol):
+        def __init__(self, topic, message_format, callback, queue_size, ip, port, protocol, conflate=False,
+                        threaded=False, overflow="drop_oldest", executor=None, callback_group=None):
             '''
             Create either a tcp or udp subscriber to the following topci
 
@@ -576,6 +2075,18 @@ class Node:
                             data it receives to.
                 queue_size: The maximum amount of messages the receive socket buffer should queue up
                 protocol: Either tcp or udp protocol
+                conflate: Default False. If True, only the newest message received from
+                        each publisher is passed to the callback.
+                threaded: Default False. If True, messages are received by the thread of
+                        the subscriber and put in its inbox until the node is spun.
+                overflow: Default "drop_oldest". The policy of the inbox of a threaded
+                        subscriber when it is full. Either "drop_oldest", "drop_newest"
+                        or "block".
+                executor: Default None. The executor running the callback, see
+                        callback_executors. None calls it in the thread receiving
+                        the messages.
+                callback_group: Default None. The Callback_Group of the callback. None
+                        gives the subscriber a mutually exclusive group of its own.
             '''
 
             #Initialize base thread class
@@ -585,6 +2096,7 @@ class Node:
             self.protocol = protocol
             self.callback = callback
             self.queue_size = queue_size
+            self.conflate = conflate
 
             self.message_format = message_format
 
@@ -602,6 +2114,82 @@ class Node:
             self.publisher_tcp_connections = {}
             self.publisher_udp_connections = {}
 
+            #A dictionary where the key is the unique id of a tcp publisher and
+            #the value is the Frame_Receiver reassembling its messages.
+            self.frame_receivers = {}
+
+            #A dictionary where the key is the unique id of a shm publisher and
+            #the value is its ring buffer and the index of this subscriber's cursor.
+            self.publisher_shm_connections = {}
+
+            #Udp socket that shm publishers send a byte to when they write a message.
+            self.doorbell_socket = None
+
+            #Reusable buffer that udp datagrams are received into, and the messages
+            #being reassembled from their fragments.
+            self.datagram_buffer = None
+            self.datagram_view = None
+            self.fragment_buffer = None
+
+            #The sequence number of the last message received from the address of
+            #each udp publisher, to count the messages lost before the next one.
+            self.udp_sequences = {}
+
+            #Counters of the messages received, see topic_stats.
+            self.stats = Topic_Stats()
+
+            #A dictionary where the key is the unique id of a udp_multicast publisher
+            #and the value is its multicast group and port, and the socket that
+            #joined the group of the topic.
+            self.publisher_multicast_connections = {}
+            self.multicast_socket = None
+
+            #Messages handed over by publishers of the same node. The oldest message
+            #is dropped once queue_size messages are waiting. A conflating subscriber
+            #only keeps the newest message of each publisher.
+            if(conflate):
+                self.local_inbox = collections.OrderedDict()
+            else:
+                self.local_inbox = collections.deque(maxlen=queue_size)
+            self.local_inbox_lock = threading.Lock()
+
+            #Socket of the node to send a byte to when the local inbox gets a message.
+            self.wakeup_socket = None
+
+            #A threaded subscriber watches its sockets with its own selector and
+            #puts the messages it receives in its inbox instead of passing them to
+            #the callback. The node passes them on to the callback when it is spun.
+            if(overflow not in ("drop_oldest", "drop_newest", "block")):
+                raise ValueError("Unknown overflow policy %s" % overflow)
+            self.threaded = threaded
+            self.overflow = overflow
+            self.inbox = collections.deque()
+            self.inbox_condition = threading.Condition()
+            self.selector = None
+
+            #The executor runs the callback under the callback group. An executor
+            #that takes packed messages gets them through encoded_callback, so the
+            #subscriber never unpacks them.
+            if(executor is None):
+                executor = Single_Threaded_Executor()
+            if(callback_group is None):
+                callback_group = Callback_Group()
+            self.executor = executor
+            self.callback_group = callback_group
+            self.dispatch_callback = executor.dispatcher(callback, callback_group, self.stats)
+            self.encoded_callback = executor.encoded_dispatcher(callback, callback_group, message_format, self.stats)
+            self.inbox_callback = self.dispatch_callback
+            self.callback = self.dispatch_callback
+
+            if(threaded):
+                self.selector = selectors.DefaultSelector()
+                self.callback = self._put_inbox
+
+                #The inbox holds the packed messages for an executor that takes them.
+                if(self.encoded_callback is not None):
+                    self.inbox_callback = self.encoded_callback
+                    self.encoded_callback = lambda message_encoded: self._put_inbox(bytes(message_encoded))
+
         def _connect_to_tcp_publisher(self, publisher_id, publisher_ip, publisher_port):
             '''
             Connect to a tcp publisher when notified by mechoscore that there is a publisher that
@@ -618,12 +2206,19 @@ class Node:
             sub_socket.bind((self.ip, self.port))
             sub_socket.connect((publisher_ip, publisher_port))
 
+            #Tell the publisher which subscriber the connection belongs to.
+            sub_socket.sendall(TCP_HANDSHAKE.pack(bytes.fromhex(self.id)))
+
             #Set socket to non-blocking
             sub_socket.setblocking(False)
 
             #Keep track of a socket connection to a publisher.
             self.publisher_tcp_connections[publisher_id] = sub_socket
 
+            frame_size = FRAME_HEADER.size + self.message_format.size
+            buffer_size = max(frame_size, min(self.queue_size*frame_size, MAX_FRAME_BUFFER_SIZE))
+            self.frame_receivers[publisher_id] = Frame_Receiver(buffer_size)
+
         def _connect_to_udp_publisher(self, publisher_id, publisher_ip, publisher_port):
             '''
             Connect to a udp publisher by looking to receive messages from the publishers ip and port.
@@ -643,85 +2238,1093 @@ class Node:
             self.publisher_udp_connections[publisher_id] = [sub_socket, publisher_ip, publisher_port]
 
 
-        def _receive(self):
+        def _connect_to_shm_publisher(self, publisher_id, publisher_ip, publisher_port):
+            '''
+            Attach to the shared memory ring buffer of a shm publisher on the same host.
+            The publisher must already have given this subscriber a read cursor.
+
+            Parameters:
+                publisher_id: The unique id of the publisher to read from.
+                publisher_ip: The ip address of the publisher.
+                publisher_port: The port of the publisher.
+            Returns:
+                N/A
             '''
-            For each socket connected to a publisher, try to receive any data
-            if possible.
+            try:
+                ring = Shared_Memory_Ring(ring_name(publisher_id))
+            except OSError as exception:
+                #The ring only exists on the host of the publisher.
+                print("[ERROR]: Could not attach to the shm publisher on topic %s: %s" % (self.topic, exception))
+                return
+            cursor_index = ring.find_cursor(self.id)
+            if(cursor_index is None):
+                print("[ERROR]: Shm publisher on topic %s did not give a cursor to the subscriber" % self.topic)
+                ring.close()
+                return
+
+            self.publisher_shm_connections[publisher_id] = [ring, cursor_index]
+
+        def _create_doorbell(self):
+            '''
+            Create the udp socket shm publishers send a byte to when they write a
+            message. It is bound to a port picked by the os, which becomes the port
+            of the subscriber registered with mechoscore.
 
             Parameters:
                 N/A
             Returns:
                 N/A
             '''
-            if(self.protocol == "tcp"):
+            self.doorbell_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.doorbell_socket.bind((self.ip, 0))
+            self.doorbell_socket.setblocking(False)
+            self.port = self.doorbell_socket.getsockname()[1]
 
-                for publisher_id in self.publisher_tcp_connections.keys():
-                    try:
+        def _connect_to_multicast_publisher(self, publisher_id, group, port):
+            '''
+            Join the multicast group a udp_multicast publisher sends to. Every
+            publisher of a topic sends to the same group, so it is only joined once.
 
+            Parameters:
+                publisher_id: The unique id of the publisher.
+                group: The multicast group address of the topic.
+                port: The port of the multicast group.
+            Returns:
+                N/A
+            '''
+            if(self.multicast_socket is None):
+                sub_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-                        message_encoded = self.publisher_tcp_connections[publisher_id].recv(self.message_format.size)
+                #Other subscribers of the topic on this host use the same port.
+                sub_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sub_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.queue_size*self.message_format.size)
+                sub_socket.bind(('', port))
+                sub_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                    socket.inet_aton(group) + socket.inet_aton(self.ip))
+                sub_socket.setblocking(False)
+                self.multicast_socket = sub_socket
 
-                        if(not message_encoded):
-                            continue
+            self.publisher_multicast_connections[publisher_id] = [group, port]
 
-                        message = self.message_format._unpack(message_encoded)
-                        self.callback(message)
+        def run(self):
+            '''
+            SUBSCRIBER THREAD
 
+            Receive messages from the sockets of a threaded subscriber as soon as
+            they arrive and put them in the inbox.
 
-                    except socket.error as e:
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            while(self.run_thread):
+                try:
+                    events = self.selector.select(0.1)
+                except (OSError, ValueError) as e:
+                    time.sleep(0.1)
+                    continue
+
+                for key, mask in events:
+                    try:
+                        connected = self._receive(key.data, key.fileobj)
+                    except (OSError, ValueError, struct.error) as e:
+                        print("[ERROR]: Subscriber of %s could not receive a message: %s" % (self.topic, e))
                         continue
 
-            elif(self.protocol == "udp"):
-
+                    #A closed tcp connection stays readable forever, so stop watching it.
+                    if(not connected):
+                        self._unwatch_socket(key.fileobj)
 
-                for publisher_id in self.publisher_udp_connections.keys():
+        def _stop_receiving(self):
+            '''
+            Stop the receive thread of a threaded subscriber and wait for it to exit.
 
-                    try:
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            with self.inbox_condition:
+                self.run_thread = False
+                self.inbox_condition.notify_all()
+            if(self.is_alive() and self is not threading.current_thread()):
+                self.join(1.0)
+            self.selector.close()
+
+        def _watch_socket(self, sub_socket, publisher_id):
+            '''
+            Have the receive thread of a threaded subscriber watch a socket.
 
-                        message_encoded, _ = self.publisher_udp_connections[publisher_id][0].recvfrom(self.message_format.size)
+            Parameters:
+                sub_socket: The socket connected to the publisher.
+                publisher_id: The unique id of the publisher the socket receives from.
+            Returns:
+                N/A
+            '''
+            self.selector.register(sub_socket, selectors.EVENT_READ, publisher_id)
 
-                        if(not message_encoded):
-                            continue
+        def _unwatch_socket(self, sub_socket):
+            '''
+            Stop the receive thread of a threaded subscriber from watching a socket.
 
-                        message = self.message_format._unpack(message_encoded)
-                        self.callback(message)
+            Parameters:
+                sub_socket: The socket to stop watching.
+            Returns:
+                watched: True if the socket was being watched.
+            '''
+            try:
+                self.selector.unregister(sub_socket)
+            except (KeyError, ValueError, RuntimeError):
+                return False
+            return True
 
-                    except socket.error as e:
-                        continue
-                    except:
-                        continue
+        def _put_inbox(self, message):
+            '''
+            SUBSCRIBER THREAD
 
-class Parameter_Server_Client():
-    '''
-    This creates an object that is a client to the parameter server running on
-    mechoscore.
-    '''
-    def __init__(self, ip=None, port=None):
-        '''
-        Initialize Parameter server for XMLRPCServer client.
-        Parameters:
-            ip: The ip address to host the XMLRPCServer. Default "http://127.0.0.101"
-            port: The port to host the XMLRPCServer. Default 8000
-        Returns:
-            N/A
-        '''
-        if ip == None:
-            ip = "127.0.0.1"
+            Put a received message in the inbox of a threaded subscriber, applying
+            the overflow policy when it is full.
+
+            Parameters:
+                message: The received message.
+            Returns:
+                N/A
+            '''
+            with self.inbox_condition:
+                if(len(self.inbox) >= self.queue_size):
+                    if(self.overflow == "drop_newest"):
+                        self.stats.drops += 1
+                        return
+                    elif(self.overflow == "block"):
+                        while(len(self.inbox) >= self.queue_size and self.run_thread):
+                            self.inbox_condition.wait()
+                    else:
+                        self.inbox.popleft()
+                        self.stats.drops += 1
+                wakeup = not self.inbox
+                self.inbox.append(message)
+
+            #Only wake up the node when the inbox goes from empty to not empty.
+            if(wakeup and self.wakeup_socket is not None):
+                try:
+                    self.wakeup_socket.send(b'\x00')
+                except socket.error as e:
+                    pass
+
+        def _dispatch_inbox(self):
+            '''
+            Pass the messages in the inbox of a threaded subscriber to the callback.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            while(1):
+                with self.inbox_condition:
+                    if(not self.inbox):
+                        break
+                    message = self.inbox.popleft()
+
+                    #Let a receive thread blocked on the full inbox continue.
+                    if(self.overflow == "block"):
+                        self.inbox_condition.notify()
+                self.inbox_callback(message)
+
+        def _receive_encoded(self, message_encoded):
+            '''
+            Pass a packed message received from a publisher on, unpacked unless the
+            executor takes packed messages.
+
+            Parameters:
+                message_encoded: The bytes-like packed message. It may be a view of a
+                                receive buffer that is reused afterwards.
+            Returns:
+                N/A
+            '''
+            self.stats.messages += 1
+            self.stats.bytes += len(message_encoded)
+            if(self.encoded_callback is not None):
+                self.encoded_callback(message_encoded)
+            else:
+                #A malformed message only loses itself, not the rest of the spin.
+                try:
+                    message = self.message_format._unpack(message_encoded)
+                except Exception as e:
+                    print("[ERROR]: Subscriber of %s dropped a message it could not unpack: %s" % (self.topic, e))
+                    return
+                self.callback(message)
+
+        def _deliver_local(self, message, publisher_id=None):
+            '''
+            Put a message from a publisher on the same node in the local inbox.
+
+            Parameters:
+                message: The message object published.
+                publisher_id: Default None. The unique id of the publisher.
+            Returns:
+                N/A
+            '''
+            self.stats.messages += 1
+            with self.local_inbox_lock:
+                wakeup = not self.local_inbox
+                if(self.conflate):
+                    self.local_inbox[publisher_id] = message
+                else:
+                    if(len(self.local_inbox) == self.queue_size):
+                        self.stats.drops += 1
+                    self.local_inbox.append(message)
+
+            #Only wake up the node when the inbox goes from empty to not empty.
+            if(wakeup and self.wakeup_socket is not None):
+                try:
+                    self.wakeup_socket.send(b'\x00')
+                except socket.error as e:
+                    pass
+
+        def _receive(self, publisher_id, sub_socket):
+            '''
+            Receive data from a socket connected to a publisher that the node
+            selector reported as readable. For tcp, every complete message
+            waiting on the socket is passed to the callback. For udp, every
+            message in the datagram received is. A conflating subscriber receives
+            everything waiting and only passes the newest message of each
+            publisher to the callback.
+
+            Parameters:
+                publisher_id: The unique id of the publisher the socket receives from.
+                sub_socket: The readable socket connected to the publisher.
+            Returns:
+                connected: False if the publisher closed the connection, otherwise True.
+            '''
+            if(self.protocol == "tcp"):
+                return self._receive_tcp(publisher_id, sub_socket)
+
+            elif(self.protocol == "shm"):
+                return self._receive_shm(sub_socket)
+
+            return self._receive_udp(sub_socket)
+
+        def _receive_udp(self, sub_socket):
+            '''
+            Receive a datagram from a udp socket and pass every message in it to the
+            callback. A conflating subscriber receives every datagram waiting instead.
+
+            Parameters:
+                sub_socket: The readable udp socket.
+            Returns:
+                connected: Always True since there is no connection to close.
+            '''
+            #Datagrams are received into one reusable buffer. Publishers never
+            #send datagrams larger than UDP_BATCH_SIZE.
+            if(self.datagram_buffer is None):
+                self.datagram_buffer = bytearray(UDP_BATCH_SIZE)
+                self.datagram_view = memoryview(self.datagram_buffer)
+
+            #The newest message from the address of each publisher.
+            latest = {}
+            while(1):
+                try:
+                    num_bytes, address = sub_socket.recvfrom_into(self.datagram_buffer)
+                except socket.error as e:
+                    break
+
+                message_encoded = None
+                for message_encoded in self._datagram_messages(address, num_bytes):
+                    if(not self.conflate):
+                        self._receive_encoded(message_encoded)
+
+                if(not self.conflate):
+                    break
+
+                #The datagram buffer is reused by the next datagram.
+                if(isinstance(message_encoded, memoryview)):
+                    latest[address] = bytes(message_encoded)
+                elif(message_encoded is not None):
+                    latest[address] = message_encoded
+
+            for message_encoded in latest.values():
+                self._receive_encoded(message_encoded)
+            return True
+
+        def _datagram_messages(self, address, num_bytes):
+            '''
+            Iterate over the messages in the datagram buffer. A fragment is added to
+            the message it belongs to, which is given once all its fragments arrived.
+
+            Parameters:
+                address: The address of the publisher that sent the datagram.
+                num_bytes: The number of bytes of the datagram.
+            Returns:
+                messages_encoded: A generator of the packed messages, as memoryviews
+                        of the datagram buffer or bytearrays of reassembled messages.
+            '''
+            position = 0
+            while(num_bytes - position >= FRAME_HEADER.size):
+                payload_length, sequence = FRAME_HEADER.unpack_from(self.datagram_buffer, position)
+                position += FRAME_HEADER.size
+
+                if(payload_length & FRAGMENT_FLAG):
+                    message_encoded = self._receive_fragment(address, sequence, payload_length & ~FRAGMENT_FLAG,
+                                                            position, num_bytes)
+                    if(message_encoded is not None):
+                        self._count_lost(address, sequence)
+                        yield message_encoded
+                    return
+
+                if(position + payload_length > num_bytes):
+                    return
+
+                self._count_lost(address, sequence)
+                yield self.datagram_view[position:position + payload_length]
+                position += payload_length
+
+        def _count_lost(self, address, sequence):
+            '''
+            Count the udp messages lost before a message from the gap between its
+            sequence number and the one of the last message from its publisher.
+            A message whose fragments did not all arrive is counted as lost too.
+
+            Parameters:
+                address: The address of the publisher that sent the message.
+                sequence: The sequence number of the message.
+            Returns:
+                N/A
+            '''
+            last_sequence = self.udp_sequences.get(address)
+            if(last_sequence is not None):
+                lost = (sequence - last_sequence - 1) & 0xFFFFFFFF
+
+                #The message arrived out of order or twice.
+                if(lost & 0x80000000):
+                    return
+                self.stats.drops += lost
+            self.udp_sequences[address] = sequence
+
+        def _receive_fragment(self, address, sequence, fragment_length, position, num_bytes):
+            '''
+            Add a fragment in the datagram buffer to the message it belongs to.
+
+            Parameters:
+                address: The address of the publisher that sent the datagram.
+                sequence: The sequence number of the message.
+                fragment_length: The number of bytes of the fragment.
+                position: The offset of the fragment header in the datagram buffer.
+                num_bytes: The number of bytes of the datagram.
+            Returns:
+                message_encoded: The bytearray of the message once all its fragments
+                        arrived, otherwise None.
+            '''
+            if(num_bytes - position < FRAGMENT_HEADER.size + fragment_length):
+                return None
+            message_length, offset = FRAGMENT_HEADER.unpack_from(self.datagram_buffer, position)
+            position += FRAGMENT_HEADER.size
+
+            if(self.fragment_buffer is None):
+                self.fragment_buffer = Fragment_Buffer(self.message_format.size)
+
+            return self.fragment_buffer.add(address, sequence, message_length, offset,
+                                            self.datagram_view[position:position + fragment_length])
+
+        def _receive_shm(self, doorbell_socket):
+            '''
+            Clear the wake up bytes sent to the doorbell socket and pass every new
+            message in the ring buffer of each shm publisher to the callback.
+
+            Parameters:
+                doorbell_socket: The readable doorbell socket of the subscriber.
+            Returns:
+                connected: Always True since the doorbell socket is never closed by
+                            a publisher.
+            '''
+            while(1):
+                try:
+                    doorbell_socket.recv(64)
+                except socket.error as e:
+                    break
+
+            for publisher_id in list(self.publisher_shm_connections.keys()):
+                [ring, cursor_index] = self.publisher_shm_connections[publisher_id]
+
+                if(self.conflate):
+                    message_encoded = ring.read_latest(cursor_index)
+                    if(message_encoded is not None):
+                        self._receive_encoded(message_encoded)
+                    continue
+
+                for message_encoded in ring.read_new(cursor_index):
+                    self._receive_encoded(message_encoded)
+
+                #Messages the publisher overwrote before they could be read.
+                if(ring.dropped):
+                    self.stats.drops += ring.dropped
+                    ring.dropped = 0
+
+            return True
+
+        def _receive_tcp(self, publisher_id, sub_socket):
+            '''
+            Drain a tcp socket connected to a publisher, passing every complete
+            message to the callback, or only the last one if the subscriber conflates.
+
+            Parameters:
+                publisher_id: The unique id of the publisher the socket receives from.
+                sub_socket: The readable socket connected to the publisher.
+            Returns:
+                connected: False if the publisher closed the connection, otherwise True.
+            '''
+            frame_receiver = self.frame_receivers.get(publisher_id)
+            if(frame_receiver is None):
+                return False
+
+            latest = None
+            connected = True
+            while(1):
+                free_space = frame_receiver.free_space()
+                num_bytes = frame_receiver.receive(sub_socket)
+
+                if(num_bytes is None):
+                    break
+                if(num_bytes == 0):
+                    connected = False
+                    break
+
+                if(self.conflate):
+                    message_encoded = frame_receiver.latest_frame()
+                    if(message_encoded is not None):
+                        latest = message_encoded
+                else:
+                    for message_encoded in frame_receiver.frames():
+                        self._receive_encoded(message_encoded)
+
+                #A short read means the socket has been drained.
+                if(num_bytes < free_space):
+                    break
+
+            if(latest is not None):
+                self._receive_encoded(latest)
+            return connected
+
+class AsyncNode(Node):
+    '''
+    An AsyncNode is a Node for asyncio programs. Registration with mechoscore is
+    done in a background thread so it never blocks the event loop, and subscriber
+    sockets are watched by the event loop's reader callbacks instead of spin_once.
+    Publishers are published to with "await pub.publish(message)" and subscribers
+    are read with "async for message in sub".
+    '''
+    def __init__(self, name, node_ip='127.0.0.1', mechoscore_ip='127.0.0.1', mechoscore_port=5959,
+                    mechoscore_control_port=None, executor=None):
+        '''
+        Initialize an asyncio node. The node registers itself with mechoscore the
+        first time a publisher or subscriber is created, or when register is awaited.
+
+        Parameters:
+            name: A unique name that any nodes in the network do no already have.
+            node_ip: Default '127.0.0.1': The ip of the node (and the xmlrpc server running on the node)
+            mechoscore_ip: Default '127.0.0.1'. The ip of mechsocore server.
+            mechoscore_port: Default 5959: The port of the mechoscore server.
+            mechoscore_control_port: Default None. If given, the node talks to mechoscore
+                        over persistent control connections to this port instead of xmlrpc.
+            executor: Default None. The executor running the callbacks of the subscribers,
+                        see Node. None calls each callback on the event loop.
+        '''
+        #The event loop is only known once a coroutine of the node runs.
+        self.loop = None
+        self.registered = False
+
+        #All the blocking xmlrpc calls to mechoscore are made one at a time from
+        #this thread, since an xmlrpc client can't be shared between threads.
+        self.control_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        Node.__init__(self, name, node_ip, mechoscore_ip, mechoscore_port, mechoscore_control_port, executor)
+
+    def _register_node(self):
+        '''
+        Registration of an AsyncNode is deferred until register is awaited.
+
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        return None
+
+    async def _call_control(self, function, *args, **kwargs):
+        '''
+        Run a blocking call that talks to mechoscore in the control thread.
+
+        Parameters:
+            function: The function to call.
+            args: The positional arguments of the function.
+            kwargs: The keyword arguments of the function.
+        Returns:
+            result: The value returned by the function.
+        '''
+        return await self.loop.run_in_executor(self.control_executor,
+                                    functools.partial(function, *args, **kwargs))
+
+    async def register(self):
+        '''
+        Register the node with mechoscore and start watching for messages that
+        publishers of this node deliver to its own subscribers. Only the first
+        call registers the node.
+
+        Parameters:
+            N/A
+        Returns:
+            allowable: False if a node with the same name already exists.
+        '''
+        if(self.registered):
+            return True
+
+        self.loop = asyncio.get_running_loop()
+        self.selector.unregister(self.wakeup_receiver)
+        self.loop.add_reader(self.wakeup_receiver, self._receive_local)
+
+        self.registered = await self._call_control(Node._register_node, self)
+        return self.registered
+
+    async def create_publisher(self, topic, message_format, queue_size=1000, ip=None, protocol="tcp", local_copy=True,
+                                overflow="drop_oldest", coalesce_delay=None, coalesce_size=UDP_BATCH_SIZE):
+        '''
+        Create either a tcp, udp or shm publisher and register it with mechoscore
+        without blocking the event loop. See Node.create_publisher for the parameters.
+
+        Returns:
+            publisher: The AsyncNode.Publisher created.
+        '''
+        await self.register()
+        return await self._call_control(Node.create_publisher, self, topic, message_format,
+                                    queue_size, ip, protocol, local_copy, overflow, coalesce_delay,
+                                    coalesce_size)
+
+    async def create_subscriber(self, topic, message_format, callback=None, queue_size=1000, ip=None, protocol="tcp",
+                                conflate=False, threaded=False, overflow="drop_oldest", callback_group=None):
+        '''
+        Create either a tcp, udp or shm subscriber and register it with mechoscore
+        without blocking the event loop. See Node.create_subscriber for the parameters.
+        If no callback is given, the received messages are read with
+        "async for message in subscriber".
+
+        Returns:
+            subscriber: The AsyncNode.Subscriber created.
+        '''
+        await self.register()
+        return await self._call_control(Node.create_subscriber, self, topic, message_format,
+                                    callback, queue_size, ip, protocol, conflate, threaded, overflow,
+                                    callback_group)
+
+    def _watch_subscriber_socket(self, sub_socket, subscriber, publisher_id):
+        '''
+        Add a reader callback for a subscriber socket to the event loop. This is
+        called from the xmlrpc server thread when mechoscore connects a publisher.
+
+        Parameters:
+            sub_socket: The socket of the subscriber connected to the publisher.
+            subscriber: The subscriber object that owns the socket.
+            publisher_id: The unique id of the publisher the socket receives from.
+        Returns:
+            N/A
+        '''
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sub_socket,
+                                    self._on_readable, sub_socket, subscriber, publisher_id)
+
+    def _unwatch_subscriber_socket(self, sub_socket):
+        '''
+        Remove the reader callback of a subscriber socket from the event loop and
+        wait for it to be removed, since the socket is closed right afterwards.
+
+        Parameters:
+            sub_socket: The socket of the subscriber to stop watching.
+        Returns:
+            N/A
+        '''
+        if(self._unwatch_threaded_socket(sub_socket)):
+            return
+
+        if(self.loop is None or self.loop.is_closed()):
+            return
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if(running_loop is self.loop):
+            self.loop.remove_reader(sub_socket)
+            return
+
+        removed = concurrent.futures.Future()
+        def remove_reader():
+            self.loop.remove_reader(sub_socket)
+            removed.set_result(True)
+        self.loop.call_soon_threadsafe(remove_reader)
+        try:
+            removed.result(timeout=1.0)
+        except concurrent.futures.TimeoutError:
+            pass
+
+    def _on_readable(self, sub_socket, subscriber, publisher_id):
+        '''
+        Event loop reader callback for a subscriber socket that has data waiting.
+
+        Parameters:
+            sub_socket: The readable socket.
+            subscriber: The subscriber object that owns the socket.
+            publisher_id: The unique id of the publisher the socket receives from.
+        Returns:
+            N/A
+        '''
+        connected = subscriber._receive(publisher_id, sub_socket)
+
+        #A closed tcp connection stays readable forever, so stop watching it.
+        if(not connected):
+            self.loop.remove_reader(sub_socket)
+
+    def spin_once(self, timeout=0.0):
+        '''
+        An AsyncNode receives its messages from the event loop, so there is
+        nothing to spin.
+        '''
+        raise RuntimeError("AsyncNode receives messages on its event loop and can't be spun")
+
+    def spin(self):
+        '''
+        An AsyncNode receives its messages from the event loop, so there is
+        nothing to spin.
+        '''
+        raise RuntimeError("AsyncNode receives messages on its event loop and can't be spun")
+
+    class Publisher(Node.Publisher):
+        '''
+        A publisher of an AsyncNode. Messages go into the send queues like for a
+        Node.Publisher; with the "block" overflow policy, publish waits on the event
+        loop for room in the queues instead of blocking it.
+        '''
+        def __init__(self, topic, message_format, queue_size, ip, port, protocol, local_copy=True,
+                        overflow="drop_oldest", coalesce_delay=None, coalesce_size=UDP_BATCH_SIZE):
+            '''
+            Create either a tcp, udp or shm publisher. See Node.Publisher for the
+            parameters.
+            '''
+            #Set by the writer thread when it frees room in the send queues, for
+            #publish calls waiting on the event loop. Created by the first wait,
+            #since only then is the event loop known.
+            self.room_event = None
+            self.room_loop = None
+
+            #Sending a full batch of coalesced messages may wait for room in the
+            #send queues, so a blocking tcp publisher hands its coalesced messages
+            #to this thread instead. A single thread keeps them in order.
+            self.coalesce_executor = None
+            if(protocol == "tcp" and overflow == "block" and coalesce_delay is not None):
+                self.coalesce_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+            Node.Publisher.__init__(self, topic, message_format, queue_size, ip, port, protocol, local_copy,
+                                    overflow, coalesce_delay, coalesce_size)
+
+        async def publish(self, message):
+            '''
+            Publish a message to the topic of the subscriber. The message must
+            be of the type that the message_format object will pack and unpack.
+
+            Parameters:
+                message: A message that matches the type described in the message format
+                         object passed to the publisher.
+            Returns:
+                N/A
+            '''
+            self.stats.messages += 1
+            if(not self._publish_local(message)):
+                return
+
+            message_encoded = self.message_format._pack(message)
+            self.stats.bytes += len(message_encoded)
+
+            if(self.coalesce_executor is not None):
+                await asyncio.get_running_loop().run_in_executor(self.coalesce_executor, self._coalesce,
+                                                                [message_encoded])
+                return
+
+            #Wait on the event loop instead of in _send_tcp for room in the
+            #send queues of subscribers that fell behind.
+            if(self.protocol == 'tcp' and self.overflow == "block"):
+                await self._wait_for_room()
+
+            if(self.coalesce_delay is not None):
+                self._coalesce([message_encoded])
+            else:
+                self._send([message_encoded])
+
+        async def publish_many(self, messages):
+            '''
+            Publish several messages to the topic at once. See Node.Publisher.publish_many.
+
+            Parameters:
+                messages: A list of messages that match the type described in the
+                        message format object passed to the publisher.
+            Returns:
+                N/A
+            '''
+            if(self.coalesce_executor is not None):
+                await asyncio.get_running_loop().run_in_executor(self.coalesce_executor,
+                                                        Node.Publisher.publish_many, self, messages)
+                return
+
+            if(self.protocol != 'tcp' or self.overflow != "block"):
+                Node.Publisher.publish_many(self, messages)
+                return
+
+            #Only publish as many messages at a time as every send queue has room
+            #for, so _send_tcp never waits for room on the event loop.
+            position = 0
+            while(position < len(messages)):
+                room = await self._wait_for_room()
+                Node.Publisher.publish_many(self, messages[position:position + room])
+                position += room
+
+        def _free_space(self):
+            '''
+            Get the number of frames every tcp send queue has room for.
+
+            Parameters:
+                N/A
+            Returns:
+                free_space: The smallest free space of the send queues, queue_size
+                            if there are none.
+            '''
+            return(min([send_queue.free_space() for send_queue in list(self.send_queues.values()) \
+                            if not send_queue.broken], default=self.queue_size))
+
+        async def _wait_for_room(self):
+            '''
+            Wait on the event loop until every tcp send queue has room for a frame.
+
+            Parameters:
+                N/A
+            Returns:
+                free_space: The number of frames every send queue has room for.
+            '''
+            while(1):
+                with self.send_condition:
+                    free_space = self._free_space()
+                    if(free_space > 0):
+                        return free_space
+                    if(self.room_event is None):
+                        self.room_loop = asyncio.get_running_loop()
+                        self.room_event = asyncio.Event()
+                    self.room_event.clear()
+                await self.room_event.wait()
+
+        def _stop_coalescer(self):
+            '''
+            Send the messages held back and stop the coalescing threads.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            if(self.coalesce_executor is not None):
+                self.coalesce_executor.shutdown(wait=True)
+            Node.Publisher._stop_coalescer(self)
+
+        def _room_freed(self):
+            '''
+            WRITER THREAD
+
+            Wake publish calls waiting on the event loop for room in the send
+            queues. Called with send_condition held.
+
+            Parameters:
+                N/A
+            Returns:
+                N/A
+            '''
+            Node.Publisher._room_freed(self)
+            if(self.room_event is None):
+                return
+            try:
+                self.room_loop.call_soon_threadsafe(self.room_event.set)
+            except RuntimeError:
+                #The event loop was closed.
+                pass
+
+    class Subscriber(Node.Subscriber):
+        '''
+        A subscriber of an AsyncNode. Received messages are passed to the callback
+        if one was given, otherwise they are put in an asyncio queue that is read
+        with "async for message in subscriber".
+        '''
+        def __init__(self, topic, message_format, callback, queue_size, ip, port, protocol, conflate=False,
+                        threaded=False, overflow="drop_oldest", executor=None, callback_group=None):
+            '''
+            Create either a tcp, udp or shm subscriber. See Node.Subscriber for the
+            parameters. If callback is None, the messages go to the subscriber queue,
+            which drops its oldest message once queue_size messages are waiting.
+            '''
+            if(callback is None):
+                callback = self._enqueue
+            Node.Subscriber.__init__(self, topic, message_format, callback, queue_size, ip, port, protocol, conflate,
+                                    threaded, overflow, executor, callback_group)
+
+            self.queue = asyncio.Queue(maxsize=queue_size)
+
+        def _enqueue(self, message):
+            '''
+            Put a received message in the subscriber queue.
+
+            Parameters:
+                message: The received message.
+            Returns:
+                N/A
+            '''
+            if(self.queue.full()):
+                self.queue.get_nowait()
+                self.stats.drops += 1
+            self.queue.put_nowait(message)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            return await self.queue.get()
+
+class Parameter_Server_Client():
+    '''
+    This creates an object that is a client to the parameter server running on
+    mechoscore.
+
+    Parameters under a prefix passed to subscribe are cached by the client. The
+    parameter server pushes every change to them, so get_param of a cached
+    parameter never leaves the process. The cache is only trusted while pushes
+    or heartbeats keep arriving. Once they stop, e.g. because the parameter
+    server dropped the client, the client subscribes again.
+    '''
+    def __init__(self, ip=None, port=None, control_port=None, client_ip='127.0.0.1'):
+        '''
+        Initialize Parameter server for XMLRPCServer client.
+        Parameters:
+            ip: The ip address to host the XMLRPCServer. Default "http://127.0.0.101"
+            port: The port to host the XMLRPCServer. Default 8000
+            control_port: Default None. If given, the parameter server is called over a
+                        persistent control connection to this port instead of xmlrpc.
+            client_ip: Default '127.0.0.1'. The ip address the parameter server pushes
+                        changes of subscribed parameters to.
+        Returns:
+            N/A
+        '''
+        if ip == None:
+            ip = "127.0.0.1"
 
         if port == None:
             port = 8000
 
-        self.client = xmlrpc.client.ServerProxy("http://" + ip + ":" + str(port))
-    def use_parameter_database(self, xml_file):
+        if(control_port is not None):
+            self.client = Control_Client((ip, control_port))
+        else:
+            self.client = xmlrpc.client.ServerProxy("http://" + ip + ":" + str(port))
+
+        self.id = str(uuid.uuid4().hex)
+        self.client_ip = client_ip
+
+        #Cache of the subscribed parameters and the version of the parameter
+        #database each was last changed in.
+        self.param_cache = {}
+        self.param_cache_versions = {}
+        self.param_cache_lock = threading.Lock()
+        self.param_callbacks = []
+
+        #The prefixes subscribed to, the time the last push arrived and the
+        #seconds after which the cache is no longer trusted without one.
+        self.param_prefixes = []
+        self.param_push_time = None
+        self.param_cache_timeout = None
+
+        #Control server the parameter server pushes changes to, created on the
+        #first subscribe.
+        self.callback_server = None
+
+    def subscribe(self, prefix, callback=None):
+        '''
+        Cache the parameters under a path prefix and keep them up to date with
+        changes pushed by the parameter server.
+        Parameters:
+            prefix: The parameter path prefix, e.g. 'PID/'. '' for every parameter.
+            callback: Default None. A function callback(param_path, parameter) called
+                        from a background thread on each change under the prefix.
+                        parameter is None if the path was removed.
+        Returns:
+            True
+        '''
+        if(self.callback_server is None):
+            self.callback_server = Control_Server((self.client_ip, 0))
+            self.callback_server.register_function(self._update_params)
+            threading.Thread(target=self.callback_server.serve_forever, daemon=True).start()
+
+        if(callback is not None):
+            self.param_callbacks.append((prefix.strip('/'), callback))
+
+        self._subscribe_prefix(prefix)
+        self.param_prefixes.append(prefix)
+        return True
+
+    def _subscribe_prefix(self, prefix):
+        '''
+        Ask the parameter server to push the changes under a prefix and cache the
+        current parameters under it.
+        Parameters:
+            prefix: The parameter path prefix.
+        Returns:
+            N/A
+        '''
+        result = self.client.subscribe_params(self.id, prefix, self.client_ip,
+                                        self.callback_server.server_address[1])
+        version, params = result[0], result[1]
+        if(len(result) > 2):
+            self.param_cache_timeout = 3*result[2]
+        self.param_push_time = time.monotonic()
+        self._update_cache(version, params, [])
+
+    def _resubscribe(self):
+        '''
+        Subscribe again to every prefix once the pushes stopped arriving. The
+        cache is emptied first, since changes may have been missed. If the
+        parameter server can't be reached, the cache stays empty and parameters
+        are asked from the server.
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        #Other threads getting parameters meanwhile don't subscribe again too, and
+        #a parameter server that can't be reached is only retried after a timeout.
+        self.param_push_time = time.monotonic()
+        with self.param_cache_lock:
+            self.param_cache = {}
+            self.param_cache_versions = {}
+        try:
+            for prefix in self.param_prefixes:
+                self._subscribe_prefix(prefix)
+        except (OSError, xmlrpc.client.Error) as e:
+            print("[WARNING]: Could not subscribe to parameters again: %s" % e)
+            with self.param_cache_lock:
+                self.param_cache = {}
+                self.param_cache_versions = {}
+
+    def _cache_stale(self):
+        '''
+        Check if the pushes stopped arriving, so the cache can't be trusted.
+        Parameters:
+            N/A
+        Returns:
+            stale: True if nothing was pushed for longer than the cache timeout.
+        '''
+        return(self.param_cache_timeout is not None and self.param_push_time is not None and \
+                time.monotonic() - self.param_push_time > self.param_cache_timeout)
+
+    def unsubscribe(self):
+        '''
+        Stop caching parameters.
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        self.client.unsubscribe_params(self.id)
+        with self.param_cache_lock:
+            self.param_cache = {}
+            self.param_cache_versions = {}
+        self.param_callbacks = []
+        self.param_prefixes = []
+        self.param_push_time = None
+        if(self.callback_server is not None):
+            self.callback_server.shutdown()
+            self.callback_server.server_close()
+            self.callback_server = None
+
+    def _update_cache(self, version, changes, removed):
+        '''
+        Apply changes to the cache unless they are older than what it holds.
+        Parameters:
+            version: The version of the parameter database with the changes.
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+        Returns:
+            updated: A list of (param_path, parameter) of the changes applied.
+        '''
+        updated = []
+        with self.param_cache_lock:
+            for param_path, parameter in changes.items():
+                if(version >= self.param_cache_versions.get(param_path, 0)):
+                    self.param_cache[param_path] = parameter
+                    self.param_cache_versions[param_path] = version
+                    updated.append((param_path, parameter))
+            for param_path in removed:
+                if(version >= self.param_cache_versions.get(param_path, 0)):
+                    self.param_cache.pop(param_path, None)
+                    self.param_cache_versions[param_path] = version
+                    updated.append((param_path, None))
+        return updated
+
+    def _update_params(self, version, changes, removed):
+        '''
+        CONTROL CALL FROM THE PARAMETER SERVER
+
+        Changes of subscribed parameters pushed by the parameter server.
+        Parameters:
+            version: The version of the parameter database with the changes.
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+        Returns:
+            True
+        '''
+        self.param_push_time = time.monotonic()
+        for param_path, parameter in self._update_cache(version, changes, removed):
+            for prefix, callback in self.param_callbacks:
+                if(prefix == '' or param_path == prefix or param_path.startswith(prefix + '/')):
+                    try:
+                        callback(param_path, parameter)
+                    except Exception as e:
+                        print("[ERROR]: Parameter callback failed on %s: %s" % (param_path, e))
+        return True
+
+    def use_parameter_database(self, xml_file, store="xml"):
         '''
         Sets the xml file to use for the parameter server to store and retreive
         data from.
         Parameters:
             xml_file: The xml file to save and get parameters from.
+            store: Default "xml". "xml" rewrites the xml file on every write. "log"
+                    appends changes to a log next to the xml file, so writes take
+                    the same time however large the database is.
         Returns:
             true
         '''
-        self.client.use_parameter_database(xml_file)
+        self.client.use_parameter_database(xml_file, store)
+
+    def import_parameters(self, xml_file):
+        '''
+        Set every parameter of an xml file, on the machine of the parameter
+        server, in the database.
+        Parameters:
+            xml_file: The xml file to import.
+        Returns:
+            True if the parameters were set.
+        '''
+        return self.client.import_parameters(xml_file)
+
+    def export_parameters(self, xml_file):
+        '''
+        Write the whole database to an xml file on the machine of the parameter server.
+        Parameters:
+            xml_file: The xml file to export to.
+        Returns:
+            True if the file was written.
+        '''
+        return self.client.export_parameters(xml_file)
 
     def set_param(self, param_path, parameter):
         '''
@@ -732,11 +3335,20 @@ class Parameter_Server_Client():
             param_path: The parameter path tree to set the given parameter. Note:
                         each level name should be spaced by a '/'.
                         Example 'PID/roll_pid/p'
-            parameter: The string representation of the parameter you want to set.
+            parameter: The parameter you want to set: a string, int, float, bool or
+                        a list of numbers, which may be nested for arrays of more than
+                        one dimension. It keeps its type when it is read back.
         Returns:
             N/A
         '''
-        self.client.set_param(param_path, parameter)
+        #Arrays and tuples are sent as lists, the way they are stored.
+        parameter = normalize_parameter(parameter)
+        allowable = self.client.set_param(param_path, parameter)
+
+        #Read your own writes before the change is pushed back.
+        with self.param_cache_lock:
+            if(allowable and param_path in self.param_cache):
+                self.param_cache[param_path] = parameter
         return True
 
     def get_param(self, param_path):
@@ -746,7 +3358,56 @@ class Parameter_Server_Client():
         Parameters:
             param_path: The parameter path tree to set the given parameter.
         Returns:
-            N/A
+            parameter: The parameter, with the type it was set with. Raises
+                    xmlrpc.client.Fault if the path does not exist.
         '''
+        if(self.param_prefixes and self._cache_stale()):
+            self._resubscribe()
+
+        with self.param_cache_lock:
+            if(param_path in self.param_cache):
+                return self.param_cache[param_path]
+
         parameter = self.client.get_param(param_path)
         return parameter
+
+    def get_params(self, prefix):
+        '''
+        Get a whole subtree of parameters in one round trip.
+        Parameters:
+            prefix: The parameter path of the subtree, e.g. 'PID/'.
+        Returns:
+            params: Nested dictionaries of the parameters under prefix, e.g.
+                    {'roll_pid': {'p': 1.0, 'i': 0.1}}. Raises xmlrpc.client.Fault
+                    if the prefix does not exist.
+        '''
+        return self.client.get_params(prefix)
+
+    def get_many(self, param_paths):
+        '''
+        Get several parameters in one round trip.
+        Parameters:
+            param_paths: A list of parameter paths.
+        Returns:
+            parameters: A dictionary from parameter path to parameter. Paths that
+                        do not exist are left out.
+        '''
+        return self.client.get_many(list(param_paths))
+
+    def set_many(self, params):
+        '''
+        Set several parameters in one round trip. Either all of them are set or
+        none are.
+        Parameters:
+            params: A dictionary from parameter path to parameter.
+        Returns:
+            True if the parameters were set.
+        '''
+        params = {param_path: normalize_parameter(parameter) for param_path, parameter in dict(params).items()}
+        allowable = self.client.set_many(params)
+        if(allowable):
+            with self.param_cache_lock:
+                for param_path, parameter in params.items():
+                    if(param_path in self.param_cache):
+                        self.param_cache[param_path] = parameter
+        return allowable
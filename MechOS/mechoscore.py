@@ -12,16 +12,26 @@ import os
 import signal
 import atexit
 import threading
+import concurrent.futures
+import functools
 from MechOS import parameter_server
+from MechOS.control_plane import Threaded_XMLRPC_Server, Pooled_XMLRPC_Client, Control_Server, Control_Client
+from MechOS.topic_stats import add_topic_stats, marshallable_topic_stats
 import argparse
 
+#Number of multicast groups 239.255.0.1 to 239.255.255.254 udp_multicast topics
+#are given.
+MULTICAST_GROUP_COUNT = 256*254
+
 class Mechoscore:
     '''
     Mechoscore containts and xmlrpc server that nodes, publishers,
     subscribers register to in order to hop on the mechos network.
     '''
 
-    def __init__(self, ip="127.0.0.1", core_port=5959, param_server_port=8000):
+    def __init__(self, ip="127.0.0.1", core_port=5959, param_server_port=8000,
+                    notification_workers=16, notification_timeout=5.0,
+                    control_port=None, param_server_control_port=None, multicast_port=45000):
         '''
         Initialize the XMLRPCServer.
 
@@ -29,15 +39,30 @@ class Mechoscore:
             ip: The ip address to host the XMLRPCServer. Default "http://127.0.0.101"
             core_port: The port to host the mechoscore XMLRPCServer. Default 5959
             param_server_port: The port to host the parameter server on. Default 8000
+            notification_workers: Default 16. The number of calls to nodes that can be
+                        made at the same time when connecting or disconnecting publishers
+                        and subscribers.
+            notification_timeout: Default 5.0. The number of seconds a call to a node
+                        may take before mechoscore gives up on it.
+            control_port: Default None. If given, nodes can also register over persistent
+                        control connections (see control_plane.Control_Server) on this port.
+            param_server_control_port: Default None. If given, the parameter server can
+                        also be reached over persistent control connections on this port.
+            multicast_port: Default 45000. The port of the first udp_multicast topic.
+                        Each udp_multicast topic gets its own group and the next port.
 
         Returns:
             N/A
         '''
-        self.xmlrpc_server = SimpleXMLRPCServer((ip,core_port), logRequests=False)
+        #Each request is handled in its own thread so one node registering does
+        #not hold up the others.
+        self.xmlrpc_server = Threaded_XMLRPC_Server((ip,core_port), logRequests=False)
 
         self.ip = ip
         self.core_port = core_port
         self.param_server_port = param_server_port
+        self.control_port = control_port
+        self.param_server_control_port = param_server_control_port
 
         #Register functions that nodes will call to register themselves as well
         #as there publishers and subscribers.
@@ -45,20 +70,48 @@ class Mechoscore:
         self.xmlrpc_server.register_function(self.unregister_node)
         self.xmlrpc_server.register_function(self.register_publisher)
         self.xmlrpc_server.register_function(self.register_subscriber)
+        self.xmlrpc_server.register_function(self.get_multicast_group)
+        self.xmlrpc_server.register_function(self.get_topic_stats)
+
+        #Nodes may instead register over persistent control connections, which
+        #serve the same functions.
+        self.control_server = None
+        if(control_port is not None):
+            self.control_server = Control_Server((ip, control_port))
+            for name, function in self.xmlrpc_server.funcs.items():
+                self.control_server.register_function(function, name)
 
         self.node_information = {}
 
+        #Guards node_information and topic_index, which are shared by the request threads.
+        self.registry_lock = threading.RLock()
+
+        #Calls to nodes telling them to connect or disconnect publishers and subscribers
+        #are made in parallel by this pool of threads.
+        self.notification_timeout = notification_timeout
+        self.notification_executor = concurrent.futures.ThreadPoolExecutor(max_workers=notification_workers)
+
+        #Index from (topic, protocol) to the publishers and subscribers of that topic.
+        #Each holds a dictionary from the unique id of the publisher or subscriber
+        #to the name of its node, so matching only touches the relevant endpoints.
+        self.topic_index = {}
+
+        #The multicast group and port assigned to each udp_multicast topic.
+        self.multicast_port = multicast_port
+        self.multicast_groups = {}
+
         #When a new node is created, a client to that nodes xml rpc will be created.
         self.xmlrpc_clients_to_nodes = {}
 
         #Initialize the parameter server
-        self.param_server = parameter_server.Parameter_Server(ip=self.ip, port=self.param_server_port)
+        self.param_server = parameter_server.Parameter_Server(ip=self.ip, port=self.param_server_port,
+                                                    control_port=self.param_server_control_port)
 
 
         #At the exit of the mechoscore, unregister and kill all nodes if any are running.
         atexit.register(self.unregister_all_nodes)
 
-    def register_node(self, name, pid, xmlrpc_server_ip, xmlrpc_server_port):
+    def register_node(self, name, pid, xmlrpc_server_ip, xmlrpc_server_port, control_port=None):
         '''
         Register a node with mechoscore. Check if that node is already created.
         If it is already created, send an error message and do not let it connect.
@@ -68,25 +121,33 @@ class Mechoscore:
             pid: The process id of the node.
             xmlrpc_server_ip: The ip address that the node is running on.
             xmlrpc_server_port: The port that the node is running on.
+            control_port: Default None. If given, mechoscore calls the node over a
+                        persistent control connection to this port instead of xmlrpc.
 
         Returns:
             True: If the node can be created.
             False: If the node name already exists, then it cant be created.
         '''
-        if(name in self.node_information.keys()):
-            return False
-
-        #Create an xmlrpc client to the newly registered node. This is so that
-        #mechoscore can make calls to the individual nodes.
-        self.xmlrpc_clients_to_nodes[name] = xmlrpc.client.ServerProxy("http://" + \
-                    xmlrpc_server_ip + ":" + \
-                    str(xmlrpc_server_port))
-
-        self.node_information[name] = {"pid":pid,
-                                                    "xmlrpc_server_ip": xmlrpc_server_ip,
-                                                    "xmlrpc_server_port":xmlrpc_server_port,
-                                                    "publishers":{},
-                                                    "subscribers":{}}
+        with self.registry_lock:
+            if(name in self.node_information.keys()):
+                return False
+
+            #Create an xmlrpc client to the newly registered node. This is so that
+            #mechoscore can make calls to the individual nodes. The client can be
+            #used by several notification threads at once.
+            if(control_port is not None):
+                self.xmlrpc_clients_to_nodes[name] = Control_Client((xmlrpc_server_ip, control_port),
+                                                                timeout=self.notification_timeout)
+            else:
+                self.xmlrpc_clients_to_nodes[name] = Pooled_XMLRPC_Client("http://" + \
+                            xmlrpc_server_ip + ":" + \
+                            str(xmlrpc_server_port), timeout=self.notification_timeout)
+
+            self.node_information[name] = {"pid":pid,
+                                                        "xmlrpc_server_ip": xmlrpc_server_ip,
+                                                        "xmlrpc_server_port":xmlrpc_server_port,
+                                                        "publishers":{},
+                                                        "subscribers":{}}
         print("[INFO]: Registering Node %s to the mechos network" % name)
         return True
 
@@ -115,47 +176,156 @@ class Mechoscore:
             N/A
         '''
 
-        #Remove the information about a node.
-        node_information = self.node_information[name]
+        #Connections on other nodes to the publishers and subscribers of the node
+        #are killed first, then the publishers and subscribers of the node itself.
+        connection_notifications = []
+        node_notifications = []
+
+        with self.registry_lock:
+            #Remove the information about a node.
+            if(name not in self.node_information):
+                return False
+            node_information = self.node_information[name]
+            xmlrpc_client_to_node = self.xmlrpc_clients_to_nodes[name]
+
+            #Kill the publishers of the node
+            for publisher_id, publisher_information in node_information["publishers"].items():
+
+                topic_endpoints = self._remove_from_topic_index(publisher_information, "publishers", publisher_id)
+
+                #Disconnect the publisher from ALL subscribers of its topic. Only the nodes
+                #that have subscribers connected to the publisher being killed need to make
+                #the sockets of their subscribers disconnect from this publisher.
+                for node_name in set(topic_endpoints["subscribers"].values()):
 
+                    connection_notifications.append(functools.partial(
+                                self.xmlrpc_clients_to_nodes[node_name]._kill_subscriber_connection, publisher_id))
 
-        #Kill the publishers of the node
-        for publisher_id in node_information["publishers"].keys():
+                node_notifications.append(functools.partial(xmlrpc_client_to_node._kill_publisher, publisher_id))
 
-            #For each of the nodes in the network, see if the publisher connects to
-            #any subscribers. Disconnect the publisher from ALL subscribers it connects to.
-            #Also tell the subscribers that they no longer need to look for messages coming
-            #from this publisher.
-            for node_name in self.node_information.keys():
+            #Kill the subscriber of the node.
+            for subscriber_id, subscriber_information in node_information["subscribers"].items():
 
-                #Go into the nodes that have subscribers connected to the current publisher being killed.
-                #Make the sockets of the subscribers disconnect from this publisher.
-                self.xmlrpc_clients_to_nodes[node_name]._kill_subscriber_connection(publisher_id)
+                topic_endpoints = self._remove_from_topic_index(subscriber_information, "subscribers", subscriber_id)
 
-            self.xmlrpc_clients_to_nodes[name]._kill_publisher(publisher_id)
+                #Make it so that the publishers of the topic no longer need to try and
+                #send messages to the current subscriber being killed.
+                for node_name in set(topic_endpoints["publishers"].values()):
 
-        #Kill the subscriber of the node.
-        for subscriber_id in node_information["subscribers"].keys():
+                    connection_notifications.append(functools.partial(
+                                self.xmlrpc_clients_to_nodes[node_name]._kill_publisher_connection, subscriber_id))
 
-            #For each of the nodes in the network, see if the subscriber subscribes to
-            #to any publishers of other nodes. Make it so that the publishers no longer
-            #need to try and send messages to the current subscriber being killed.
-            for node_name in self.node_information.keys():
+                node_notifications.append(functools.partial(xmlrpc_client_to_node._kill_subscriber, subscriber_id))
 
-                #Go into the nodes that have a publisher sending to the current subscriber being killed.
-                #Make the sockets of thos publishers disconnect from sending data to te subscriber
-                #being killed.
-                self.xmlrpc_clients_to_nodes[node_name]._kill_publisher_connection(subscriber_id)
+            print("[WARNING]: Unregistering and killing the process continaing Node %s" % name)
+            self.node_information.pop(name)
+            self.xmlrpc_clients_to_nodes.pop(name)
 
-            self.xmlrpc_clients_to_nodes[name]._kill_subscriber(subscriber_id)
+        self._notify_nodes(connection_notifications)
+        self._notify_nodes(node_notifications)
 
-        print("[WARNING]: Unregistering and killing the process continaing Node %s" % name)
-        self.node_information.pop(name)
+        if(isinstance(xmlrpc_client_to_node, Control_Client)):
+            xmlrpc_client_to_node.close()
         #self.xmlrpc_clients_to_nodes[name]._kill_node()
 
 
 
         return(True)
+
+    def _notify_nodes(self, notifications):
+        '''
+        Make calls to nodes in parallel and wait for all of them to finish. A node
+        that fails or does not answer in time is reported without holding up the
+        calls to the other nodes.
+
+        Parameters:
+            notifications: A list of functions that each make calls to nodes.
+        Returns:
+            N/A
+        '''
+        futures = [self.notification_executor.submit(notification) for notification in notifications]
+
+        for future in futures:
+            exception = future.exception()
+            if(exception is not None):
+                print("[ERROR]: A node could not be notified of a connection change: %s" % exception)
+
+    def get_multicast_group(self, topic):
+        '''
+        Get the multicast group and port of a udp_multicast topic, assigning the
+        topic free ones the first time it is asked for.
+
+        Parameters:
+            topic: The topic name.
+        Returns:
+            [group, port]: The multicast group address and port of the topic.
+        '''
+        with self.registry_lock:
+            if(topic not in self.multicast_groups):
+                self.multicast_groups[topic] = self._free_multicast_group()
+            return self.multicast_groups[topic]
+
+    def _free_multicast_group(self):
+        '''
+        Find a multicast group and port no udp_multicast topic is using. Once every
+        group was given out, the groups of topics without publishers or subscribers
+        left are taken back. Called with registry_lock held.
+
+        Parameters:
+            N/A
+        Returns:
+            [group, port]: The free multicast group address and port.
+        Raises:
+            RuntimeError: If every group or every port is in use.
+        '''
+        group_count = min(MULTICAST_GROUP_COUNT, 65536 - self.multicast_port)
+        if(len(self.multicast_groups) >= group_count):
+            unused_topics = [topic for topic in self.multicast_groups \
+                                if (topic, "udp_multicast") not in self.topic_index]
+            for topic in unused_topics:
+                del self.multicast_groups[topic]
+
+        used = set(port - self.multicast_port for group, port in self.multicast_groups.values())
+        for index in range(len(self.multicast_groups), group_count):
+            if(index not in used):
+                break
+        else:
+            index = next((index for index in range(group_count) if index not in used), None)
+            if(index is None):
+                raise RuntimeError("No udp_multicast group is free, the %d groups starting at port %d are all in use" % \
+                            (max(group_count, 0), self.multicast_port))
+
+        return ["239.255.%d.%d" % (index // 254, index % 254 + 1), self.multicast_port + index]
+
+    def get_topic_stats(self):
+        '''
+        Collect the counters of the publishers and subscribers of every node and
+        add them up for each topic. The nodes are asked in parallel, and a node
+        that fails or does not answer in time is left out.
+
+        Parameters:
+            N/A
+        Returns:
+            topic_stats: A dictionary from topic name to a dictionary of the
+                    "protocols" of the topic, the number of "publishers" and
+                    "subscribers", and the sums of their counters under "published"
+                    and "received" (see topic_stats.STATS_FIELDS).
+        '''
+        with self.registry_lock:
+            xmlrpc_clients_to_nodes = dict(self.xmlrpc_clients_to_nodes)
+
+        futures = {node_name: self.notification_executor.submit(xmlrpc_client_to_node._get_topic_stats) \
+                    for node_name, xmlrpc_client_to_node in xmlrpc_clients_to_nodes.items()}
+
+        topic_stats = {}
+        for node_name, future in futures.items():
+            exception = future.exception()
+            if(exception is not None):
+                print("[ERROR]: Could not get the topic stats of node %s: %s" % (node_name, exception))
+                continue
+            add_topic_stats(topic_stats, future.result())
+        return marshallable_topic_stats(topic_stats)
+
     def register_publisher(self, node_name, id, topic, ip, port, protocol):
         '''
         Register a publisher from a node. Check if the publisher has an allowable
@@ -167,15 +337,22 @@ class Mechoscore:
             topic: The topic name that the publisher will publish data to.
             ip: The ip address that the publisher want to send on.
             port: The port that the publisher wants to send on.
-            protocol: Either tcp or udp.
+            protocol: Either tcp, udp, udp_multicast or shm.
         '''
 
-        self.node_information[node_name]["publishers"][id] = {"topic":topic,
-                                                         "ip":ip,
-                                                         "port":port,
-                                                         "protocol":protocol}
+        with self.registry_lock:
+            self.node_information[node_name]["publishers"][id] = {"topic":topic,
+                                                             "ip":ip,
+                                                             "port":port,
+                                                             "protocol":protocol}
+            self._topic_endpoints(topic, protocol)["publishers"][id] = node_name
 
-        self.new_publisher_update_connections(node_name, id)
+            #The subscribers are listed in the same critical section as the
+            #publisher is added, so a subscriber registering at the same time is
+            #connected to it by exactly one of the two registrations.
+            notifications = self._publisher_connections(node_name, id)
+
+        self._notify_nodes(notifications)
         print("[INFO]: Registering publisher with topic %s on Node %s" % (topic, node_name))
         return True
 
@@ -190,23 +367,111 @@ class Mechoscore:
             node_name: The name of the node registering the subscriber.
             id: The unique id of the subscriber.
             topic: The topic name that the subscriber will subscribe to get data from.
-            protocol: Either udp or tcp.
+            protocol: Either tcp, udp, udp_multicast or shm.
         Returns:
             N/A
         '''
-        self.node_information[node_name]["subscribers"][id] = {"topic":topic,
-                                                                "ip":ip,
-                                                                "port":port,
-                                                                "protocol":protocol}
+        with self.registry_lock:
+            self.node_information[node_name]["subscribers"][id] = {"topic":topic,
+                                                                    "ip":ip,
+                                                                    "port":port,
+                                                                    "protocol":protocol}
+            self._topic_endpoints(topic, protocol)["subscribers"][id] = node_name
+            notifications = self._subscriber_connections(node_name, id)
         print("[INFO]: Registering subscriber with topic %s on Node %s" % (topic, node_name))
-        self.new_subscriber_update_connections(node_name, id)
+        self._notify_nodes(notifications)
         return(True)
 
 
+    def _topic_endpoints(self, topic, protocol):
+        '''
+        Get the publishers and subscribers of a topic from the topic index, adding
+        the topic to the index if it is new.
+
+        Parameters:
+            topic: The topic name.
+            protocol: The protocol of the topic.
+        Returns:
+            topic_endpoints: A dictionary with "publishers" and "subscribers" dictionaries
+                            from unique id to node name.
+        '''
+        key = (topic, protocol)
+        if(key not in self.topic_index):
+            self.topic_index[key] = {"publishers":{}, "subscribers":{}}
+        return self.topic_index[key]
+
+    def _remove_from_topic_index(self, endpoint_information, endpoint_type, id):
+        '''
+        Remove a publisher or subscriber from the topic index.
+
+        Parameters:
+            endpoint_information: The registered information of the publisher or subscriber.
+            endpoint_type: Either "publishers" or "subscribers".
+            id: The unique id of the publisher or subscriber.
+        Returns:
+            topic_endpoints: The publishers and subscribers left on the topic.
+        '''
+        key = (endpoint_information["topic"], endpoint_information["protocol"])
+        topic_endpoints = self.topic_index.get(key, {"publishers":{}, "subscribers":{}})
+        topic_endpoints[endpoint_type].pop(id, None)
+
+        if(not topic_endpoints["publishers"] and not topic_endpoints["subscribers"]):
+            self.topic_index.pop(key, None)
+        return topic_endpoints
+
+    def _connect(self, publisher_node_name, publisher_id, subscriber_node_name, subscriber_id):
+        '''
+        Get a function that tells a publisher and a subscriber to connect to each
+        other. The publisher is always updated before the subscriber.
+
+        Parameters:
+            publisher_node_name: The name of the node of the publisher.
+            publisher_id: The unique id of the publisher.
+            subscriber_node_name: The name of the node of the subscriber.
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            connect: The function making the calls to the nodes.
+        '''
+        publisher_information = self.node_information[publisher_node_name]["publishers"][publisher_id]
+        subscriber_information = self.node_information[subscriber_node_name]["subscribers"][subscriber_id]
+        xmlrpc_client_to_publisher_node = self.xmlrpc_clients_to_nodes[publisher_node_name]
+        xmlrpc_client_to_subscriber_node = self.xmlrpc_clients_to_nodes[subscriber_node_name]
+
+        def connect():
+            xmlrpc_client_to_publisher_node._update_publisher(publisher_id, subscriber_id,
+                            subscriber_information["ip"], subscriber_information["port"])
+            xmlrpc_client_to_subscriber_node._update_subscriber(subscriber_id, publisher_id,
+                            publisher_information["ip"], publisher_information["port"])
+        return connect
+
+    def _same_host(self, publisher_node_name, subscriber_node_name, protocol):
+        '''
+        Check if a publisher and a subscriber can reach each other over their
+        protocol. A shm ring only exists on the host of its publisher, so shm
+        pairs are only connected if both nodes registered with the same ip.
+
+        Parameters:
+            publisher_node_name: The name of the node of the publisher.
+            subscriber_node_name: The name of the node of the subscriber.
+            protocol: The protocol of the topic.
+        Returns:
+            same_host: False if the pair cannot be connected.
+        '''
+        if(protocol != "shm"):
+            return True
+        publisher_ip = self.node_information[publisher_node_name]["xmlrpc_server_ip"]
+        subscriber_ip = self.node_information[subscriber_node_name]["xmlrpc_server_ip"]
+        if(publisher_ip == subscriber_ip):
+            return True
+        print("[WARNING]: Not connecting shm subscriber on node %s to the publisher on node %s, " \
+              "they are on different hosts (%s, %s). Use tcp between hosts." % \
+              (subscriber_node_name, publisher_node_name, subscriber_ip, publisher_ip))
+        return False
+
     def new_subscriber_update_connections(self, node_name, subscriber_id):
         '''
         If a new subscriber of publisher comes onto the network, connect it with its counter
-        parts.
+        parts. The publishers are connected in parallel.
 
         Parameters:
             node_name: The name of the node that has publisher who need to connect to this new subscriber.
@@ -214,34 +479,35 @@ class Mechoscore:
         Returns:
             N/A
         '''
-        xmlrpc_client_to_subscriber_node = self.xmlrpc_clients_to_nodes[node_name]
-        subscriber_topic = self.node_information[node_name]["subscribers"][subscriber_id]["topic"]
-        subscriber_protocol =  self.node_information[node_name]["subscribers"][subscriber_id]["protocol"]
-        subscriber_ip = self.node_information[node_name]["subscribers"][subscriber_id]["ip"]
-        subscriber_port = self.node_information[node_name]["subscribers"][subscriber_id]["port"]
-        #Iterate through each nodes publishers, and connect it to the repectable topics
-        for nodes in self.node_information.keys():
-
-            for publisher_id in self.node_information[nodes]["publishers"].keys():
+        with self.registry_lock:
+            notifications = self._subscriber_connections(node_name, subscriber_id)
 
-                #publisher topics of current node.
-                publisher_topic = self.node_information[nodes]["publishers"][publisher_id]["topic"]
-                publisher_ip = self.node_information[nodes]["publishers"][publisher_id]["ip"]
-                publisher_port = self.node_information[nodes]["publishers"][publisher_id]["port"]
-                publisher_protocol = self.node_information[nodes]["publishers"][publisher_id]["protocol"]
+        self._notify_nodes(notifications)
 
-                xmlrpc_client_to_publisher_node = self.xmlrpc_clients_to_nodes[nodes]
+    def _subscriber_connections(self, node_name, subscriber_id):
+        '''
+        Get the functions connecting a subscriber to the publishers of its topic.
+        Called with registry_lock held.
 
-                #Only connect subscribers to a publisher if they have the same topic name and protocol type.
-                if(publisher_topic == subscriber_topic and publisher_protocol == subscriber_protocol):
+        Parameters:
+            node_name: The name of the node of the subscriber.
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            notifications: The functions making the calls to the nodes.
+        '''
+        subscriber_topic = self.node_information[node_name]["subscribers"][subscriber_id]["topic"]
+        subscriber_protocol =  self.node_information[node_name]["subscribers"][subscriber_id]["protocol"]
 
-                    xmlrpc_client_to_publisher_node._update_publisher(publisher_id, subscriber_id, subscriber_ip, subscriber_port)
-                    xmlrpc_client_to_subscriber_node._update_subscriber(subscriber_id, publisher_id, publisher_ip, publisher_port)
+        #Only the publishers with the same topic name and protocol type are looked at.
+        topic_publishers = self._topic_endpoints(subscriber_topic, subscriber_protocol)["publishers"]
+        return [self._connect(nodes, publisher_id, node_name, subscriber_id) \
+                    for publisher_id, nodes in topic_publishers.items() \
+                    if self._same_host(nodes, node_name, subscriber_protocol)]
 
     def new_publisher_update_connections(self, node_name, publisher_id):
         '''
         If a new publisher comes onto the network, tell the subscriber of the topic
-        to connect.
+        to connect. The subscribers are connected in parallel.
 
         Parameters:
             node_name:
@@ -249,30 +515,30 @@ class Mechoscore:
         Returns:
             N/A
         '''
-        xmlrpc_client_to_publisher_node = self.xmlrpc_clients_to_nodes[node_name]
-        publisher_topic = self.node_information[node_name]["publishers"][publisher_id]["topic"]
-        publisher_ip = self.node_information[node_name]["publishers"][publisher_id]["ip"]
-        publisher_port = self.node_information[node_name]["publishers"][publisher_id]["port"]
-        publisher_protocol = self.node_information[node_name]["publishers"][publisher_id]["protocol"]
-
+        with self.registry_lock:
+            notifications = self._publisher_connections(node_name, publisher_id)
 
-        for nodes in self.node_information.keys():
+        self._notify_nodes(notifications)
 
-            for subscriber_id in self.node_information[nodes]["subscribers"].keys():
-
-                #publisher topics of current node.
-                subscriber_topic = self.node_information[nodes]["subscribers"][subscriber_id]["topic"]
-                subscriber_protocol = self.node_information[nodes]["subscribers"][subscriber_id]["protocol"]
-                subscriber_ip = self.node_information[nodes]["subscribers"][subscriber_id]["ip"]
-                subscriber_port = self.node_information[nodes]["subscribers"][subscriber_id]["port"]
-
-                xmlrpc_client_to_subscriber_node = self.xmlrpc_clients_to_nodes[nodes]
+    def _publisher_connections(self, node_name, publisher_id):
+        '''
+        Get the functions connecting a publisher to the subscribers of its topic.
+        Called with registry_lock held.
 
-                if(publisher_topic == subscriber_topic and publisher_protocol == subscriber_protocol):
+        Parameters:
+            node_name: The name of the node of the publisher.
+            publisher_id: The unique id of the publisher.
+        Returns:
+            notifications: The functions making the calls to the nodes.
+        '''
+        publisher_topic = self.node_information[node_name]["publishers"][publisher_id]["topic"]
+        publisher_protocol = self.node_information[node_name]["publishers"][publisher_id]["protocol"]
 
-                    xmlrpc_client_to_publisher_node._update_publisher(publisher_id, subscriber_id, subscriber_ip, subscriber_port)
-                    xmlrpc_client_to_subscriber_node._update_subscriber(subscriber_id, publisher_id, publisher_ip, publisher_port)
-                    #xmlrpc_client_to_publisher_node._update_publisher(publisher_id, subscriber_id, subscriber_ip, subscriber_port)
+        #Only the subscribers with the same topic name and protocol type are looked at.
+        topic_subscribers = self._topic_endpoints(publisher_topic, publisher_protocol)["subscribers"]
+        return [self._connect(node_name, publisher_id, nodes, subscriber_id) \
+                    for subscriber_id, nodes in topic_subscribers.items() \
+                    if self._same_host(node_name, nodes, publisher_protocol)]
 
     def run(self):
         '''
@@ -288,6 +554,11 @@ class Mechoscore:
         print("[INFO]: Parameter Server started at %s:%d" % (self.ip, self.param_server_port))
         self.param_server_thread = threading.Thread(target=self.param_server.run, daemon=True)
 
+        if(self.control_server is not None):
+            print("[INFO]: Node Control Server started at %s:%d" % (self.ip, self.control_port))
+            self.control_server_thread = threading.Thread(target=self.control_server.serve_forever, daemon=True)
+            self.control_server_thread.start()
+
         #Start the xmlrpc server of mechoscore and the parameter server
         self.param_server_thread.start()
 
@@ -308,8 +579,30 @@ if __name__ == "__main__":
     parser.add_argument("--param_server_port", default=8000,
             help='''The port that the parameter server is running on. Default 8000''', type=int)
 
+    parser.add_argument("--notification_workers", default=16,
+            help='''The number of calls to nodes made in parallel. Default 16''', type=int)
+
+    parser.add_argument("--notification_timeout", default=5.0,
+            help='''The number of seconds a call to a node may take. Default 5.0''', type=float)
+
+    parser.add_argument("--control_port", default=None,
+            help='''The port of the persistent control connections for node registration.
+                  Default None, only xmlrpc is served.''', type=int)
+
+    parser.add_argument("--param_server_control_port", default=None,
+            help='''The port of the persistent control connections to the parameter server.
+                  Default None, only xmlrpc is served.''', type=int)
+
+    parser.add_argument("--multicast_port", default=45000,
+            help='''The port of the first udp_multicast topic. Default 45000''', type=int)
+
     args= parser.parse_args()
 
 
-    mechoscore_server = Mechoscore(ip=args.ip, core_port=args.core_port, param_server_port=args.param_server_port)
+    mechoscore_server = Mechoscore(ip=args.ip, core_port=args.core_port, param_server_port=args.param_server_port,
+                                    notification_workers=args.notification_workers,
+                                    notification_timeout=args.notification_timeout,
+                                    control_port=args.control_port,
+                                    param_server_control_port=args.param_server_control_port,
+                                    multicast_port=args.multicast_port)
     mechoscore_server.run()
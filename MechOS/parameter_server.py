@@ -2,19 +2,75 @@ from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
 import xml.etree.ElementTree as ET
 from multiprocessing import Process
+import threading
+import time
+import atexit
+import os
+import queue
+import socket
+import functools
+from MechOS.control_plane import Control_Server, Control_Client
+from MechOS.parameter_store import PARAMETER_STORES, set_element, index_tree, write_xml, \
+                                    encode_parameter, element_parameter
+
+#Number of times a push to a subscribed client is retried before the client is
+#dropped, and the seconds waited before the first retry, doubled for each next one.
+PUSH_RETRIES = 3
+PUSH_RETRY_DELAY = 0.1
+
+#Seconds a push may take to be sent and answered. A client that takes longer is
+#hung rather than flaky, so it is dropped without retrying.
+PUSH_TIMEOUT = 2.0
+
+#Seconds between the empty pushes sent to every subscribed client so it can tell
+#its cache is still kept up to date.
+HEARTBEAT_INTERVAL = 1.0
+
+def _under_prefix(param_path, prefix):
+    '''
+    Check if a parameter path is under a prefix.
+
+    Parameters:
+        param_path: The parameter path, e.g. 'PID/roll_pid/p'.
+        prefix: The prefix without a trailing '/', e.g. 'PID'. '' is every path.
+
+    Returns:
+        True if the path is the prefix or under it.
+    '''
+    return(prefix == '' or param_path == prefix or param_path.startswith(prefix + '/'))
 
 class Parameter_Server:
     '''
     An xmlrpc server running the MechOS parameter server. This class allows one
     to set and get parameters to a specified xml file.
+
+    The database is loaded once into memory, with an index from each parameter
+    path to its element, so getting a parameter never touches the disk. Set
+    parameters are written back to the store of the database (see parameter_store)
+    in the background every flush_interval seconds. Edits made to the file by
+    hand are picked up the same way.
+
+    Parameters keep their type: strings, ints, floats, bools and arrays of numbers
+    are stored with a type attribute in the xml file and given back as the same
+    type.
+
+    Clients can subscribe to parameter path prefixes to keep a cache of those
+    parameters. Every change under a prefix is pushed to the client over a control
+    connection, and an empty push is sent every HEARTBEAT_INTERVAL seconds. A
+    client that stops getting pushes, e.g. because it was dropped after pushes to
+    it kept failing, stops trusting its cache and subscribes again.
     '''
-    def __init__(self, ip=None, port=None):
+    def __init__(self, ip=None, port=None, control_port=None, flush_interval=0.5):
         '''
         Initialize Parameter server for XMLRPCServer.
 
         Parameters:
             ip: The ip address to host the XMLRPCServer. Default "http://127.0.0.101"
             port: The port to host the XMLRPCServer. Default 8000
+            control_port: Default None. If given, the parameter server can also be
+                        reached over persistent control connections on this port.
+            flush_interval: Default 0.5. The number of seconds between writing set
+                        parameters to the xml file and checking the file for edits.
 
         Returns:
             N/A
@@ -26,76 +82,191 @@ class Parameter_Server:
             port = 8000
         self.server = SimpleXMLRPCServer((ip, port))
         self.xml_file = None
+        self.store = None
+
+        #The parameter database held in memory and the index from each parameter
+        #path (e.g. 'PID/roll_pid/p') to its element.
+        self.tree = None
+        self.param_index = {}
+
+        #The typed value of each parameter path read so far, so the text of an
+        #element is only converted once.
+        self.param_values = {}
+
+        #Parameters set since the database was last written to the store.
+        self.pending_params = {}
+
+        #Guards the database, which the xmlrpc server, the control server and the
+        #flush thread all use.
+        self.lock = threading.RLock()
+
+        self.flush_interval = flush_interval
+        self.run_flush_thread = True
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+        #Write any parameters still pending when the program exits.
+        atexit.register(self.flush)
+
+        #Clients caching parameters, by their unique id. Each holds the parameter
+        #path prefixes subscribed to and a control client to push changes through.
+        self.param_subscribers = {}
+
+        #Incremented on every change so clients can tell which value is newest.
+        self.param_version = 0
+
+        #Changes waiting to be pushed to subscribed clients, in order.
+        self.notification_queue = queue.Queue()
+        self.notification_thread = threading.Thread(target=self._notification_loop, daemon=True)
+        self.notification_thread.start()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
 
         self.server.register_function(self.use_parameter_database)
         self.server.register_function(self.set_param)
         self.server.register_function(self.get_param)
+        self.server.register_function(self.get_params)
+        self.server.register_function(self.get_many)
+        self.server.register_function(self.set_many)
+        self.server.register_function(self.subscribe_params)
+        self.server.register_function(self.unsubscribe_params)
+        self.server.register_function(self.import_parameters)
+        self.server.register_function(self.export_parameters)
+
+        #The same functions served over persistent control connections.
+        self.control_server = None
+        if(control_port is not None):
+            self.control_server = Control_Server((ip, control_port))
+            for name, function in self.server.funcs.items():
+                self.control_server.register_function(function, name)
 
-    def use_parameter_database(self, xml_file):
+    def use_parameter_database(self, xml_file, store="xml"):
         '''
         Sets the xml file to use for the parameter server to store and retreive
         data from.
 
         Parameters:
             xml_file: The xml file to save and get parameters from.
+            store: Default "xml". How the database is saved (see parameter_store).
+                    "xml" rewrites the xml file on every write. "log" appends the
+                    changes to xml_file + ".log" and rewrites the xml file only
+                    once the log is large.
 
         Returns:
             true
         '''
+        with self.lock:
+            #Write what was set in the previous database before switching.
+            self.flush()
+            if(self.store is not None):
+                self.store.close()
 
-
-        self.xml_file = xml_file
+            params = self._flat_params()
+            self.xml_file = xml_file
+            try:
+                self.store = PARAMETER_STORES[store](xml_file)
+                self._load()
+            except Exception as e:
+                print("Could not load parameter database", xml_file, ":", e)
+                self.store = None
+                self.tree = None
+                self.param_index = {}
+                self.param_values = {}
+            self._notify_reload(params)
         return True
 
+    def _load(self):
+        '''
+        Read the database from its store into memory and index the path of
+        every element.
+
+        Parameters:
+            N/A
+
+        Returns:
+            N/A
+        '''
+        self.tree = self.store.load()
+        self.param_index = index_tree(self.tree)
+        self.param_values = {}
+
+    def _set_element(self, param_path, parameter):
+        '''
+        Set the parameter of the element of a parameter path, creating the elements
+        of the path that don't exist yet.
+
+        Parameters:
+            param_path: The parameter path tree to set the given parameter.
+            parameter: The parameter, see parameter_store.encode_parameter.
+
+        Returns:
+            parameter: The parameter as it is stored, e.g. tuples as lists.
+        '''
+        element = set_element(self.tree, self.param_index, param_path, parameter)
+        self.param_values[param_path] = self._element_parameter(element)
+        return self.param_values[param_path]
+
+    def _element_parameter(self, element):
+        '''
+        Get the typed value of an element. If its text does not match its type
+        attribute, e.g. after a bad hand edit, the text is given instead.
+
+        Parameters:
+            element: The element of the parameter.
+
+        Returns:
+            parameter: The value of the parameter.
+        '''
+        try:
+            return element_parameter(element)
+        except ValueError as e:
+            print("[WARNING]: Parameter", element.tag, "does not match its type:", e)
+            return element.text if(element.text is not None) else ''
+
+    def _parameter(self, param_path):
+        '''
+        Get the typed value of a parameter path.
+
+        Parameters:
+            param_path: The parameter path.
+
+        Returns:
+            parameter: The value of the parameter. Raises KeyError if the path does
+                    not exist.
+        '''
+        parameter = self.param_values.get(param_path)
+        if(parameter is None):
+            parameter = self._element_parameter(self.param_index[param_path])
+            self.param_values[param_path] = parameter
+        return parameter
+
     def set_param(self, param_path, parameter):
         '''
         Set a parameter in the the xml file database. If the parameter path already
         exist, then update its content with the new parameters. If the parameter
         path does not exist, create the parameter path and add the parameter value.
+        The xml file is written in the background.
 
         Parameter:
             param_path: The parameter path tree to set the given parameter. Note:
                         each level name should be spaced by a '/'.
                         Example 'PID/roll_pid/p'
-            parameter: The string representation of the parameter you want to set.
+            parameter: The parameter you want to set: a string, int, float, bool or
+                        a list of numbers, which may be nested for arrays of more than
+                        one dimension.
 
         Returns:
             N/A
         '''
         try:
-            #Get xml data tree
-            tree = ET.parse(self.xml_file)
-            tree_head_previous = tree.getroot()
-
-            #split parameter path into individual components
-            param_path_list = param_path.split('/')
-
-            #Search through param path and set parameters
-            for level, param_tag in enumerate(param_path_list):
-                tree_head = tree_head_previous.findall(param_tag)
-
-                #If the parameter does not exist, create the path and set parameter
-                if len(tree_head) == 0:
-                    #Generate the new path
-                    sub_element = tree_head_previous
-                    for sub_element_name in param_path_list[level:]:
-                        sub_element = ET.SubElement(sub_element, sub_element_name)
-                        sub_element.text = parameter
-
-                        tree.write(self.xml_file)
-                        return True
-
-                else:
-
-                    tree_head_previous = tree_head[0]
-            #Set parameter
-            tree_head[0].text = parameter
-            tree.write(self.xml_file)
+            with self.lock:
+                parameter = self._set_element(param_path, parameter)
+                self.pending_params[param_path] = parameter
+                self._notify_changes({param_path: parameter})
             return True
 
-
         except Exception as e:
-            print("Could not set parameter path", param_path, "with parameter", paramter, ":", e)
+            print("Could not set parameter path", param_path, "with parameter", parameter, ":", e)
             return False
 
     def get_param(self, param_path):
@@ -106,25 +277,436 @@ class Parameter_Server:
         Parameters:
             param_path: The parameter path tree to set the given parameter.
 
+        Returns:
+            parameter: The parameter, with the type it was set with. Raises KeyError,
+                    a Fault for the client, if the path does not exist, since any
+                    value returned instead could also be a stored parameter.
+        '''
+        with self.lock:
+            if(self.tree is None or param_path not in self.param_index):
+                raise KeyError("Parameter path %s does not exist" % param_path)
+            return self._parameter(param_path)
+
+    def _element_to_dict(self, element):
+        '''
+        Convert an element and all of its children to nested dictionaries.
+
+        Parameters:
+            element: The element to convert.
+
+        Returns:
+            params: The parameter of the element if it has no children, otherwise a
+                    dictionary from the tag of each child to its converted value.
+        '''
+        if(len(element) == 0):
+            return self._element_parameter(element)
+
+        params = {}
+        for child in element:
+            if(child.tag not in params):
+                params[child.tag] = self._element_to_dict(child)
+        return params
+
+    def get_params(self, prefix):
+        '''
+        Get a whole subtree of parameters in one call.
+
+        Parameters:
+            prefix: The parameter path of the subtree, e.g. 'PID' or 'PID/'. An
+                    empty prefix gets every parameter.
+
+        Returns:
+            params: Nested dictionaries of the parameters under prefix, e.g.
+                    {'roll_pid': {'p': 1.0, 'i': 0.1}}. Raises KeyError if the
+                    prefix does not exist.
+        '''
+        with self.lock:
+            prefix = prefix.strip('/')
+            if(self.tree is None or (prefix != '' and prefix not in self.param_index)):
+                raise KeyError("Parameter path %s does not exist" % prefix)
+            element = self.tree.getroot() if(prefix == '') else self.param_index[prefix]
+            return self._element_to_dict(element)
+
+    def get_many(self, param_paths):
+        '''
+        Get several parameters in one call.
+
+        Parameters:
+            param_paths: A list of parameter paths.
+
+        Returns:
+            parameters: A dictionary from parameter path to parameter. Paths that
+                        do not exist are left out.
+        '''
+        with self.lock:
+            if(self.tree is None):
+                return {}
+            return {param_path: self._parameter(param_path) for param_path in param_paths \
+                        if(param_path in self.param_index)}
+
+    def set_many(self, params):
+        '''
+        Set several parameters in one call. Either every parameter is set or,
+        if any of them can't be, none are.
+
+        Parameters:
+            params: A dictionary from parameter path to parameter.
+
+        Returns:
+            True if the parameters were set, False otherwise.
+        '''
+        with self.lock:
+            if(self.tree is None):
+                print("Could not set parameters: no parameter database in use")
+                return False
+            for param_path, parameter in params.items():
+                try:
+                    if(not isinstance(param_path, str) or not param_path.strip('/')):
+                        raise ValueError("invalid parameter path")
+                    encode_parameter(parameter)
+                except ValueError as e:
+                    print("Could not set parameter path", param_path, "with parameter", parameter, ":", e)
+                    return False
+
+            changes = {}
+            for param_path, parameter in params.items():
+                changes[param_path] = self._set_element(param_path, parameter)
+                self.pending_params[param_path] = changes[param_path]
+            self._notify_changes(changes)
+        return True
+
+    def _flat_params(self, prefix=None):
+        '''
+        Get the parameter of every path in the database.
+
+        Parameters:
+            prefix: Default None. If given, only the paths under this prefix.
+
+        Returns:
+            params: A dictionary from parameter path to parameter. Empty
+                    elements are given as ''.
+        '''
+        return {param_path: self._parameter(param_path) for param_path in self.param_index \
+                    if(prefix is None or _under_prefix(param_path, prefix))}
+
+    def subscribe_params(self, subscriber_id, prefix, ip, port):
+        '''
+        Subscribe a client to the parameters under a path prefix. Every later
+        change under the prefix is pushed to the control server of the client
+        by calling its _update_params(version, changes, removed).
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+            prefix: The parameter path prefix, e.g. 'PID/'. '' for every parameter.
+            ip: The ip address of the control server of the client.
+            port: The port of the control server of the client.
+
+        Returns:
+            [version, params, heartbeat_interval]: The version of the database, a
+                    dictionary of the current parameters under the prefix and the
+                    seconds between the pushes the client gets while subscribed.
+        '''
+        with self.lock:
+            subscriber = self.param_subscribers.get(subscriber_id)
+            if(subscriber is None):
+                subscriber = {"prefixes":set(),
+                              "client":Control_Client((ip, port), timeout=PUSH_TIMEOUT)}
+                self.param_subscribers[subscriber_id] = subscriber
+
+            prefix = prefix.strip('/')
+            subscriber["prefixes"].add(prefix)
+            return [self.param_version, self._flat_params(prefix), HEARTBEAT_INTERVAL]
+
+    def unsubscribe_params(self, subscriber_id):
+        '''
+        Stop pushing parameter changes to a client.
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+
+        Returns:
+            True
+        '''
+        with self.lock:
+            subscriber = self.param_subscribers.pop(subscriber_id, None)
+        if(subscriber is not None):
+            subscriber["client"].close()
+        return True
+
+    def _notify_changes(self, changes, removed=()):
+        '''
+        Queue changed parameters to be pushed to the subscribed clients. Called
+        with the lock held so changes are queued in the order they were made.
+
+        Parameters:
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+
+        Returns:
+            N/A
+        '''
+        self.param_version += 1
+        if(self.param_subscribers):
+            self.notification_queue.put((self.param_version, changes, list(removed)))
+
+    def _notify_reload(self, params):
+        '''
+        Queue the differences between the database before it was reloaded and now.
+
+        Parameters:
+            params: The parameters of every path before the reload.
+
+        Returns:
+            N/A
+        '''
+        new_params = self._flat_params()
+        changes = {param_path: parameter for param_path, parameter in new_params.items() \
+                        if(params.get(param_path) != parameter)}
+        removed = [param_path for param_path in params if(param_path not in new_params)]
+        if(changes or removed):
+            self._notify_changes(changes, removed)
+
+    def _notification_loop(self):
+        '''
+        Thread that pushes changed parameters to each subscribed client whose
+        prefixes they are under. The pushes to a client are pipelined on its
+        control connection, so they arrive in order without waiting on each other.
+
+        Parameter:
+            N/A
+
+        Returns:
+            N/A
+        '''
+        while(1):
+            version, changes, removed = self.notification_queue.get()
+
+            with self.lock:
+                subscribers = [(subscriber_id, tuple(subscriber["prefixes"])) \
+                                    for subscriber_id, subscriber in self.param_subscribers.items()]
+
+            for subscriber_id, prefixes in subscribers:
+                subscriber_changes = {param_path: parameter for param_path, parameter in changes.items() \
+                        if(any(_under_prefix(param_path, prefix) for prefix in prefixes))}
+                subscriber_removed = [param_path for param_path in removed \
+                        if(any(_under_prefix(param_path, prefix) for prefix in prefixes))]
+                if(not subscriber_changes and not subscriber_removed):
+                    continue
+                self._push(subscriber_id, version, subscriber_changes, subscriber_removed)
+
+    def _heartbeat_loop(self):
+        '''
+        Thread that sends an empty push to every subscribed client each
+        HEARTBEAT_INTERVAL seconds, and fails the pushes that were not answered
+        within PUSH_TIMEOUT.
+
+        Parameter:
+            N/A
+
+        Returns:
+            N/A
+        '''
+        while(1):
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self.lock:
+                version = self.param_version
+                subscribers = list(self.param_subscribers.items())
+            for subscriber_id, subscriber in subscribers:
+                subscriber["client"].expire_calls(PUSH_TIMEOUT)
+                self._push(subscriber_id, version, {}, [])
+
+    def _push(self, subscriber_id, version, changes, removed, attempt=0):
+        '''
+        Push changes to a subscribed client without waiting for it to answer.
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+            version: The version of the database with the changes.
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+            attempt: Default 0. The number of times the push was already retried.
+
+        Returns:
+            N/A
+        '''
+        with self.lock:
+            subscriber = self.param_subscribers.get(subscriber_id)
+        if(subscriber is None):
+            return
+
+        try:
+            future = subscriber["client"].call_async("_update_params", version, changes, removed)
+        except OSError as e:
+            self._push_failed(subscriber_id, version, changes, removed, attempt, e)
+            return
+        future.add_done_callback(functools.partial(self._push_done, subscriber_id, version, changes,
+                                                removed, attempt))
+
+    def _push_done(self, subscriber_id, version, changes, removed, attempt, future):
+        '''
+        Check the answer of a client to a push.
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+            version: The version of the database with the changes.
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+            attempt: The number of times the push was already retried.
+            future: The future of the push.
+
+        Returns:
+            N/A
+        '''
+        if(future.exception() is not None):
+            self._push_failed(subscriber_id, version, changes, removed, attempt, future.exception())
+
+    def _push_failed(self, subscriber_id, version, changes, removed, attempt, error):
+        '''
+        Retry a failed push after a delay, or drop the client once it has failed
+        PUSH_RETRIES times or did not answer within PUSH_TIMEOUT. Pushes retried
+        out of order are harmless since clients ignore changes older than the ones
+        they hold.
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+            version: The version of the database with the changes.
+            changes: A dictionary from parameter path to its new parameter.
+            removed: A list of the parameter paths that no longer exist.
+            attempt: The number of times the push was already retried.
+            error: Why the push failed.
+
+        Returns:
+            N/A
+        '''
+        if(attempt >= PUSH_RETRIES or isinstance(error, socket.timeout)):
+            self._drop_subscriber(subscriber_id, error)
+            return
+
+        retry = threading.Timer(PUSH_RETRY_DELAY*2**attempt, self._push,
+                                [subscriber_id, version, changes, removed, attempt + 1])
+        retry.daemon = True
+        retry.start()
+
+    def _drop_subscriber(self, subscriber_id, error):
+        '''
+        Remove a client from the subscribers after pushes to it kept failing. The
+        client notices it gets no more heartbeats and subscribes again.
+
+        Parameters:
+            subscriber_id: The unique id of the client.
+            error: Why the push failed.
+
+        Returns:
+            N/A
+        '''
+        with self.lock:
+            if(subscriber_id not in self.param_subscribers):
+                return
+        print("[WARNING]: Dropping parameter subscriber %s: %s" % (subscriber_id, error))
+        self.unsubscribe_params(subscriber_id)
+
+    def flush(self):
+        '''
+        Write the parameters set since the last flush to the store of the database.
+
+        Parameter:
+            N/A
+
+        Returns:
+            N/A
+        '''
+        with self.lock:
+            if(not self.pending_params or self.store is None):
+                return
+
+            try:
+                self.store.write(self.tree, self.pending_params)
+            except Exception as e:
+                print("[ERROR]: Could not write parameter database", self.xml_file, ":", e)
+                return
+            self.pending_params = {}
+
+    def _reload_if_modified(self):
+        '''
+        Reload the database if it was modified by something other than the
+        parameter server. Parameters set since the last flush are applied on top
+        of the edited database.
+
+        Parameter:
+            N/A
+
         Returns:
             N/A
         '''
+        with self.lock:
+            if(self.store is None or not self.store.modified()):
+                return
+
+            params = self._flat_params()
+            try:
+                self._load()
+            except Exception as e:
+                print("Could not reload parameter database", self.xml_file, ":", e)
+                return
+            for param_path, parameter in self.pending_params.items():
+                self._set_element(param_path, parameter)
+            self._notify_reload(params)
+
+    def import_parameters(self, xml_file):
+        '''
+        Set every parameter of an xml file in the database. Parameters of the
+        database that are not in the file are kept.
+
+        Parameters:
+            xml_file: The xml file to import.
+
+        Returns:
+            True if the parameters were set, False otherwise.
+        '''
         try:
-            tree = ET.parse(self.xml_file)
-            tree_head = tree.getroot()
+            tree = ET.parse(xml_file)
+        except Exception as e:
+            print("Could not import parameters from", xml_file, ":", e)
+            return False
 
-            param_path = param_path.split('/')
+        params = {param_path: self._element_parameter(element) for param_path, element in index_tree(tree).items() \
+                        if(len(element) == 0 and (element.text is not None or element.get("type") is not None))}
+        return self.set_many(params)
 
-            #Search for parameter in parameter path.
-            for level, param_tag in enumerate(param_path):
-                tree_head = tree_head.findall(param_tag)
+    def export_parameters(self, xml_file):
+        '''
+        Write the whole database to an xml file.
+
+        Parameters:
+            xml_file: The xml file to export to.
 
-                tree_head = tree_head[0]
-            parameter = tree_head.text
-            return parameter
+        Returns:
+            True if the file was written, False otherwise.
+        '''
+        try:
+            with self.lock:
+                write_xml(self.tree, xml_file)
+            return True
         except Exception as e:
-            print("Could not get parameter", param_path, ". Parameter path may not exsist:", e)
+            print("Could not export parameters to", xml_file, ":", e)
             return False
+
+    def _flush_loop(self):
+        '''
+        Thread that periodically picks up edits to the xml file and writes set
+        parameters to it.
+
+        Parameter:
+            N/A
+
+        Returns:
+            N/A
+        '''
+        while(self.run_flush_thread):
+            time.sleep(self.flush_interval)
+            self._reload_if_modified()
+            self.flush()
+
     def run(self):
         '''
         Run the xml rpc parameter server.
@@ -135,4 +717,7 @@ class Parameter_Server:
         Returns:
             N/A
         '''
+        if(self.control_server is not None):
+            self.control_server_thread = threading.Thread(target=self.control_server.serve_forever, daemon=True)
+            self.control_server_thread.start()
         self.server.serve_forever()
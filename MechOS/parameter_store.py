@@ -0,0 +1,424 @@
+'''
+Description: parameter_store contains the storage backends of the parameter server.
+             The parameter server keeps the whole parameter database in memory as
+             an xml element tree. A store loads that tree and writes the changes
+             made to it back to disk.
+
+             Xml_Parameter_Store keeps the database as one xml file and rewrites
+             it on every write. Log_Parameter_Store appends each change to a log
+             next to an xml snapshot and only rewrites the snapshot once the log
+             grows large, so the cost of a write does not depend on the size of
+             the database.
+
+             Parameters are typed. An element has a type attribute of "int",
+             "float", "bool", "int_array" or "float_array", or none for a string.
+             Arrays of more than one dimension also have a shape attribute, e.g.
+             <camera_matrix type="float_array" shape="3 3">...</camera_matrix>.
+             Ints must fit in the 32 bits xmlrpc can send.
+'''
+import xml.etree.ElementTree as ET
+import xmlrpc.client
+import tempfile
+import json
+import os
+import collections
+
+def _flatten_array(array):
+    '''
+    Flatten a nested list of numbers.
+
+    Parameters:
+        array: A number, or a list or tuple of numbers or of equally shaped lists.
+    Returns:
+        shape: A tuple of the length of each dimension.
+        values: A list of the numbers in row-major order.
+    '''
+    if(not isinstance(array, (list, tuple))):
+        return ((), [array])
+
+    flattened = [_flatten_array(item) for item in array]
+    shape = flattened[0][0] if(flattened) else ()
+    if(any(item_shape != shape for item_shape, _ in flattened)):
+        raise ValueError("Array parameters must have rows of equal length")
+    return ((len(array),) + shape, [value for _, values in flattened for value in values])
+
+def _check_int(value):
+    '''
+    Check that an int parameter can be sent over xmlrpc.
+
+    Parameters:
+        value: The int.
+    Returns:
+        N/A
+    '''
+    if(not xmlrpc.client.MININT <= value <= xmlrpc.client.MAXINT):
+        raise ValueError("Int parameter %d does not fit in 32 bits, set it as a float or a string" % value)
+
+def encode_parameter(parameter):
+    '''
+    Get the xml representation of a parameter.
+
+    Parameters:
+        parameter: A str, int, float, bool, or a list (or array) of numbers, which
+                    may be nested for arrays of more than one dimension.
+    Returns:
+        type_name: The type attribute of the element, None for strings.
+        text: The text of the element.
+        shape: The shape attribute of the element, None for one-dimensional arrays
+                and single values.
+    '''
+    #array.array, numpy arrays and numpy numbers.
+    if(hasattr(parameter, "tolist")):
+        parameter = parameter.tolist()
+
+    if(isinstance(parameter, bool)):
+        return("bool", "true" if(parameter) else "false", None)
+    if(isinstance(parameter, int)):
+        _check_int(parameter)
+        return("int", str(parameter), None)
+    if(isinstance(parameter, float)):
+        return("float", repr(parameter), None)
+    if(isinstance(parameter, str)):
+        return(None, parameter, None)
+
+    if(isinstance(parameter, (list, tuple))):
+        shape, values = _flatten_array(parameter)
+        if(any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in values)):
+            raise ValueError("Array parameters may only hold numbers")
+
+        type_name = "int_array" if(values and all(isinstance(value, int) for value in values)) else "float_array"
+        if(type_name == "int_array"):
+            for value in values:
+                _check_int(value)
+        text = ' '.join(repr(value) for value in values)
+        return(type_name, text, ' '.join(str(length) for length in shape) if(len(shape) > 1) else None)
+
+    raise ValueError("Parameters of type %s are not supported" % type(parameter).__name__)
+
+def decode_parameter(type_name, text, shape=None):
+    '''
+    Get a parameter from its xml representation.
+
+    Parameters:
+        type_name: The type attribute of the element, None for strings.
+        text: The text of the element.
+        shape: Default None. The shape attribute of the element.
+    Returns:
+        parameter: The value of the parameter. Arrays are given as lists, nested
+                    for arrays of more than one dimension.
+    '''
+    if(text is None):
+        text = ''
+    if(type_name is None or type_name == "str"):
+        return text
+    if(type_name == "bool"):
+        return(text.strip().lower() in ("true", "1"))
+    if(type_name == "int"):
+        return int(text)
+    if(type_name == "float"):
+        return float(text)
+    if(type_name in ("int_array", "float_array")):
+        convert = int if(type_name == "int_array") else float
+        values = [convert(value) for value in text.split()]
+        if(shape):
+            for length in reversed([int(length) for length in shape.split()][1:]):
+                values = [values[index:index + length] for index in range(0, len(values), length)]
+        return values
+    raise ValueError("Unknown parameter type %s" % type_name)
+
+def element_parameter(element):
+    '''
+    Get the parameter held by an element.
+
+    Parameters:
+        element: The element of the parameter.
+    Returns:
+        parameter: The value of the parameter.
+    '''
+    return decode_parameter(element.get("type"), element.text, element.get("shape"))
+
+def normalize_parameter(parameter):
+    '''
+    Get a parameter the way the parameter server gives it back once it is set,
+    e.g. tuples and arrays as lists.
+
+    Parameters:
+        parameter: The parameter as it is set.
+    Returns:
+        parameter: The parameter as it is stored.
+    '''
+    return decode_parameter(*encode_parameter(parameter))
+
+def set_element(tree, param_index, param_path, parameter):
+    '''
+    Set the parameter of the element of a parameter path, creating the elements
+    of the path that don't exist yet.
+
+    Parameters:
+        tree: The element tree of the database.
+        param_index: The dictionary from parameter path to element of the tree.
+        param_path: The parameter path, e.g. 'PID/roll_pid/p'.
+        parameter: The parameter, see encode_parameter.
+    Returns:
+        element: The element of the parameter.
+    '''
+    #Check the parameter before any element is created.
+    type_name, text, shape = encode_parameter(parameter)
+
+    element = param_index.get(param_path)
+    if(element is None):
+        param_path_list = param_path.split('/')
+
+        #Find the deepest part of the path that already exists.
+        parent = tree.getroot()
+        for level in range(len(param_path_list) - 1, 0, -1):
+            existing = param_index.get('/'.join(param_path_list[:level]))
+            if(existing is not None):
+                parent = existing
+                break
+        else:
+            level = 0
+
+        #Generate the new path
+        element = parent
+        for sub_level in range(level, len(param_path_list)):
+            element = ET.SubElement(element, param_path_list[sub_level])
+            param_index['/'.join(param_path_list[:sub_level + 1])] = element
+
+    element.text = text
+    for attribute, value in (("type", type_name), ("shape", shape)):
+        if(value is None):
+            element.attrib.pop(attribute, None)
+        else:
+            element.set(attribute, value)
+    return element
+
+def index_tree(tree):
+    '''
+    Index the path of every element of a tree. If several elements have the
+    same path, the first one is used.
+
+    Parameters:
+        tree: The element tree of the database.
+    Returns:
+        param_index: A dictionary from parameter path to element.
+    '''
+    param_index = {}
+    elements = collections.deque((child, child.tag) for child in tree.getroot())
+    while(elements):
+        element, param_path = elements.popleft()
+        if(param_path not in param_index):
+            param_index[param_path] = element
+        elements.extend((child, param_path + '/' + child.tag) for child in element)
+    return param_index
+
+def write_xml(tree, xml_file):
+    '''
+    Write a tree to an xml file. The tree is written to a temporary file first
+    and then renamed over the old file, so the file is never half written.
+
+    Parameters:
+        tree: The element tree to write.
+        xml_file: The path of the xml file.
+    Returns:
+        N/A
+    '''
+    directory = os.path.dirname(os.path.abspath(xml_file))
+    file_descriptor, temporary_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary:
+            tree.write(temporary)
+            temporary.flush()
+            os.fsync(temporary.fileno())
+        os.replace(temporary_file, xml_file)
+    except BaseException:
+        try:
+            os.remove(temporary_file)
+        except OSError:
+            pass
+        raise
+
+class Xml_Parameter_Store:
+    '''
+    Stores the parameter database as a single xml file.
+    '''
+    def __init__(self, xml_file):
+        '''
+        Parameters:
+            xml_file: The path of the xml file.
+        '''
+        self.xml_file = xml_file
+
+        #Modification time of the xml file when it was last read or written.
+        self.xml_file_mtime = None
+
+    def load(self):
+        '''
+        Read the database from disk.
+
+        Parameters:
+            N/A
+        Returns:
+            tree: The element tree of the database.
+        '''
+        self.xml_file_mtime = os.stat(self.xml_file).st_mtime_ns
+        return ET.parse(self.xml_file)
+
+    def write(self, tree, changes):
+        '''
+        Save the changes made to the database.
+
+        Parameters:
+            tree: The element tree of the database, with the changes applied.
+            changes: A dictionary from parameter path to parameter of every
+                    parameter set since the last write.
+        Returns:
+            N/A
+        '''
+        write_xml(tree, self.xml_file)
+        self.xml_file_mtime = os.stat(self.xml_file).st_mtime_ns
+
+    def modified(self):
+        '''
+        Check if the database was modified on disk by something other than the
+        store since it was last read or written.
+
+        Parameters:
+            N/A
+        Returns:
+            True if it needs to be loaded again.
+        '''
+        try:
+            return os.stat(self.xml_file).st_mtime_ns != self.xml_file_mtime
+        except OSError:
+            return False
+
+    def close(self):
+        '''
+        Release the files of the store.
+        '''
+        pass
+
+class Log_Parameter_Store(Xml_Parameter_Store):
+    '''
+    Stores the parameter database as an xml snapshot plus a log of the parameters
+    set since the snapshot was taken, one json record per line in xml_file + ".log".
+    A write appends to the log. Once the log is larger than both compact_size
+    and the snapshot, the snapshot is rewritten and the log emptied.
+
+    The snapshot is a normal parameter xml file, so an existing xml database can
+    be used as is. If the snapshot is edited by hand, the log is replayed on top
+    of the edited snapshot and compacted into it, so parameters set since the
+    last compaction are kept.
+    '''
+    def __init__(self, xml_file, compact_size=1048576):
+        '''
+        Parameters:
+            xml_file: The path of the xml snapshot.
+            compact_size: Default 1048576. The number of bytes the log may grow
+                        to before the snapshot is rewritten.
+        '''
+        Xml_Parameter_Store.__init__(self, xml_file)
+        self.log_file = xml_file + ".log"
+        self.compact_size = compact_size
+        self.log = None
+        self.log_size = 0
+        self.snapshot_size = 0
+
+    def load(self):
+        '''
+        Read the snapshot and replay the log on top of it.
+
+        Parameters:
+            N/A
+        Returns:
+            tree: The element tree of the database.
+        '''
+        edited = self.xml_file_mtime is not None
+        if(os.path.exists(self.xml_file)):
+            tree = Xml_Parameter_Store.load(self)
+            self.snapshot_size = os.path.getsize(self.xml_file)
+        else:
+            tree = ET.ElementTree(ET.Element("parameters"))
+
+        if(self.log is not None):
+            self.log.close()
+        self.log = open(self.log_file, "a+b")
+
+        self.log.seek(0)
+        records = self.log.read()
+
+        #The last record is torn if the process died writing it. It is cut off
+        #so the next record appended starts on its own line.
+        self.log_size = records.rfind(b'\n') + 1
+        if(self.log_size != len(records)):
+            self.log.truncate(self.log_size)
+
+        param_index = index_tree(tree)
+        for record in records[:self.log_size].splitlines():
+            param_path, parameter = json.loads(record)
+            set_element(tree, param_index, param_path, parameter)
+
+        #Once loaded, the snapshot only changes on disk if it is edited by hand.
+        #The edit is written back with the log applied so the log can be emptied.
+        if(edited):
+            self.compact(tree)
+        return tree
+
+    def write(self, tree, changes):
+        '''
+        Append the changes made to the database to the log, and compact the log
+        into the snapshot once it is large.
+
+        Parameters:
+            tree: The element tree of the database, with the changes applied.
+            changes: A dictionary from parameter path to parameter of every
+                    parameter set since the last write.
+        Returns:
+            N/A
+        '''
+        records = b''.join(json.dumps([param_path, parameter], separators=(',', ':')).encode() + b'\n' \
+                                for param_path, parameter in changes.items())
+        self.log.write(records)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_size += len(records)
+
+        if(self.log_size > max(self.compact_size, self.snapshot_size)):
+            self.compact(tree)
+
+    def compact(self, tree):
+        '''
+        Rewrite the snapshot with the whole database and empty the log.
+
+        Parameters:
+            tree: The element tree of the database.
+        Returns:
+            N/A
+        '''
+        Xml_Parameter_Store.write(self, tree, None)
+        self.snapshot_size = os.path.getsize(self.xml_file)
+
+        #The log is only emptied once the new snapshot is in place. If the
+        #process dies between the two, replaying the log again is harmless.
+        self._truncate_log()
+
+    def _truncate_log(self):
+        '''
+        Empty the log.
+        '''
+        self.log.truncate(0)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_size = 0
+
+    def close(self):
+        '''
+        Close the log.
+        '''
+        if(self.log is not None):
+            self.log.close()
+            self.log = None
+
+#The stores use_parameter_database can choose between.
+PARAMETER_STORES = {"xml": Xml_Parameter_Store, "log": Log_Parameter_Store}
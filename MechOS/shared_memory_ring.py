@@ -0,0 +1,356 @@
+'''
+Description: shared_memory_ring contains the single-producer/multi-consumer ring
+             buffer used by shm publishers and subscribers to move messages between
+             processes on the same host without going through sockets.
+'''
+import os
+import mmap
+import struct
+from multiprocessing import shared_memory
+
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+
+#Ring header: number of messages written, number of slots, bytes per slot payload,
+#number of subscriber cursors.
+RING_HEADER = struct.Struct('=QIII')
+
+#Subscriber cursor: id of the subscriber owning the cursor and the sequence number
+#of the last message it has read.
+CURSOR = struct.Struct('=16sQ')
+
+#Slot header: sequence number of the message in the slot and its length in bytes.
+SLOT_HEADER = struct.Struct('=QI4x')
+
+def ring_name(publisher_id):
+    '''
+    Get the name of the shared memory block of a shm publisher. The name is kept
+    short since some operating systems limit it to 31 characters.
+
+    Parameters:
+        publisher_id: The unique id of the publisher.
+    Returns:
+        name: The name of the shared memory block.
+    '''
+    return("mechos_" + publisher_id[:20])
+
+class Shared_Memory_Ring:
+    '''
+    A ring buffer of fixed size slots in a multiprocessing shared memory block.
+    One publisher writes messages into the slots and each subscriber keeps its own
+    read cursor. A slot is rewritten once the publisher laps it, so a subscriber
+    that falls more than a full ring behind loses the oldest messages rather than
+    slowing the publisher down.
+    '''
+    def __init__(self, name, slot_count=None, slot_size=None, max_subscribers=32):
+        '''
+        Create a new ring buffer or attach to an existing one.
+
+        Parameters:
+            name: The name of the shared memory block.
+            slot_count: The number of messages the ring holds. If None, attach to
+                        the existing ring with the given name instead of creating it.
+            slot_size: The maximum number of bytes of a message.
+            max_subscribers: Default 32. The number of subscriber cursors.
+        Returns:
+            N/A
+        '''
+        self.name = name
+        self.owner = slot_count is not None
+
+        if(self.owner):
+            size = RING_HEADER.size + max_subscribers*CURSOR.size + \
+                    slot_count*(SLOT_HEADER.size + slot_size)
+            self.shared_memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.buffer = self.shared_memory.buf
+            self.buffer[:RING_HEADER.size + max_subscribers*CURSOR.size] = \
+                    bytes(RING_HEADER.size + max_subscribers*CURSOR.size)
+            RING_HEADER.pack_into(self.buffer, 0, 0, slot_count, slot_size, max_subscribers)
+        else:
+            self.shared_memory = self._attach(name)
+            self.buffer = self.shared_memory.buf
+            _, slot_count, slot_size, max_subscribers = RING_HEADER.unpack_from(self.buffer, 0)
+
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.max_subscribers = max_subscribers
+
+        self.cursors_offset = RING_HEADER.size
+        self.slots_offset = RING_HEADER.size + max_subscribers*CURSOR.size
+
+        #Number of messages read_new skipped because they were overwritten
+        #before they could be read.
+        self.dropped = 0
+        self.slot_stride = SLOT_HEADER.size + slot_size
+
+    def _attach(self, name):
+        '''
+        Attach to an existing shared memory block without letting this process
+        remove it from the system when it exits. Only the publisher owning the
+        ring is allowed to unlink it.
+
+        Before python 3.13 SharedMemory registers every block it opens with the
+        resource tracker. Unregistering it again is not safe: processes started
+        by multiprocessing share the tracker of their parent, so it would also
+        drop the registration of the publisher. Those versions open the block
+        directly so the tracker never hears of it.
+
+        Parameters:
+            name: The name of the shared memory block.
+        Returns:
+            shared_memory: The attached shared memory block.
+        Raises:
+            FileNotFoundError: If no block with this name exists on this host.
+        '''
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            if(_posixshmem is None):
+                #Only posix shared memory is tracked.
+                return shared_memory.SharedMemory(name=name)
+            return _Untracked_Shared_Memory(name)
+
+    def write_sequence(self):
+        '''
+        Get the sequence number of the last message written to the ring.
+
+        Parameters:
+            N/A
+        Returns:
+            sequence: The sequence number, 0 if nothing was written yet.
+        '''
+        return RING_HEADER.unpack_from(self.buffer, 0)[0]
+
+    def write(self, message_encoded):
+        '''
+        PUBLISHER ONLY
+
+        Copy a packed message into the next slot of the ring.
+
+        Parameters:
+            message_encoded: The bytes-like packed message. It must not be larger
+                            than the slot size.
+        Returns:
+            sequence: The sequence number given to the message.
+        '''
+        length = len(message_encoded)
+        if(length > self.slot_size):
+            raise ValueError("Message of %d bytes does not fit in a %d byte ring slot" % (length, self.slot_size))
+
+        sequence = self.write_sequence() + 1
+        offset = self.slots_offset + ((sequence - 1) % self.slot_count)*self.slot_stride
+
+        #Mark the slot as being written so readers don't take a torn message.
+        SLOT_HEADER.pack_into(self.buffer, offset, 0, length)
+        self.buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length] = message_encoded
+        SLOT_HEADER.pack_into(self.buffer, offset, sequence, length)
+
+        struct.pack_into('=Q', self.buffer, 0, sequence)
+        return sequence
+
+    def read(self, sequence):
+        '''
+        Copy the message with the given sequence number out of the ring.
+
+        Parameters:
+            sequence: The sequence number of the message to read.
+        Returns:
+            message_encoded: The bytes of the message, or None if the slot has
+                            already been rewritten with a newer message.
+        '''
+        offset = self.slots_offset + ((sequence - 1) % self.slot_count)*self.slot_stride
+        slot_sequence, length = SLOT_HEADER.unpack_from(self.buffer, offset)
+        if(slot_sequence != sequence):
+            return None
+
+        message_encoded = bytes(self.buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length])
+
+        #If the publisher lapped the slot during the copy, the message is torn.
+        if(SLOT_HEADER.unpack_from(self.buffer, offset)[0] != sequence):
+            return None
+        return message_encoded
+
+    def read_new(self, cursor_index):
+        '''
+        SUBSCRIBER ONLY
+
+        Read every message written since the last call and advance the cursor.
+        Messages that were overwritten before they could be read are skipped.
+
+        Parameters:
+            cursor_index: The index of the cursor of the subscriber.
+        Returns:
+            messages: A list of the bytes of each new message, oldest first.
+        '''
+        messages = []
+        cursor_offset = self.cursors_offset + cursor_index*CURSOR.size
+        read_sequence = struct.unpack_from('=Q', self.buffer, cursor_offset + 16)[0]
+
+        while(1):
+            write_sequence = self.write_sequence()
+            if(read_sequence >= write_sequence):
+                break
+
+            #Skip ahead if the publisher has lapped the subscriber.
+            if(read_sequence < write_sequence - self.slot_count):
+                self.dropped += write_sequence - self.slot_count - read_sequence
+                read_sequence = write_sequence - self.slot_count
+
+            while(read_sequence < write_sequence):
+                read_sequence += 1
+                message_encoded = self.read(read_sequence)
+                if(message_encoded is not None):
+                    messages.append(message_encoded)
+                else:
+                    self.dropped += 1
+
+            #Publish the cursor before checking for newer messages so the publisher
+            #either sees the subscriber caught up or the loop picks up its message.
+            struct.pack_into('=Q', self.buffer, cursor_offset + 16, read_sequence)
+
+        return messages
+
+    def read_latest(self, cursor_index):
+        '''
+        SUBSCRIBER ONLY
+
+        Read only the newest message written since the last call and advance the
+        cursor past every message before it.
+
+        Parameters:
+            cursor_index: The index of the cursor of the subscriber.
+        Returns:
+            message_encoded: The bytes of the newest message, or None if nothing
+                            new was written.
+        '''
+        message_encoded = None
+        cursor_offset = self.cursors_offset + cursor_index*CURSOR.size
+        read_sequence = struct.unpack_from('=Q', self.buffer, cursor_offset + 16)[0]
+
+        while(1):
+            write_sequence = self.write_sequence()
+            if(read_sequence >= write_sequence):
+                break
+
+            #A newer message torn by the publisher lapping its slot leaves the
+            #one read before it as the newest.
+            newest = self.read(write_sequence)
+            if(newest is not None):
+                message_encoded = newest
+            read_sequence = write_sequence
+
+            #Publish the cursor before checking for newer messages, like read_new.
+            struct.pack_into('=Q', self.buffer, cursor_offset + 16, read_sequence)
+
+        return message_encoded
+
+    def add_cursor(self, subscriber_id):
+        '''
+        PUBLISHER ONLY
+
+        Give a subscriber a read cursor starting at the newest message.
+
+        Parameters:
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            cursor_index: The index of the cursor, or None if every cursor is taken.
+        '''
+        key = bytes.fromhex(subscriber_id)[:16]
+        free_index = None
+        for cursor_index in range(self.max_subscribers):
+            cursor_id, _ = CURSOR.unpack_from(self.buffer, self.cursors_offset + cursor_index*CURSOR.size)
+            if(cursor_id == key):
+                return cursor_index
+            if(free_index is None and cursor_id == bytes(16)):
+                free_index = cursor_index
+
+        if(free_index is not None):
+            CURSOR.pack_into(self.buffer, self.cursors_offset + free_index*CURSOR.size,
+                            key, self.write_sequence())
+        return free_index
+
+    def remove_cursor(self, subscriber_id):
+        '''
+        PUBLISHER ONLY
+
+        Free the read cursor of a subscriber.
+
+        Parameters:
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            N/A
+        '''
+        cursor_index = self.find_cursor(subscriber_id)
+        if(cursor_index is not None):
+            CURSOR.pack_into(self.buffer, self.cursors_offset + cursor_index*CURSOR.size, bytes(16), 0)
+
+    def find_cursor(self, subscriber_id):
+        '''
+        Find the index of the read cursor that the publisher gave a subscriber.
+
+        Parameters:
+            subscriber_id: The unique id of the subscriber.
+        Returns:
+            cursor_index: The index of the cursor, or None if it has none.
+        '''
+        key = bytes.fromhex(subscriber_id)[:16]
+        for cursor_index in range(self.max_subscribers):
+            cursor_id, _ = CURSOR.unpack_from(self.buffer, self.cursors_offset + cursor_index*CURSOR.size)
+            if(cursor_id == key):
+                return cursor_index
+        return None
+
+    def cursor_sequence(self, cursor_index):
+        '''
+        Get the sequence number of the last message read through a cursor.
+
+        Parameters:
+            cursor_index: The index of the cursor.
+        Returns:
+            sequence: The sequence number of the last message read.
+        '''
+        return CURSOR.unpack_from(self.buffer, self.cursors_offset + cursor_index*CURSOR.size)[1]
+
+    def close(self):
+        '''
+        Detach from the ring. The publisher owning the ring also removes it from
+        the system.
+
+        Parameters:
+            N/A
+        Returns:
+            N/A
+        '''
+        self.buffer = None
+        self.shared_memory.close()
+        if(self.owner):
+            try:
+                self.shared_memory.unlink()
+            except FileNotFoundError:
+                pass
+
+class _Untracked_Shared_Memory:
+    '''
+    A posix shared memory block attached without registering it with the
+    resource tracker. Only has the parts of SharedMemory a subscriber uses.
+    '''
+    def __init__(self, name):
+        fd = _posixshmem.shm_open("/" + name, os.O_RDWR, mode=0o600)
+        try:
+            self.size = os.fstat(fd).st_size
+            self._mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.name = name
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        '''
+        Detach from the block.
+        '''
+        if(self.buf is not None):
+            self.buf.release()
+            self.buf = None
+            self._mmap.close()
@@ -10,17 +10,41 @@ class Bool:
         '''
         #construct the message format
         self.message_constructor = '?'
+
+        #precompiled struct of the message format
+        self.message_struct = struct.Struct(self.message_constructor)
+
         #number of bytes for this message
-        self.size = 1
+        self.size = self.message_struct.size
+
+    def __reduce__(self):
+        '''
+        Pickle the message format by its constructor arguments, since the
+        precompiled struct can't be pickled.
+        '''
+        return(Bool, ())
 
     def _pack(self, message):
         '''
         '''
-        encoded_message = struct.pack(self.message_constructor, message)
+        encoded_message = self.message_struct.pack(message)
         return(encoded_message)
 
     def _unpack(self, encoded_message):
         '''
         '''
-        message = struct.unpack(self.message_constructor, encoded_message)[0]
+        message = self.message_struct.unpack(encoded_message)[0]
+        return(message)
+
+    def _pack_into(self, buffer, offset, message):
+        '''
+        Pack the message straight into a writable buffer at the given offset.
+        '''
+        self.message_struct.pack_into(buffer, offset, message)
+
+    def _unpack_from(self, buffer, offset=0):
+        '''
+        Unpack the message from a buffer starting at the given offset.
+        '''
+        message = self.message_struct.unpack_from(buffer, offset)[0]
         return(message)
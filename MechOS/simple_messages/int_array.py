@@ -1,6 +1,7 @@
 '''
 '''
 import struct
+import array
 
 class Int_Array:
     '''
@@ -9,21 +10,75 @@ class Int_Array:
         '''
         '''
         #construct the message format
-        self.message_constructor = ''
-        for i in range(number_of_ints):
-            self.message_constructor += 'i'
+        self.message_constructor = 'i' * number_of_ints
 
-        #number of bytes for this message
-        self.size = 4 * number_of_ints
+        #precompiled struct of the message format
+        self.message_struct = struct.Struct('%di' % number_of_ints)
+
+        #number of ints and bytes for this message
+        self.length = number_of_ints
+        self.size = self.message_struct.size
+
+    def _as_bytes(self, message):
+        '''
+        Get the raw bytes of an array message. An array.array('i') or any buffer
+        of 4 byte ints (such as a numpy array) is used without converting
+        each element; any other iterable is converted into an array.array('i').
+        '''
+        if(not isinstance(message, array.array) or message.typecode != 'i'):
+            try:
+                buffer = memoryview(message)
+            except TypeError:
+                buffer = None
+
+            if(buffer is not None and buffer.format == 'i' and buffer.c_contiguous):
+                message = buffer
+            else:
+                message = array.array('i', message)
+
+        encoded_message = memoryview(message).cast('B')
+        if(encoded_message.nbytes != self.size):
+            raise struct.error("Int_Array expected %d ints but got %d" % (self.length, encoded_message.nbytes // 4))
+        return(encoded_message)
+
+    def __reduce__(self):
+        '''
+        Pickle the message format by its constructor arguments, since the
+        precompiled struct can't be pickled.
+        '''
+        return(Int_Array, (self.length,))
 
     def _pack(self, message):
         '''
         '''
-        encoded_message = struct.pack(self.message_constructor, *message)
+        #Lists and tuples are packed by the precompiled struct in one C call.
+        if(isinstance(message, (list, tuple))):
+            return(self.message_struct.pack(*message))
+
+        encoded_message = self._as_bytes(message).tobytes()
         return(encoded_message)
 
     def _unpack(self, encoded_message):
         '''
+        Returns an array.array('i') copied from the encoded message in one call.
         '''
-        message = struct.unpack(self.message_constructor, encoded_message)
+        if(len(encoded_message) != self.size):
+            raise struct.error("Int_Array expected %d bytes but got %d" % (self.size, len(encoded_message)))
+        message = array.array('i')
+        message.frombytes(encoded_message)
         return(message)
+
+    def _pack_into(self, buffer, offset, message):
+        '''
+        Pack the message straight into a writable buffer at the given offset.
+        '''
+        if(isinstance(message, (list, tuple))):
+            self.message_struct.pack_into(buffer, offset, *message)
+        else:
+            memoryview(buffer).cast('B')[offset:offset + self.size] = self._as_bytes(message)
+
+    def _unpack_from(self, buffer, offset=0):
+        '''
+        Unpack the message from a buffer starting at the given offset.
+        '''
+        return(self._unpack(memoryview(buffer).cast('B')[offset:offset + self.size]))
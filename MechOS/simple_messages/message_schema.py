@@ -0,0 +1,344 @@
+'''
+Description: message_schema compiles declarative message definitions into message
+             formats. The fields of a definition, including the fields of nested
+             definitions and fixed-length arrays, are packed by a single precompiled
+             struct, and variable-length arrays are appended after it as raw arrays.
+
+             Example:
+                Vector3 = Message_Schema("Vector3", [("x", 'f'), ("y", 'f'), ("z", 'f')])
+
+                Imu = Message_Schema("Imu", [("stamp", 'd'),
+                                             ("orientation", Vector3),
+                                             ("covariance", 'f', 9),
+                                             ("ranges", 'f', None, 360)])
+
+                message = Imu.new(stamp=1.5, ranges=[1.0, 2.0])
+                publisher = node.create_publisher("imu", Imu)
+'''
+import struct
+import array
+import sys
+import keyword
+
+#The array typecode used to pack a variable-length array of each struct code.
+ARRAY_TYPECODES = {'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'i': 'i', 'I': 'I',
+                   'q': 'q', 'Q': 'Q', 'f': 'f', 'd': 'd', '?': 'B'}
+
+#Default maximum number of elements of a variable-length array.
+DEFAULT_MAX_LENGTH = 1024
+
+#Every message is sent little-endian so nodes on any machine can talk.
+SWAP_BYTES = sys.byteorder != 'little'
+
+def _array_bytes(values, typecode):
+    '''
+    Get the little-endian bytes of a variable-length array field.
+
+    Parameters:
+        values: An array.array with the right typecode or any sequence of numbers.
+        typecode: The array typecode of the field.
+    Returns:
+        encoded_values: The bytes of the array.
+    '''
+    if(not isinstance(values, array.array) or values.typecode != typecode or SWAP_BYTES):
+        values = array.array(typecode, values)
+        if(SWAP_BYTES):
+            values.byteswap()
+    return(values.tobytes())
+
+def _array_from(buffer, typecode):
+    '''
+    Decode the little-endian bytes of a variable-length array field.
+
+    Parameters:
+        buffer: The bytes-like part of the message holding the array.
+        typecode: The array typecode of the field.
+    Returns:
+        values: An array.array of the decoded values.
+    '''
+    values = array.array(typecode)
+    values.frombytes(buffer)
+    if(SWAP_BYTES):
+        values.byteswap()
+    return(values)
+
+class Schema_Message:
+    '''
+    Base class of the message objects generated for each Message_Schema. The
+    fields of a message are stored in __slots__.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        '''
+        Create a message with every field set to its default value: 0 for
+        numbers, a new message for nested schemas, zeros for fixed-length arrays
+        and an empty list for variable-length arrays.
+
+        Parameters:
+            fields: Keyword arguments of the field values to set instead.
+        '''
+        for name, default in self._schema._defaults():
+            setattr(self, name, fields.pop(name) if name in fields else default)
+        if(fields):
+            raise TypeError("%s has no fields %s" % (self._schema.name, ", ".join(fields)))
+
+    def __repr__(self):
+        return("%s(%s)" % (self._schema.name, ", ".join("%s=%r" % (name, getattr(self, name)) \
+                                for name in self.__slots__)))
+
+    def __eq__(self, other):
+        #Compare by schema, since a schema unpickled by another process generates
+        #its own message class.
+        if(not isinstance(other, Schema_Message) or other._schema != self._schema):
+            return NotImplemented
+        return(all(_field_equal(getattr(self, name), getattr(other, name)) for name in self.__slots__))
+
+def _field_equal(value, other):
+    '''
+    Compare two field values, treating arrays, lists and tuples with the same
+    elements as equal.
+    '''
+    if(isinstance(value, (list, tuple, array.array))):
+        return(list(value) == list(other))
+    return(value == other)
+
+class Message_Schema:
+    '''
+    A message format compiled from a list of named fields. Each field is a tuple
+    (name, type) for a single value, (name, type, length) for a fixed-length
+    array or (name, type, None, max_length) for a variable-length array, where
+    type is a struct format character ('b', 'B', 'h', 'H', 'i', 'I', 'q', 'Q',
+    'f', 'd' or '?') or another Message_Schema to nest. Variable-length arrays
+    are unpacked as array.array, except '?' arrays which are lists of bools.
+    '''
+    def __init__(self, name, fields):
+        '''
+        Compile the message definition.
+
+        Parameters:
+            name: The name of the message type.
+            fields: The list of field tuples of the message.
+        '''
+        self.name = name
+        self.definition = [tuple(field) for field in fields]
+        self.fields = [self._parse_field(field) for field in fields]
+
+        self.message_class = type(name, (Schema_Message,),
+                                  {"__slots__": tuple(field[0] for field in self.fields),
+                                   "_schema": self})
+        self._compile()
+
+    def __reduce__(self):
+        '''
+        Pickle the schema by its definition, since the generated functions can't
+        be pickled. The schema is compiled again when it is unpickled.
+        '''
+        return(Message_Schema, (self.name, self.definition))
+
+    def __eq__(self, other):
+        '''
+        Schemas with the same name and definition pack messages the same way, so
+        they are equal even if they were compiled separately.
+        '''
+        if(not isinstance(other, Message_Schema)):
+            return NotImplemented
+        return(self is other or (self.name == other.name and self.definition == other.definition))
+
+    def __hash__(self):
+        return(hash(self.name))
+
+    def _parse_field(self, field):
+        '''
+        Check a field definition and fill in its defaults.
+
+        Parameters:
+            field: A tuple (name, type[, length[, max_length]]).
+        Returns:
+            field: A tuple (name, type, length, max_length).
+        '''
+        name, field_type, length, max_length = (tuple(field) + (None, None))[:4]
+
+        #Field names become attribute names in the generated source.
+        if(not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name)):
+            raise ValueError("Field %r: field names must be python identifiers that are not keywords" % (name,))
+
+        if(isinstance(field_type, Message_Schema)):
+            if(length is not None):
+                raise ValueError("Field %s: arrays of nested messages are not supported" % name)
+        elif(field_type not in ARRAY_TYPECODES):
+            raise ValueError("Field %s: unknown type %r" % (name, field_type))
+
+        if(length is None and len(field) > 2 and max_length is None):
+            max_length = DEFAULT_MAX_LENGTH
+        if(length is None and max_length is not None and isinstance(field_type, Message_Schema)):
+            raise ValueError("Field %s: arrays of nested messages are not supported" % name)
+        return((name, field_type, length, max_length))
+
+    def _defaults(self):
+        '''
+        Get the default value of each field of a new message.
+
+        Returns:
+            defaults: A generator of (name, default value) pairs.
+        '''
+        for name, field_type, length, max_length in self.fields:
+            if(isinstance(field_type, Message_Schema)):
+                yield name, field_type.new()
+            elif(length is not None):
+                yield name, [0]*length
+            elif(max_length is not None):
+                yield name, []
+            else:
+                yield name, 0
+
+    def new(self, **fields):
+        '''
+        Create a message of this type.
+
+        Parameters:
+            fields: Keyword arguments of the field values to set.
+        Returns:
+            message: The new message object.
+        '''
+        return(self.message_class(**fields))
+
+    def _flatten(self, expression, variable, state):
+        '''
+        Walk the fields of the schema and its nested schemas, adding them to
+        the struct format and the lines of the generated functions.
+
+        Parameters:
+            expression: The python expression of the message holding the fields.
+            variable: The local variable the unpacked message is built in.
+            state: The dictionary of the generated code being built.
+        '''
+        class_name = "_class_%d" % len(state["classes"])
+        state["classes"][class_name] = self.message_class
+        unpack_lines = state["unpack_lines"]
+        unpack_lines.append("%s = _new(%s)" % (variable, class_name))
+
+        for name, field_type, length, max_length in self.fields:
+            field_expression = "%s.%s" % (expression, name)
+
+            if(isinstance(field_type, Message_Schema)):
+                state["variables"] += 1
+                child_variable = "_m%d" % state["variables"]
+                field_type._flatten(field_expression, child_variable, state)
+                unpack_lines.append("%s.%s = %s" % (variable, name, child_variable))
+
+            elif(length is not None):
+                index = state["count"]
+                state["format"].append("%d%s" % (length, field_type))
+                state["pack_arguments"].append("*" + field_expression)
+                unpack_lines.append("%s.%s = list(_values[%d:%d])" % (variable, name, index, index + length))
+                state["count"] += length
+
+            elif(max_length is not None):
+                index = state["count"]
+                state["format"].append('I')
+                state["pack_arguments"].append("len(%s)" % field_expression)
+                state["variable_fields"].append((field_expression, variable, name, index,
+                                                ARRAY_TYPECODES[field_type], max_length,
+                                                field_type == '?'))
+                state["count"] += 1
+
+            else:
+                index = state["count"]
+                state["format"].append(field_type)
+                state["pack_arguments"].append(field_expression)
+                unpack_lines.append("%s.%s = _values[%d]" % (variable, name, index))
+                state["count"] += 1
+
+    def _compile(self):
+        '''
+        Build the struct of the fixed-size part of the message and generate the
+        _pack, _unpack, _pack_into and _unpack_from functions.
+        '''
+        state = {"format": ['<'], "pack_arguments": [], "unpack_lines": [],
+                 "variable_fields": [], "classes": {}, "count": 0, "variables": 0}
+        self._flatten("message", "_m0", state)
+
+        self.message_constructor = ''.join(state["format"])
+        self.message_struct = struct.Struct(self.message_constructor)
+        self.fixed_size = self.message_struct.size
+
+        #number of bytes for this message, the largest possible if it has
+        #variable-length arrays.
+        self.size = self.fixed_size + sum(array.array(typecode).itemsize*max_length \
+                            for _, _, _, _, typecode, max_length, _ in state["variable_fields"])
+
+        namespace = dict(state["classes"])
+        namespace.update({"_struct_pack": self.message_struct.pack,
+                          "_struct_pack_into": self.message_struct.pack_into,
+                          "_struct_unpack_from": self.message_struct.unpack_from,
+                          "_new": object.__new__,
+                          "_array_bytes": _array_bytes,
+                          "_array_from": _array_from,
+                          "_fixed_size": self.fixed_size})
+        pack_arguments = ", ".join(state["pack_arguments"])
+        variable_fields = state["variable_fields"]
+
+        lines = []
+        if(not variable_fields):
+            #The whole message is packed by one call to the struct.
+            lines.append("def _pack(message):")
+            lines.append("    return _struct_pack(%s)" % pack_arguments)
+            lines.append("def _pack_into(buffer, offset, message):")
+            lines.append("    _struct_pack_into(buffer, offset, %s)" % pack_arguments)
+            lines.append("    return _fixed_size")
+        else:
+            lines.append("def _variable_parts(message):")
+            parts = []
+            for field_expression, _, name, _, typecode, max_length, _ in variable_fields:
+                lines.append("    if(len(%s) > %d):" % (field_expression, max_length))
+                lines.append("        raise ValueError('Field %s has more than %d elements')" % (name, max_length))
+                parts.append("_array_bytes(%s, %r)" % (field_expression, typecode))
+            lines.append("    return (%s,)" % ", ".join(parts))
+
+            lines.append("def _pack(message):")
+            lines.append("    parts = _variable_parts(message)")
+            lines.append("    return b''.join((_struct_pack(%s),) + parts)" % pack_arguments)
+
+            lines.append("def _pack_into(buffer, offset, message):")
+            lines.append("    parts = _variable_parts(message)")
+            lines.append("    _struct_pack_into(buffer, offset, %s)" % pack_arguments)
+            lines.append("    view = memoryview(buffer).cast('B')")
+            lines.append("    position = offset + _fixed_size")
+            lines.append("    for part in parts:")
+            lines.append("        view[position:position + len(part)] = part")
+            lines.append("        position += len(part)")
+            lines.append("    return position - offset")
+
+        lines.append("def _unpack_from(buffer, offset=0):")
+        lines.append("    _values = _struct_unpack_from(buffer, offset)")
+        lines.extend("    " + line for line in state["unpack_lines"])
+        if(variable_fields):
+            lines.append("    view = memoryview(buffer).cast('B')")
+            lines.append("    position = offset + _fixed_size")
+            for _, variable, name, index, typecode, max_length, boolean in variable_fields:
+                itemsize = array.array(typecode).itemsize
+                lines.append("    end = position + %d*_values[%d]" % (itemsize, index))
+
+                #The count comes from the buffer, which may be corrupt or cut short.
+                lines.append("    if(_values[%d] > %d or end > len(view)):" % (index, max_length))
+                lines.append("        raise ValueError('Field %s has %%d elements, more than the message holds' %% _values[%d])" % \
+                                (name, index))
+                if(boolean):
+                    #Bools are sent as bytes, give them back as bools like scalar fields.
+                    lines.append("    %s.%s = [bool(value) for value in view[position:end]]" % (variable, name))
+                else:
+                    lines.append("    %s.%s = _array_from(view[position:end], %r)" % (variable, name, typecode))
+                lines.append("    position = end")
+        lines.append("    return _m0")
+
+        lines.append("def _unpack(encoded_message):")
+        lines.append("    return _unpack_from(encoded_message, 0)")
+
+        self.source = "\n".join(lines)
+        exec(compile(self.source, "<Message_Schema %s>" % self.name, "exec"), namespace)
+
+        self._pack = namespace["_pack"]
+        self._unpack = namespace["_unpack"]
+        self._pack_into = namespace["_pack_into"]
+        self._unpack_from = namespace["_unpack_from"]
@@ -0,0 +1,86 @@
+'''
+'''
+import struct
+import math
+
+#numpy is only needed by programs that send ndarray messages.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Header of an encoded ndarray: the dtype string (such as '<f4') and the number
+#of dimensions. It is followed by one unsigned int per dimension for the shape.
+NDARRAY_HEADER = struct.Struct('!16sB')
+
+#Largest number of dimensions an ndarray message can have.
+MAX_DIMENSIONS = 32
+
+class Ndarray:
+    '''
+    Message format for numpy ndarrays such as camera frames, lidar scans or IMU
+    batches. The array is sent as a small dtype/shape header followed by the
+    bytes of its buffer, and is decoded with numpy.frombuffer without converting
+    each element.
+    '''
+    def __init__(self, shape=None, dtype=None, max_size=1048576):
+        '''
+        Parameters:
+            shape: Default None. The shape every array sent must have. If None,
+                    arrays of any shape are allowed.
+            dtype: Default None. The dtype every array sent is converted to. If
+                    None, arrays keep their own dtype.
+            max_size: Default 1048576. The maximum number of bytes of array data
+                    when the shape or dtype is not fixed.
+        '''
+        if(numpy is None):
+            raise ImportError("The Ndarray message format requires numpy to be installed")
+
+        self.shape = None if shape is None else tuple(shape)
+        self.dtype = None if dtype is None else numpy.dtype(dtype)
+
+        #number of bytes for this message. Arrays with a fixed shape and dtype
+        #always have this size, otherwise it is the largest allowed.
+        if(self.shape is not None and self.dtype is not None):
+            self.size = NDARRAY_HEADER.size + 4*len(self.shape) + \
+                        math.prod(self.shape)*self.dtype.itemsize
+        else:
+            self.size = NDARRAY_HEADER.size + 4*MAX_DIMENSIONS + max_size
+
+    def _pack(self, message):
+        '''
+        Encode an array. A C-contiguous array of the right dtype is copied
+        straight from its buffer.
+        '''
+        message = numpy.ascontiguousarray(message, dtype=self.dtype)
+        if(self.shape is not None and message.shape != self.shape):
+            raise ValueError("Ndarray expected shape %s but got %s" % (self.shape, message.shape))
+        if(message.dtype.hasobject):
+            raise ValueError("Ndarray can't send arrays of python objects")
+        if(message.ndim > MAX_DIMENSIONS):
+            raise ValueError("Ndarray can't have more than %d dimensions" % MAX_DIMENSIONS)
+
+        header = NDARRAY_HEADER.pack(message.dtype.str.encode(), message.ndim) + \
+                    struct.pack('!%dI' % message.ndim, *message.shape)
+
+        encoded_message = b''.join((header, memoryview(message).cast('B')))
+        if(len(encoded_message) > self.size):
+            raise ValueError("Ndarray of %d bytes is larger than the %d byte message size" % \
+                                (len(encoded_message), self.size))
+        return(encoded_message)
+
+    def _unpack(self, encoded_message):
+        '''
+        Decode an array with numpy.frombuffer over the encoded message. Immutable
+        bytes are used without a copy, which gives a read-only array. Bytes in a
+        reused receive buffer are copied once.
+        '''
+        dtype, ndim = NDARRAY_HEADER.unpack_from(encoded_message, 0)
+        shape = struct.unpack_from('!%dI' % ndim, encoded_message, NDARRAY_HEADER.size)
+
+        message = numpy.frombuffer(encoded_message, dtype=numpy.dtype(dtype.rstrip(b'\x00').decode()),
+                                    offset=NDARRAY_HEADER.size + 4*ndim).reshape(shape)
+
+        if(not isinstance(encoded_message, bytes)):
+            message = message.copy()
+        return(message)
@@ -0,0 +1,93 @@
+'''
+Description: topic_stats contains the counters publishers and subscribers keep
+             about the messages of their topic, and the functions mechoscore uses
+             to add up the counters of every node.
+
+             The counters are plain numbers updated without a lock, so keeping
+             them costs the hot path a few attribute increments. Each counter is
+             written by the threads of one publisher or subscriber, so a count is
+             at worst a few messages off while it is being read, which is all the
+             statistics need.
+'''
+
+#Counters kept for every publisher and subscriber. Publishers count the messages
+#they publish, subscribers the messages they receive.
+#   messages: Number of messages published or received.
+#   bytes: Number of bytes of the packed messages sent or received.
+#   send_errors: Number of sends to a subscriber that failed.
+#   partial_writes: Number of tcp writes that only sent part of the frames.
+#   drops: Number of messages dropped by full queues or lost on the way.
+#   callbacks: Number of times the callback of a subscriber was run.
+#   callback_time: Number of seconds spent running the callback of a subscriber.
+STATS_FIELDS = ("messages", "bytes", "send_errors", "partial_writes", "drops", "callbacks", "callback_time")
+
+#Largest integer xmlrpc can send. Larger counters are sent as floats.
+MAX_XMLRPC_INT = 2147483647
+
+class Topic_Stats:
+    '''
+    The counters of one publisher or subscriber.
+    '''
+    __slots__ = STATS_FIELDS
+
+    def __init__(self):
+        for field in STATS_FIELDS:
+            setattr(self, field, 0)
+
+    def snapshot(self):
+        '''
+        Get the counters so they can be sent to mechoscore.
+
+        Parameters:
+            N/A
+        Returns:
+            stats: A dictionary from the name of each counter to its value.
+        '''
+        return({field: _marshallable(getattr(self, field)) for field in STATS_FIELDS})
+
+def _marshallable(value):
+    '''
+    Get a counter in a form xmlrpc can send.
+    '''
+    if(isinstance(value, int) and value > MAX_XMLRPC_INT):
+        return float(value)
+    return value
+
+def add_topic_stats(topic_stats, node_stats):
+    '''
+    Add the counters of the publishers and subscribers of a node to the totals of
+    each topic.
+
+    Parameters:
+        topic_stats: A dictionary from topic name to the totals of the topic,
+                    updated in place.
+        node_stats: The dictionary given by the _get_topic_stats call of a node.
+    Returns:
+        N/A
+    '''
+    for endpoint_type, direction in (("publishers", "published"), ("subscribers", "received")):
+        for endpoint in node_stats.get(endpoint_type, []):
+            totals = topic_stats.setdefault(endpoint["topic"],
+                                {"protocols": [], "publishers": 0, "subscribers": 0,
+                                 "published": dict.fromkeys(STATS_FIELDS, 0),
+                                 "received": dict.fromkeys(STATS_FIELDS, 0)})
+
+            if(endpoint["protocol"] not in totals["protocols"]):
+                totals["protocols"].append(endpoint["protocol"])
+            totals[endpoint_type] += 1
+            for field in STATS_FIELDS:
+                totals[direction][field] += endpoint["stats"].get(field, 0)
+
+def marshallable_topic_stats(topic_stats):
+    '''
+    Get the totals of each topic in a form xmlrpc can send.
+
+    Parameters:
+        topic_stats: A dictionary from topic name to the totals of the topic.
+    Returns:
+        topic_stats: The same totals with counters too large for xmlrpc as floats.
+    '''
+    for totals in topic_stats.values():
+        for direction in ("published", "received"):
+            totals[direction] = {field: _marshallable(value) for field, value in totals[direction].items()}
+    return topic_stats